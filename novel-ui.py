@@ -1,13 +1,43 @@
 import tkinter as tk
 from tkinter import filedialog, messagebox, simpledialog
-import re
 import sys
-import requests
-import json
 import threading
+import asyncio
 import os
 import time
 from tkinter import ttk  # 用于Notebook
+from tkinter import font as tkfont
+
+from novel_engine import (NovelIndex, SearchIndex, SEARCH_MAX_HITS, diff_text, map_offset,
+                          ApiError, RequestCancelled, CancelToken, TokenCoalescer, use_async_http, HEDGE_AFTER,
+                          RewriteEngine, RewriteCache, TelemetryStore, JobStore, SummaryStore,
+                          EditJournal, export_revision, new_revision_filename,
+                          read_model_configs, write_model_configs, read_directions, write_directions,
+                          read_heading_grammar, MODEL_CONFIG_FILE, DIRECTIONS_FILE, HEADING_GRAMMAR_FILE,
+                          CACHE_FILE, JOBS_FILE, TELEMETRY_FILE, SUMMARY_FILE,
+                          DEFAULT_CONTEXT_TOKENS, DEFAULT_MAX_OUTPUT_TOKENS, DEFAULT_TOKENS_PER_CJK,
+                          DEFAULT_MAX_CONCURRENCY, DEFAULT_BATCH_CONCURRENCY, DEFAULT_SUMMARY_TOKENS,
+                          SUMMARY_PREVIOUS_CHAPTERS)
+
+# 配置模型窗口中的数值项：(配置键, 标签, 默认值, 类型)
+MODEL_NUMBER_FIELDS = (
+    ("connect_timeout", "连接超时(秒):", 10, float),
+    ("read_timeout", "读取超时(秒):", 120, float),
+    ("max_retries", "重试次数:", 3, int),
+    ("rpm", "每分钟请求数(0不限):", 0, int),
+    ("tpm", "每分钟token数(0不限):", 0, int),
+    ("max_concurrency", "最大并发:", DEFAULT_MAX_CONCURRENCY, int),
+    ("hedge_after", "对冲等待首字(秒):", HEDGE_AFTER, float),
+    ("context_tokens", "上下文窗口(token):", DEFAULT_CONTEXT_TOKENS, int),
+    ("max_output_tokens", "单次输出上限(token):", DEFAULT_MAX_OUTPUT_TOKENS, int),
+    ("tokens_per_cjk", "每个汉字约合(token):", DEFAULT_TOKENS_PER_CJK, float),
+    ("overlap_tokens", "分段重叠上文(token):", 0, int),
+    ("summary_tokens", "前情提要上限(token):", DEFAULT_SUMMARY_TOKENS, int),
+)
+
+# 超长章节分批显示：首屏同步插入的字数（定位点之后；之前另插入其一半），以及之后每次空闲时补齐的字数
+RENDER_FIRST_CHARS = 20000
+RENDER_CHUNK_CHARS = 50000
 
 class NovelReader:
     def __init__(self, root):
@@ -23,12 +53,21 @@ class NovelReader:
             except Exception:
                 pass
 
-        self.chapters = {}
+        self.chapters = None  # NovelIndex，加载文件后才有
+        self.journal = None   # 当前文件的修订日志
+        self.load_token = None         # 后台加载的取消标记，None 表示没有正在进行的加载
+        self.displayed_chapter = None  # 当前显示的章节序号
+        self.render_job = None         # 超长章节剩余部分的分批插入任务
+        self.render_base = 0           # 文本框开头对应的章内偏移（定位点之前的部分尚未补齐时大于 0）
+        self.search_index = None       # 全文搜索索引（SearchIndex），文件加载完成后在后台建立
+        self.search_token = None       # 建立搜索索引的取消标记
+        self.search_win = None         # 搜索结果窗口
+        self.summarizing = set()       # 正在后台生成摘要的章节序号
         self.current_file_path = None
         self.modification_direction = ""  # 旧版使用，目前保留兼容
         # 用于记录上次加载时的章节索引与文本框滚动位置
         self.last_chapter_index = None
-        self.last_scroll_fraction = None
+        self.last_scroll_offset = None
 
         # ---------------- 大模型配置信息 ----------------
         self.model_configs = {}
@@ -44,7 +83,39 @@ class NovelReader:
         self.toast_window = None
         self.toast_timer = None
 
+        # 改写结果缓存（无法创建数据库时不使用缓存）
+        try:
+            self.rewrite_cache = RewriteCache(os.path.join(os.path.dirname(sys.argv[0]), CACHE_FILE))
+        except Exception as e:
+            print("打开改写缓存出错：", e)
+            self.rewrite_cache = None
+        self.use_cache = tk.BooleanVar(value=True)
+        # 每次接口调用的耗时记录（无法创建数据库时不记录）
+        try:
+            self.telemetry = TelemetryStore(os.path.join(os.path.dirname(sys.argv[0]), TELEMETRY_FILE))
+        except Exception as e:
+            print("打开请求统计出错：", e)
+            self.telemetry = None
+        # 可恢复的改写任务（每个片段完成后立即保存，程序重启后继续）
+        try:
+            self.jobs = JobStore(os.path.join(os.path.dirname(sys.argv[0]), JOBS_FILE))
+            self.jobs.prune()
+        except Exception as e:
+            print("打开改写任务数据库出错：", e)
+            self.jobs = None
+        # 每章的摘要与设定表（按正文哈希缓存），勾选“前情提要”时加在改写提示词开头
+        try:
+            self.summaries = SummaryStore(os.path.join(os.path.dirname(sys.argv[0]), SUMMARY_FILE))
+        except Exception as e:
+            print("打开章节摘要数据库出错：", e)
+            self.summaries = None
+        self.use_summaries = tk.BooleanVar(value=False)
+        # 与界面无关的改写引擎（长连接客户端、缓存），命令行 novel_engine.py 使用同一实现
+        self.engine = RewriteEngine(self.model_configs, self.rewrite_cache, read_heading_grammar(
+            os.path.join(os.path.dirname(sys.argv[0]), HEADING_GRAMMAR_FILE)), self.telemetry, self.summaries)
+
         self.create_widgets()
+        self.root.after(500, self.check_unfinished_jobs)
 
     def create_widgets(self):
         # 顶部统一菜单栏：左侧为模型选择及当前文件显示，右侧为各功能按钮
@@ -59,6 +130,9 @@ class NovelReader:
         model_names = list(self.model_configs.keys())
         option_menu = tk.OptionMenu(model_frame, self.model_option, *model_names, command=self.change_model)
         option_menu.pack(side=tk.LEFT, padx=5)
+        tk.Checkbutton(model_frame, text="使用缓存", variable=self.use_cache).pack(side=tk.LEFT, padx=5)
+        tk.Checkbutton(model_frame, text="前情提要", variable=self.use_summaries,
+                       command=lambda: self.prepare_summaries(self.displayed_chapter)).pack(side=tk.LEFT, padx=5)
         # 显示当前加载的文件名
         self.file_label = tk.Label(model_frame, text="未加载文件", fg="blue")
         self.file_label.pack(side=tk.LEFT, padx=10)
@@ -66,12 +140,21 @@ class NovelReader:
         # 右侧：所有功能按钮
         menu_buttons_frame = tk.Frame(top_frame)
         menu_buttons_frame.pack(side=tk.RIGHT)
+        self.search_var = tk.StringVar()
+        search_entry = tk.Entry(menu_buttons_frame, textvariable=self.search_var, width=16)
+        search_entry.pack(side=tk.LEFT, padx=5)
+        search_entry.bind("<Return>", lambda e: self.search_book())
+        tk.Button(menu_buttons_frame, text="搜索", command=self.search_book).pack(side=tk.LEFT, padx=5)
         self.load_button = tk.Button(menu_buttons_frame, text="加载小说", command=self.load_novel)
         self.load_button.pack(side=tk.LEFT, padx=5)
         self.set_mod_button = tk.Button(menu_buttons_frame, text="修改方向", command=self.set_modification_direction)
         self.set_mod_button.pack(side=tk.LEFT, padx=5)
         self.modify_button = tk.Button(menu_buttons_frame, text="修改选中（调用API）", command=self.modify_selected_text)
         self.modify_button.pack(side=tk.LEFT, padx=5)
+        self.batch_button = tk.Button(menu_buttons_frame, text="批量改写", command=self.batch_modify)
+        self.batch_button.pack(side=tk.LEFT, padx=5)
+        self.export_button = tk.Button(menu_buttons_frame, text="导出修订", command=self.export_revision)
+        self.export_button.pack(side=tk.LEFT, padx=5)
         # 将原“保存修改内容”按钮改为“直接编辑本章”
         self.edit_chapter_button = tk.Button(menu_buttons_frame, text="直接编辑本章", command=self.edit_current_chapter)
         self.edit_chapter_button.pack(side=tk.LEFT, padx=5)
@@ -98,6 +181,10 @@ class NovelReader:
         self.chapter_text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         self.chapter_text.config(yscrollcommand=self.right_scrollbar.set)
         self.right_scrollbar.config(command=self.chapter_text.yview)
+        # 段首缩进由标签实现，正文原样插入，无需在每行前拼接“　　”
+        indent = tkfont.Font(font=self.chapter_text.cget("font")).measure("　　")
+        self.chapter_text.tag_configure("para", lmargin1=indent, lmargin2=0)
+        self.chapter_text.tag_configure("search_hit", background="#ffe08a")
         # 禁止在主界面直接编辑，但仍允许光标移动和选中
         self.chapter_text.bind("<Key>", lambda e: "break")
 
@@ -110,81 +197,296 @@ class NovelReader:
         if old_file is not None:
             sel = self.chapter_listbox.curselection()
             self.last_chapter_index = sel[0] if sel else 0
-            self.last_scroll_fraction = self.chapter_text.yview()[0]
+            self.last_scroll_offset = self.top_offset()
         file_path = filedialog.askopenfilename(filetypes=[("文本文件", "*.txt")])
         if not file_path:
             return
+        # 如果重新加载的是同一个文件且有之前的进度，则加载完成后恢复；否则边加载边显示第一章
+        if file_path == old_file and self.last_chapter_index is not None:
+            self.reload_current_file(self.last_chapter_index, self.last_scroll_offset or 0)
+        else:
+            self.start_loading(file_path)
+
+    def start_loading(self, file_path, on_done=None):
+        """
+        在后台线程中扫描文件建立章节索引，扫描进度与新找到的章节通过 root.after 送回界面，
+        章节列表边扫描边填充。再次调用（例如中途选择了其他文件）会取消上一次加载。
+        on_done 为加载完成后在界面线程执行的回调；不传时第一章一出现就立即显示。
+        """
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                novel_text = f.read()
-            self.current_file_path = file_path
-            self.file_label.config(text="当前文件: " + os.path.basename(file_path))
+            chapters = NovelIndex(file_path, build=False, grammar=self.engine.grammar)
         except Exception as e:
             messagebox.showerror("错误", f"无法读取文件: {str(e)}")
             return
+        if self.load_token is not None:
+            self.load_token.cancel()
+        token = CancelToken()
+        self.load_token = token
+        self.current_file_path = file_path
+        self.set_chapters(chapters)
+        name = os.path.basename(file_path)
+        state = {"shown": False}
 
-        self.chapters = self.split_into_chapters(novel_text)
-        self.chapter_listbox.delete(0, tk.END)
-        for chap_title in self.chapters.keys():
-            self.chapter_listbox.insert(tk.END, chap_title)
-
-        # 如果重新加载的是同一个文件且有之前的进度，则恢复
-        if file_path == old_file and self.last_chapter_index is not None:
-            chapter_index = self.last_chapter_index
-            if chapter_index >= self.chapter_listbox.size():
-                chapter_index = 0
-            self.chapter_listbox.selection_clear(0, tk.END)
-            self.chapter_listbox.selection_set(chapter_index)
-            self.display_chapter_content(None)
-            if self.last_scroll_fraction is not None:
-                self.chapter_text.yview_moveto(self.last_scroll_fraction)
-        else:
-            # 否则默认显示第一章
-            if self.chapter_listbox.size() > 0:
+        def show_first():
+            if not state["shown"] and self.chapter_listbox.size() > 0:
+                state["shown"] = True
                 self.chapter_listbox.selection_clear(0, tk.END)
                 self.chapter_listbox.selection_set(0)
                 self.display_chapter_content(None)
 
-    def split_into_chapters(self, text):
-        pattern = r'(第[\d一二三四五六七八九十百千]+章)'
-        parts = re.split(pattern, text)
-        if not parts or len(parts) < 2:
-            return {"全文": text}
-        chapters = {}
-        current_title = None
-        current_content = []
-        for item in parts:
-            item = item.strip()
-            if not item:
-                continue
-            if re.match(pattern, item):
-                if current_title is not None and current_content:
-                    chapters[current_title] = "\n".join(current_content)
-                current_title = item
-                current_content = []
+        def on_progress(scanned, total, titles):
+            if token is not self.load_token:
+                return
+            if titles:
+                self.chapter_listbox.insert(tk.END, *titles)
+            self.file_label.config(text=f"正在加载 {name}：{scanned / 1048576:.1f}/{total / 1048576:.1f} MB，"
+                                        f"已找到 {self.chapter_listbox.size()} 章")
+            if on_done is None:
+                show_first()
+
+        def on_finish(error):
+            if token is not self.load_token:
+                return  # 已被新的加载取代
+            self.load_token = None
+            if error is not None:
+                messagebox.showerror("错误", f"无法读取文件: {str(error)}")
+                return
+            # 标题表已完整，按标题核对修订所属的章节
+            self.journal.bind(chapters.titles)
+            self.update_file_label()
+            if chapters.throughput is not None:
+                self.show_toast(f"已加载 {len(chapters)} 章，扫描速度 {chapters.throughput:.0f} MB/s")
+            self.start_search_index()
+            if on_done is not None:
+                on_done()
             else:
-                current_content.append(item)
-        if current_title is not None and current_content:
-            chapters[current_title] = "\n".join(current_content)
-        return chapters
+                show_first()
+
+        def task():
+            try:
+                if chapters.build(on_progress=lambda *args: self.root.after(0, lambda: on_progress(*args)),
+                                  cancel=token):
+                    self.root.after(0, lambda: on_finish(None))
+            except Exception as e:
+                self.root.after(0, lambda e=e: on_finish(e))
+        threading.Thread(target=task, daemon=True).start()
+
+    def is_loading(self, warn=True):
+        """文件仍在后台加载时返回 True（并提示用户稍候）"""
+        if self.load_token is None:
+            return False
+        if warn:
+            messagebox.showwarning("提示", "文件仍在加载中，请稍候。")
+        return True
+
+    def set_chapters(self, chapters):
+        """替换当前章节索引并刷新章节列表"""
+        if self.chapters is not None:
+            self.chapters.close()  # 若旧索引仍在扫描，会在扫描中止后释放
+        if self.search_token is not None:
+            self.search_token.cancel()
+            self.search_token = None
+        self.search_index = None
+        self.summarizing = set()
+        self.chapters = chapters
+        self.journal = EditJournal(EditJournal.path_for(chapters.file_path))
+        self.chapter_listbox.delete(0, tk.END)
+        if chapters.titles:
+            self.chapter_listbox.insert(tk.END, *chapters.titles)
+
+    def start_search_index(self):
+        """在后台为当前文件建立全文搜索索引（建立期间也可搜索，未建索引的章节直接查看正文）"""
+        chapters, journal = self.chapters, self.journal
+        index = SearchIndex(len(chapters), lambda i: journal.apply(i, chapters.chapter_text(i)))
+        token = CancelToken()
+        self.search_index, self.search_token = index, token
 
-    def display_chapter_content(self, event):
+        def task():
+            try:
+                index.build(cancel=token)
+            except Exception:
+                return  # 文件被重新加载或关闭时中止
+            # 建索引读遍了全书，对不上的修订此时都已发现，在状态栏提示一次
+            self.root.after(0, lambda: self.journal is journal and self.update_file_label())
+        threading.Thread(target=task, daemon=True).start()
+
+    def search_book(self):
+        """在全书（含修订）中搜索，结果列在窗口中，点击跳转到对应章节与位置"""
+        query = self.search_var.get().strip()
+        if not query:
+            return
+        if self.is_loading():
+            return
+        if self.search_index is None:
+            messagebox.showwarning("提示", "请先加载小说文件。")
+            return
+        index, chapters = self.search_index, self.chapters
+        started = time.perf_counter()
+
+        def task():
+            try:
+                hits = index.search(query)
+                rows = []
+                text, text_index = "", None
+                for i, pos in hits:
+                    if i != text_index:
+                        text, text_index = index.text_of(i), i
+                    snippet = text[max(pos - 15, 0):pos + len(query) + 15].replace("\n", " ")
+                    rows.append((i, pos, f"{chapters.titles[i]}：{snippet}"))
+                result = (rows, len(hits) >= SEARCH_MAX_HITS, time.perf_counter() - started)
+            except Exception as e:
+                result = e
+            self.root.after(0, lambda: self.show_search_results(query, result))
+        threading.Thread(target=task, daemon=True).start()
+
+    def show_search_results(self, query, result):
+        if isinstance(result, Exception):
+            messagebox.showerror("错误", f"搜索失败：{str(result)}")
+            return
+        rows, truncated, seconds = result
+        if not rows:
+            self.show_toast(f"没有找到“{query}”")
+            return
+        if self.search_win is not None and tk.Toplevel.winfo_exists(self.search_win):
+            self.search_win.destroy()
+        win = tk.Toplevel(self.root)
+        self.search_win = win
+        more = f"，只显示前 {len(rows)} 处" if truncated else ""
+        win.title(f"搜索“{query}”：{len(rows)} 处{more}（{seconds * 1000:.0f} ms）")
+        frame = tk.Frame(win)
+        frame.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        scrollbar = tk.Scrollbar(frame, orient=tk.VERTICAL)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        listbox = tk.Listbox(frame, width=60, height=20, yscrollcommand=scrollbar.set)
+        listbox.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.config(command=listbox.yview)
+        listbox.insert(tk.END, *[label for _, _, label in rows])
+
+        def on_select(event):
+            sel = listbox.curselection()
+            if sel:
+                chapter_index, offset, _ = rows[sel[0]]
+                self.jump_to_text(chapter_index, offset, len(query))
+        listbox.bind('<<ListboxSelect>>', on_select)
+        win.transient(self.root)
+
+    def jump_to_text(self, chapter_index, offset, length):
+        """显示第 chapter_index 章，滚动到章内偏移 offset 处并选中其后 length 个字"""
+        if self.chapters is None or not 0 <= chapter_index < len(self.chapters):
+            return
+        self.chapter_listbox.selection_clear(0, tk.END)
+        self.chapter_listbox.selection_set(chapter_index)
+        self.chapter_listbox.see(chapter_index)
+        self.display_chapter_content(None, focus_offset=offset)
+        start, end = self.index_from_offset(offset), self.index_from_offset(offset + length)
+        self.chapter_text.tag_add("search_hit", start, end)
+        self.chapter_text.tag_remove(tk.SEL, "1.0", tk.END)
+        self.chapter_text.tag_add(tk.SEL, start, end)
+        self.chapter_text.see(start)
+
+    def get_chapter_content(self, index):
+        """第 index 章的当前内容（原文件内容加上修订日志中的补丁）"""
+        if self.chapters is None or not 0 <= index < len(self.chapters):
+            return ""
+        return self.journal.apply(index, self.chapters.chapter_text(index))
+
+    def display_chapter_content(self, event, focus_offset=0):
         sel = self.chapter_listbox.curselection()
         if not sel:
             return
-        selected_title = self.chapter_listbox.get(sel)
-        content = self.chapters.get(selected_title, "")
-        # 自动添加缩进（保存时会去除）
-        lines = content.splitlines()
-        indented = ["　　" + ln for ln in lines]
-        content_with_indent = "\n".join(indented)
+        try:
+            content = self.get_chapter_content(sel[0])
+        except UnicodeDecodeError as e:
+            messagebox.showerror("错误", f"章节解码失败: {str(e)}")
+            return
+        self.displayed_chapter = sel[0]
+        self.render_chapter_text(content, focus_offset)
+        if self.journal.skipped and self.load_token is None:
+            self.update_file_label()  # 显示本章时可能发现对不上的修订
+        self.prepare_summaries(sel[0])
+
+    def prepare_summaries(self, index):
+        """勾选了“前情提要”时，在后台为第 index 章及其前几章生成还没有的摘要（改写时只读取已有的摘要）"""
+        if not self.use_summaries.get() or self.summaries is None or self.chapters is None or index is None:
+            return
+        if self.is_loading(warn=False):
+            return
+        indices = [i for i in range(max(0, index - SUMMARY_PREVIOUS_CHAPTERS), index + 1)
+                   if i not in self.summarizing]
+        if not indices:
+            return
+        if not self.model_configs.get(self.current_model_name, {}).get("api_key"):
+            return
+        self.summarizing.update(indices)
+        model_name = self.current_model_name
+        chapters, journal = self.chapters, self.journal
+        chapters_text = lambda i: journal.apply(i, chapters.chapter_text(i))
+
+        def finished(failed):
+            if self.chapters is not chapters:
+                return  # 期间换了文件
+            self.summarizing.difference_update(indices)
+            if failed:
+                self.show_toast(f"有 {failed} 章的摘要生成失败，改写时不含这些章节")
+
+        def task():
+            try:
+                failed = self.engine.summarize_chapters(model_name, chapters_text, indices)
+            except Exception:
+                failed = len(indices)  # 文件被重新加载或关闭
+            self.root.after(0, lambda: finished(failed))
+        threading.Thread(target=task, daemon=True).start()
+
+    def summary_prefix(self, chapter_index):
+        """第 chapter_index 章的前情提要（只用已生成的摘要），未勾选“前情提要”时为空字符串"""
+        if not self.use_summaries.get() or self.summaries is None:
+            return ""
+        return self.engine.context_prefix(self.current_model_name, self.chapters.titles, self.get_chapter_content,
+                                          chapter_index)
+
+    def render_chapter_text(self, content, focus_offset=0):
+        """
+        把章节正文原样插入文本框（段首缩进由 para 标签负责）。
+        超长章节先同步插入 focus_offset 附近的一段（不论定位点多靠后，首次插入的字数都有上限），
+        其余部分在空闲时分批补齐：先追加后文，再把前文逐块插到开头。
+        """
+        if self.render_job is not None:
+            self.root.after_cancel(self.render_job)
+            self.render_job = None
         # 允许取回文本前先临时设置为 normal
         self.chapter_text.config(state=tk.NORMAL)
         self.chapter_text.delete(1.0, tk.END)
-        self.chapter_text.insert(tk.END, content_with_indent)
+        first = max(0, focus_offset - RENDER_FIRST_CHARS // 2)
+        if first:
+            # 从段首开始显示，找不到较近的段首时直接从 first 开始
+            first = content.rfind("\n", max(0, first - RENDER_FIRST_CHARS), first) + 1 or first
+        last = focus_offset + RENDER_FIRST_CHARS
+        self.render_base = first
+        self.chapter_text.insert(tk.END, content[first:last], "para")
+        if first or last < len(content):
+            self.render_job = self.root.after(1, self._render_rest, content, last)
         # 显示后禁止编辑（但允许光标移动和选中）
         self.chapter_text.config(state=tk.DISABLED)
 
+    def _render_rest(self, content, pos):
+        text = self.chapter_text
+        text.config(state=tk.NORMAL)
+        if pos < len(content):
+            pos += RENDER_CHUNK_CHARS
+            text.insert(tk.END, content[pos - RENDER_CHUNK_CHARS:pos], "para")
+        else:
+            # 插到开头会把正在看的内容往下推，借助标记保持可见位置不变
+            start = max(0, self.render_base - RENDER_CHUNK_CHARS)
+            text.mark_set("render_top", "@0,0")
+            text.insert("1.0", content[start:self.render_base], "para")
+            text.yview("render_top")
+            self.render_base = start
+        text.config(state=tk.DISABLED)
+        if pos < len(content) or self.render_base:
+            self.render_job = self.root.after(1, self._render_rest, content, pos)
+        else:
+            self.render_job = None
+
     # --------------- 修改方向管理（列表模式） ---------------
     def set_modification_direction(self):
         """弹出管理修改方向列表的窗口，支持新建、编辑、删除条目，并可存储到本地"""
@@ -252,25 +554,11 @@ class NovelReader:
 
     def load_modification_directions_list(self):
         """从 '修改方向.json' 中加载修改方向列表（每一项为一条文本）"""
-        file_path = os.path.join(os.path.dirname(sys.argv[0]), "修改方向.json")
-        if os.path.exists(file_path):
-            try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    self.modification_directions = json.load(f)
-            except Exception as e:
-                print("读取修改方向配置出错：", e)
-                self.modification_directions = []
-        else:
-            self.modification_directions = []
+        self.modification_directions = read_directions(os.path.join(os.path.dirname(sys.argv[0]), DIRECTIONS_FILE))
 
     def save_modification_directions_list(self):
         """将修改方向列表保存到 '修改方向.json' 文件中"""
-        file_path = os.path.join(os.path.dirname(sys.argv[0]), "修改方向.json")
-        try:
-            with open(file_path, "w", encoding="utf-8") as f:
-                json.dump(self.modification_directions, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            print("保存修改方向配置出错：", e)
+        write_directions(os.path.join(os.path.dirname(sys.argv[0]), DIRECTIONS_FILE), self.modification_directions)
 
     # 旧版的修改方向加载/保存（兼容）
     def load_modification_direction(self):
@@ -292,19 +580,15 @@ class NovelReader:
 
     # --------------- 编辑本章功能（直接编辑当前章节） ---------------
     def edit_current_chapter(self):
-        # 获取当前显示的文本内容和滚动位置
-        current_text = self.chapter_text.get("1.0", tk.END)
-        current_scroll = self.chapter_text.yview()[0]
-        # 去除每行前的缩进（即移除“　　”）
-        def remove_indent(text):
-            lines = text.splitlines()
-            return "\n".join([ln[2:] if ln.startswith("　　") else ln for ln in lines])
-        clean_text = remove_indent(current_text).rstrip("\n")
-        # 获取当前章节索引
+        if self.is_loading():
+            return
+        # 获取当前章节索引、正文内容和滚动位置（显示的就是原始正文，无需去除缩进）
         try:
             chapter_index = self.chapter_listbox.curselection()[0]
         except IndexError:
             chapter_index = 0
+        clean_text = self.get_chapter_content(chapter_index)
+        current_offset = self.top_offset()
 
         # 弹出全屏编辑对话框
         dialog = tk.Toplevel(self.root)
@@ -314,34 +598,41 @@ class NovelReader:
         text_widget.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
         text_widget.insert("1.0", clean_text)
         text_widget.update_idletasks()
-        text_widget.yview_moveto(current_scroll)
+        text_widget.yview(f"1.0 + {current_offset} chars")
         btn_frame = tk.Frame(dialog)
         btn_frame.pack(pady=5)
         def on_cancel():
             dialog.destroy()
         def on_save():
-            edited = text_widget.get("1.0", tk.END)
-            # 更新当前章节内容
-            chapter_title = self.chapter_listbox.get(chapter_index)
-            self.chapters[chapter_title] = edited.rstrip("\n")
-            # 重构全文内容并直接写回当前文件
-            full_text = ""
-            for title in self.chapter_listbox.get(0, tk.END):
-                content = self.chapters.get(title, "")
-                full_text += title + "\n" + content + "\n\n"
+            if self.chapters is None or not self.current_file_path:
+                messagebox.showwarning("提示", "未记录小说文件名，请先加载小说文件。")
+                return
+            edited = text_widget.get("1.0", tk.END).rstrip("\n")
+            if edited == clean_text.rstrip("\n"):
+                dialog.destroy()  # 没有改动，不必重写文件
+                return
+            # 只替换本章正文写回当前文件（按原编码、BOM 与换行风格，其余字节原样保留，修订仍留在日志中），
+            # 章节索引原地平移偏移，无需重新读取和拆分整本书
             try:
-                with open(self.current_file_path, 'w', encoding='utf-8') as f:
-                    f.write(full_text)
+                self.chapters.replace_chapter(chapter_index, edited)
             except Exception as e:
                 messagebox.showerror("错误", f"保存文件失败：{str(e)}")
                 return
-            # 刷新界面，保持当前章节和滚动位置
-            self.reload_current_file()
+            # 本章的修订已包含在编辑后的内容中
+            try:
+                self.journal.drop_chapter(chapter_index)
+            except Exception as e:
+                messagebox.showerror("错误", f"更新修订日志失败：{str(e)}")
+            if self.search_index is not None:
+                self.search_index.update(chapter_index)
+            # 只重绘本章：标题表未变，章节列表保持原样，仅恢复选中行和滚动位置
+            dialog.destroy()
             self.chapter_listbox.selection_clear(0, tk.END)
             self.chapter_listbox.selection_set(chapter_index)
-            self.display_chapter_content(None)
-            self.chapter_text.yview_moveto(current_scroll)
-            dialog.destroy()
+            self.chapter_listbox.see(chapter_index)
+            self.display_chapter_content(None, focus_offset=current_offset)
+            self.scroll_to_offset(current_offset)
+            self.update_file_label()
         tk.Button(btn_frame, text="取消", command=on_cancel).pack(side=tk.LEFT, padx=5)
         tk.Button(btn_frame, text="存储至当前文件", command=on_save).pack(side=tk.LEFT, padx=5)
         dialog.transient(self.root)
@@ -350,19 +641,21 @@ class NovelReader:
 
     # --------------- 修改调用大模型部分 ---------------
     def modify_selected_text(self):
-        # 为了保证能修改文本，先临时设置状态为 normal
-        self.chapter_text.config(state=tk.NORMAL)
-        entire_text = self.chapter_text.get("1.0", tk.END).strip()
-        try:
-            selected_text = self.chapter_text.get(tk.SEL_FIRST, tk.SEL_LAST)
-        except tk.TclError:
-            selected_text = ""
-        if not entire_text:
+        if self.chapter_text.compare("end-1c", "==", "1.0"):
             messagebox.showwarning("提示", "右侧文本框没有内容。")
             return
-        if not selected_text.strip():
+        # 记录选区所在章节与章内偏移，保存时直接按偏移替换
+        selection = self.selection_offsets()
+        if selection is None:
             messagebox.showwarning("提示", "请先在右侧文本框中选中要修改的内容。")
             return
+        chapter_index, start, end = selection
+        selected_text = self.get_chapter_content(chapter_index)[start:end]
+        if not selected_text.strip():
+            messagebox.showwarning("提示", "无法识别要替换的原文内容（可能只选了缩进空格）。")
+            return
+        # 同时记下当时的修订号，之后同章其他修订造成的偏移变化可据此换算
+        selection = (chapter_index, start, end, len(self.journal))
 
         # 使用修改方向列表进行选择
         if not self.modification_directions:
@@ -383,44 +676,217 @@ class NovelReader:
         dir_box = tk.Text(direction_dialog, width=80, height=20, font=("思源黑体", 12))
         dir_box.pack(padx=10, pady=5)
         dir_box.insert("1.0", selected_direction.get())
+        # 请求方式：单一模型 / 对冲（当前模型迟迟不出字时补发给其他模型，取先完成者）/ 多个模型并排对比
+        mode_frame = tk.Frame(direction_dialog)
+        mode_frame.pack(padx=10, pady=5, fill=tk.X)
+        tk.Label(mode_frame, text="请求方式：").pack(side=tk.LEFT)
+        mode_var = tk.StringVar(value="single")
+        for value, label in (("single", f"仅【{self.current_model_name}】"),
+                             ("hedge", "对冲（首字超时改用其他模型）"),
+                             ("fanout", "所有模型并排对比")):
+            tk.Radiobutton(mode_frame, text=label, variable=mode_var, value=value).pack(side=tk.LEFT, padx=5)
         def on_next():
             local_mod_dir = dir_box.get("1.0", tk.END).strip()
+            mode = mode_var.get()
+            # 其他已设置 API Key 的模型配置，按配置顺序作为备用
+            others = [name for name, cfg in self.model_configs.items()
+                      if name != self.current_model_name and cfg.get("api_key")]
+            if mode != "single" and not others:
+                messagebox.showwarning("提示", "没有其他已设置 API Key 的模型配置。", parent=direction_dialog)
+                return
             direction_dialog.destroy()
-            prompt = (
-                f"请对我选中的这部分文本进行改写或润色：\n\n"
-                f"【修改方向】{local_mod_dir}\n\n"
-                f"【待修改文本】\n{selected_text}\n"
-            )
-            # 创建一个锁定交互的遮罩（仅用于锁定交互，无视觉效果）
-            overlay = self.create_overlay()
-            def on_complete(result):
-                overlay.destroy()  # 解除锁定
-                if result is None:
-                    return
-                self.show_compare_dialog(original_text=selected_text, modified_text=result)
-            self.call_api_in_thread(prompt, on_complete)
+            prefix = self.summary_prefix(chapter_index)
+            if mode == "fanout":
+                self.show_fanout_dialog(selected_text, local_mod_dir, selection, [self.current_model_name] + others,
+                                        prefix=prefix)
+                return
+            models = [self.current_model_name] + others if mode == "hedge" else None
+            # 立即打开对比窗口，改写结果边生成边显示（超出 token 预算的选区自动分段依次请求）
+            self.show_compare_dialog(original_text=selected_text, direction=local_mod_dir, selection=selection,
+                                     models=models, prefix=prefix)
         tk.Button(direction_dialog, text="下一步", command=on_next).pack(pady=5)
         direction_dialog.transient(self.root)
         direction_dialog.grab_set()
         direction_dialog.wait_window()
 
-    def create_overlay(self):
-        """创建一个透明的遮罩层覆盖主窗口，仅锁定交互，不显示视觉遮罩"""
-        overlay = tk.Toplevel(self.root)
-        overlay.overrideredirect(True)
-        self.root.update_idletasks()
-        x = self.root.winfo_rootx()
-        y = self.root.winfo_rooty()
-        w = self.root.winfo_width()
-        h = self.root.winfo_height()
-        overlay.geometry(f"{w}x{h}+{x}+{y}")
-        # 设置透明度为0（完全透明），但仍可调用 grab_set 锁定交互
-        overlay.attributes("-alpha", 0.0)
-        overlay.lift()
-        overlay.grab_set()
-        return overlay
-
-    def show_compare_dialog(self, original_text, modified_text):
+    # --------------- 批量改写（章节范围 / 全书） ---------------
+    def check_unfinished_jobs(self):
+        """启动时提示继续上次未完成的批量改写任务"""
+        if self.jobs is None:
+            return
+        rows = [row for row in self.jobs.unfinished("book") if os.path.exists(row["book"])]
+        if not rows:
+            return
+        row = rows[0]
+        if not messagebox.askyesno("继续任务", f"上次的批量改写没有完成：\n{row['book']}\n"
+                                            f"第 {row['first'] + 1}～{row['last'] + 1} 章，模型【{row['model']}】，"
+                                            f"已完成 {row['done']} 个片段。\n\n"
+                                            f"是否打开该文件并继续？（已完成的片段不会重新请求）"):
+            return
+        self.start_loading(row["book"], on_done=lambda: self.batch_modify(resume=row))
+
+    def batch_modify(self, resume=None):
+        """
+        选择章节范围、修改方向与并发数，在后台批量改写并另存为新文件。
+        resume 为 JobStore.unfinished() 中的一项时按其参数立即继续该任务。
+        """
+        if self.is_loading():
+            return
+        if self.chapters is None or not self.current_file_path:
+            messagebox.showwarning("提示", "未记录小说文件名，请先加载小说文件。")
+            return
+        if not self.modification_directions:
+            messagebox.showwarning("提示", "当前没有任何修改方向，请先设置修改方向。")
+            self.set_modification_direction()
+            if not self.modification_directions:
+                return
+        model_name = resume["model"] if resume is not None else self.current_model_name
+        config = dict(self.model_configs.get(model_name, {}))
+        if not config.get("api_key"):
+            messagebox.showwarning("提示", f"请先在【配置模型】中设置【{model_name}】的 API Key。")
+            return
+        chapter_count = len(self.chapters)
+        try:
+            current = self.chapter_listbox.curselection()[0]
+        except IndexError:
+            current = 0
+        if resume is not None and resume["last"] >= chapter_count:
+            messagebox.showwarning("提示", "文件的章节数已变化，无法继续该任务。")
+            return
+
+        win = tk.Toplevel(self.root)
+        win.title("批量改写")
+        range_frame = tk.Frame(win)
+        range_frame.pack(padx=10, pady=5, fill=tk.X)
+        tk.Label(range_frame, text=f"章节范围（共 {chapter_count} 章）：从").pack(side=tk.LEFT)
+        first_var = tk.IntVar(value=resume["first"] + 1 if resume is not None else current + 1)
+        last_var = tk.IntVar(value=resume["last"] + 1 if resume is not None else chapter_count)
+        tk.Spinbox(range_frame, from_=1, to=chapter_count, width=6, textvariable=first_var).pack(side=tk.LEFT)
+        tk.Label(range_frame, text="到").pack(side=tk.LEFT)
+        tk.Spinbox(range_frame, from_=1, to=chapter_count, width=6, textvariable=last_var).pack(side=tk.LEFT)
+        tk.Button(range_frame, text="全书",
+                  command=lambda: (first_var.set(1), last_var.set(chapter_count))).pack(side=tk.LEFT, padx=5)
+        tk.Label(range_frame, text="并发数：").pack(side=tk.LEFT, padx=(10, 0))
+        concurrency_var = tk.IntVar(value=config.get("batch_concurrency", DEFAULT_BATCH_CONCURRENCY))
+        # 异步请求不占线程，并发只受接口限流约束
+        max_batch = 1000 if use_async_http(config) else 64
+        tk.Spinbox(range_frame, from_=1, to=max_batch, width=5, textvariable=concurrency_var).pack(side=tk.LEFT)
+        summarize_var = tk.BooleanVar(value=self.use_summaries.get() and self.summaries is not None)
+        tk.Checkbutton(range_frame, text="前情提要", variable=summarize_var,
+                       state=tk.NORMAL if self.summaries is not None else tk.DISABLED).pack(side=tk.LEFT, padx=5)
+
+        dir_frame = tk.Frame(win)
+        dir_frame.pack(padx=10, pady=5, fill=tk.X)
+        tk.Label(dir_frame, text="修改方向：").pack(side=tk.LEFT)
+        selected_direction = tk.StringVar(value=self.modification_directions[0])
+        tk.OptionMenu(dir_frame, selected_direction, *self.modification_directions,
+                      command=lambda v: dir_box.delete("1.0", tk.END) or dir_box.insert("1.0", v)).pack(side=tk.LEFT, padx=5)
+        dir_box = tk.Text(win, width=80, height=10, font=("思源黑体", 12))
+        dir_box.pack(padx=10, pady=5)
+        dir_box.insert("1.0", resume["direction"] if resume is not None else selected_direction.get())
+
+        progress = ttk.Progressbar(win, length=500, mode="determinate")
+        progress.pack(padx=10, pady=5)
+        status_label = tk.Label(win, text="")
+        status_label.pack(pady=5)
+        btn_frame = tk.Frame(win)
+        btn_frame.pack(pady=5)
+        cancel_event = threading.Event()
+        state = {"running": False}
+
+        def on_progress(done, total, failed, started):
+            elapsed = max(time.time() - started, 1e-6)
+            progress.config(maximum=total, value=done)
+            status_label.config(text=f"已完成 {done}/{total} 章   失败片段 {failed}   "
+                                     f"{done / elapsed * 60:.1f} 章/分钟")
+
+        def on_summary(done, total):
+            progress.config(maximum=max(total, 1), value=done)
+            status_label.config(text=f"正在生成章节摘要 {done}/{total}")
+
+        def on_finish(result, out_path, error):
+            state["running"] = False
+            if not tk.Toplevel.winfo_exists(win):
+                return
+            win.destroy()
+            if error is not None:
+                messagebox.showerror("错误", f"批量改写失败：{str(error)}")
+                return
+            if result is None:
+                messagebox.showinfo("提示", "批量改写已取消。")
+                return
+            done, failed = result
+            messagebox.showinfo("提示", f"批量改写完成：{done} 章，失败片段 {failed} 个（保留原文）。\n"
+                                      f"已保存到文件：\n{out_path}")
+            self.current_file_path = out_path
+            self.reload_current_file()
+
+        def on_start():
+            try:
+                first = first_var.get() - 1
+                last = last_var.get() - 1
+                concurrency = concurrency_var.get()
+            except tk.TclError:
+                messagebox.showwarning("提示", "章节范围和并发数必须是数字。", parent=win)
+                return
+            if not 0 <= first <= last < chapter_count or concurrency < 1:
+                messagebox.showwarning("提示", "章节范围或并发数无效。", parent=win)
+                return
+            direction = dir_box.get("1.0", tk.END).strip()
+            use_cache = self.use_cache.get()
+            summarize = summarize_var.get()
+            file_path = self.current_file_path
+            journal_path = self.journal.path
+            out_path = os.path.join(os.path.dirname(file_path), self.generate_new_filename())
+            # 参数相同的未完成任务直接继续（沿用其输出文件名），已完成的片段不会重新请求
+            job = None
+            if self.jobs is not None:
+                job = self.jobs.open("book", file_path, direction, model_name, first, last, out_path=out_path)
+                if job.resumed:
+                    out_path = job.out_path or out_path
+                    status_label.config(text=f"继续未完成的任务，已完成 {job.done_count()} 个片段")
+            start_button.config(state=tk.DISABLED)
+            state["running"] = True
+            started = time.time()
+
+            def task():
+                try:
+                    result = self.engine.rewrite_book(
+                        file_path, out_path, direction, model_name,
+                        first=first, last=last, concurrency=concurrency,
+                        on_progress=lambda d, t, f: self.root.after(0, lambda: on_progress(d, t, f, started)),
+                        cancel_event=cancel_event, journal=EditJournal(journal_path), use_cache=use_cache,
+                        job=job, summarize=summarize,
+                        on_summary=lambda d, t: self.root.after(0, lambda: on_summary(d, t)))
+                    self.root.after(0, lambda: on_finish(result, out_path, None))
+                except Exception as e:
+                    self.root.after(0, lambda e=e: on_finish(None, out_path, e))
+            threading.Thread(target=task, daemon=True).start()
+
+        def on_cancel():
+            if state["running"]:
+                cancel_event.set()
+                status_label.config(text="正在取消，等待进行中的请求结束……")
+            else:
+                win.destroy()
+
+        start_button = tk.Button(btn_frame, text="开始", command=on_start)
+        start_button.pack(side=tk.LEFT, padx=5)
+        tk.Button(btn_frame, text="取消", command=on_cancel).pack(side=tk.LEFT, padx=5)
+        win.protocol("WM_DELETE_WINDOW", on_cancel)
+        win.transient(self.root)
+        if resume is not None:
+            on_start()
+
+    def show_compare_dialog(self, original_text, modified_text="", direction=None, selection=None, models=None,
+                            prefix=""):
+        """
+        对比显示原文与修改结果，selection 为原文所在的 (章节序号, 起始偏移, 结束偏移, 修订号)。
+        传入 direction 时窗口立即打开并在后台按该方向改写原文，生成的文本实时追加到右侧，
+        可随时停止并保留已生成的部分；关闭窗口则取消请求。
+        结果完整后在后台逐字比较两栏，标出删除、新增与替换的文字，两栏按对应位置同步滚动。
+        models 为对冲请求依次使用的模型配置名称（None 表示只用当前模型），prefix 为前情提要。
+        """
         compare_win = tk.Toplevel(self.root)
         compare_win.title("对比显示（选中内容）")
         try:
@@ -435,180 +901,437 @@ class NovelReader:
         compare_paned.add(right_frame, stretch="always")
         scroll_left = tk.Scrollbar(left_frame, orient=tk.VERTICAL)
         scroll_left.pack(side=tk.RIGHT, fill=tk.Y)
-        text_orig = tk.Text(left_frame, wrap=tk.WORD, font=("思源黑体", 12),
-                             yscrollcommand=scroll_left.set)
+        text_orig = tk.Text(left_frame, wrap=tk.WORD, font=("思源黑体", 12))
         text_orig.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scroll_left.config(command=text_orig.yview)
         scroll_right = tk.Scrollbar(right_frame, orient=tk.VERTICAL)
         scroll_right.pack(side=tk.RIGHT, fill=tk.Y)
-        text_mod = tk.Text(right_frame, wrap=tk.WORD, font=("思源黑体", 12),
-                            yscrollcommand=scroll_right.set)
+        text_mod = tk.Text(right_frame, wrap=tk.WORD, font=("思源黑体", 12))
         text_mod.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
         scroll_right.config(command=text_mod.yview)
+        text_orig.tag_configure("diff_del", background="#ffd0d0")
+        text_orig.tag_configure("diff_rep", background="#fff0a8")
+        text_mod.tag_configure("diff_ins", background="#c8f0c8")
+        text_mod.tag_configure("diff_rep", background="#fff0a8")
         text_orig.insert(tk.END, original_text)
         text_mod.insert(tk.END, modified_text)
         bottom_frame = tk.Frame(compare_win)
         bottom_frame.pack(side=tk.BOTTOM, fill=tk.X, pady=5)
         orig_len = len(original_text)
-        mod_len = len(modified_text)
-        info_label = tk.Label(bottom_frame, text=f"原文字数: {orig_len}   |   修改后字数: {mod_len}")
+        info_label = tk.Label(bottom_frame, text=f"原文字数: {orig_len}   |   修改后字数: {len(modified_text)}")
         info_label.pack(side=tk.LEFT, padx=10)
+        stream_label = tk.Label(bottom_frame, text="", fg="gray")
+        stream_label.pack(side=tk.LEFT, padx=10)
+        diff_label = tk.Label(bottom_frame, text="", fg="gray")
+        diff_label.pack(side=tk.LEFT, padx=10)
+        state = {"chars": 0, "running": False, "model": None, "ops": None, "diff_seq": 0, "syncing": False}
         def save_and_close():
-            self.save_modified_selection(original_text, text_mod.get("1.0", tk.END))
+            self.save_modified_selection(selection, original_text, text_mod.get("1.0", tk.END),
+                                         model_name=state["model"])
             compare_win.destroy()
         save_button = tk.Button(bottom_frame, text="保存修改结果", command=save_and_close)
         save_button.pack(side=tk.RIGHT, padx=10)
 
-    def generate_new_filename(self):
-        """
-        根据当前加载的原文件名、当前选择的模型名称以及当前时间生成新文件名：
-        - 如果原文件名最前方没有序号，则新文件名为 "1-原文件名称-当前选择模型名称→当前时间.txt"。
-        - 如果原文件名最前方有序号且包含“思考模型”、“全文模型”或“小说模型”中的任意一个，
-          则提取最前方的序号（并加 1）和原文件名称（去掉旧的模型名称和时间部分），
-          生成新文件名为 "新序号-原文件名称-当前选择模型名称→当前时间.txt"。
-        """
-        timestamp = time.strftime("%Y%m%d%H%M%S")
-        base_name = os.path.splitext(os.path.basename(self.current_file_path))[0]
-        pattern_full = r'^(\d+)-(.+)-(思考模型|全文模型|小说模型)→\d{14}$'
-        m = re.match(pattern_full, base_name)
-        if m:
-            old_serial = int(m.group(1))
-            original_name = m.group(2)
-            new_serial = old_serial + 1
-            new_file_name = f"{new_serial}-{original_name}-{self.current_model_name}→{timestamp}.txt"
-        elif re.match(r'^\d+-', base_name) and any(model in base_name for model in ["思考模型", "全文模型", "小说模型"]):
-            parts = base_name.split('-', 1)
-            try:
-                old_serial = int(parts[0])
-            except:
-                old_serial = 0
-            new_serial = old_serial + 1
-            remainder = parts[1]
-            pattern_trailing = r'(.+)-(思考模型|全文模型|小说模型)→\d{14}$'
-            m2 = re.match(pattern_trailing, remainder)
-            if m2:
-                original_name = m2.group(1)
-            else:
-                original_name = remainder
-            new_file_name = f"{new_serial}-{original_name}-{self.current_model_name}→{timestamp}.txt"
-        else:
-            new_file_name = f"1-{base_name}-{self.current_model_name}→{timestamp}.txt"
-        return new_file_name
+        # ---------- 逐字差异 ----------
+        def apply_diff(seq, ops):
+            # 只采用最近一次比较的结果；比较期间窗口可能已关闭
+            if seq != state["diff_seq"] or not compare_win.winfo_exists():
+                return
+            state["ops"] = ops
+            for widget, tags in ((text_orig, ("diff_del", "diff_rep")), (text_mod, ("diff_ins", "diff_rep"))):
+                for tag in tags:
+                    widget.tag_remove(tag, "1.0", tk.END)
+            ranges = {"diff_del": [], "diff_ins": [], "orig_rep": [], "mod_rep": []}
+            for tag, i1, i2, j1, j2 in ops:
+                if tag == "delete":
+                    ranges["diff_del"] += [f"1.0 + {i1} chars", f"1.0 + {i2} chars"]
+                elif tag == "insert":
+                    ranges["diff_ins"] += [f"1.0 + {j1} chars", f"1.0 + {j2} chars"]
+                elif tag == "replace":
+                    ranges["orig_rep"] += [f"1.0 + {i1} chars", f"1.0 + {i2} chars"]
+                    ranges["mod_rep"] += [f"1.0 + {j1} chars", f"1.0 + {j2} chars"]
+            # 每种标记一次性加上所有区间，几千处改动也只需几次 Tk 调用
+            for widget, tag, key in ((text_orig, "diff_del", "diff_del"), (text_mod, "diff_ins", "diff_ins"),
+                                     (text_orig, "diff_rep", "orig_rep"), (text_mod, "diff_rep", "mod_rep")):
+                if ranges[key]:
+                    widget.tag_add(tag, *ranges[key])
+            changes = sum(1 for op in ops if op[0] != "equal")
+            diff_label.config(text=f"改动 {changes} 处（红：删除  绿：新增  黄：替换）")
 
-    def save_modified_selection(self, original_text, modified_text):
-        # 保存大模型修改后的结果：生成新文件，不修改原文件
-        if not self.current_file_path:
-            messagebox.showwarning("提示", "未记录小说文件名，请先加载小说文件。")
+        def refresh_diff():
+            # 在后台线程比较，长文本也不会卡住界面
+            state["diff_seq"] += 1
+            seq = state["diff_seq"]
+            a = text_orig.get("1.0", "end-1c")
+            b = text_mod.get("1.0", "end-1c")
+            diff_label.config(text="比较中……")
+            def task():
+                ops = diff_text(a, b)
+                self.root.after(0, lambda: apply_diff(seq, ops))
+            threading.Thread(target=task, daemon=True).start()
+
+        def make_yscroll(src, dst, scrollbar, reverse):
+            # 一栏滚动时按差异结果把另一栏滚到对应位置
+            def on_yscroll(first, last):
+                scrollbar.set(first, last)
+                if state["ops"] is None or state["syncing"] or not sync_var.get():
+                    return
+                count = src.count("1.0", src.index("@0,0"), "chars")
+                target = map_offset(state["ops"], count[0] if count else 0, reverse)
+                # 对侧滚动后也会回调，短时间内忽略，免得两栏来回拉扯
+                state["syncing"] = True
+                dst.yview(f"1.0 + {target} chars")
+                compare_win.after(50, lambda: state.update(syncing=False))
+            return on_yscroll
+
+        sync_var = tk.BooleanVar(value=True)
+        text_orig.config(yscrollcommand=make_yscroll(text_orig, text_mod, scroll_left, False))
+        text_mod.config(yscrollcommand=make_yscroll(text_mod, text_orig, scroll_right, True))
+        tk.Checkbutton(bottom_frame, text="同步滚动", variable=sync_var).pack(side=tk.RIGHT, padx=10)
+        tk.Button(bottom_frame, text="重新比较", command=refresh_diff).pack(side=tk.RIGHT, padx=10)
+        if direction is None:
+            refresh_diff()
             return
+
+        # ---------- 流式生成 ----------
+        cancel = CancelToken()
+        started = time.monotonic()
+        state["running"] = True
+        text_mod.config(state=tk.DISABLED)
+        save_button.config(state=tk.DISABLED)
+
+        def update_labels(tokens, first_at, end=None):
+            info_label.config(text=f"原文字数: {orig_len}   |   修改后字数: {state['chars']}")
+            if first_at is None:
+                stream_label.config(text=f"等待首个字…… {time.monotonic() - started:.1f}s")
+                return
+            elapsed = max((end or time.monotonic()) - first_at, 1e-6)
+            stream_label.config(text=f"首字延迟: {first_at - started:.2f}s   |   "
+                                     f"速度: {tokens / elapsed:.1f} tok/s")
+
+        def on_text(text, tokens, first_at):
+            if not state["running"] or not compare_win.winfo_exists():
+                return
+            # 仅当用户停留在底部时自动滚动，方便边生成边阅读前文
+            follow = text_mod.yview()[1] >= 0.999
+            text_mod.config(state=tk.NORMAL)
+            text_mod.insert(tk.END, text)
+            text_mod.config(state=tk.DISABLED)
+            if follow:
+                text_mod.see(tk.END)
+            state["chars"] += len(text)
+            update_labels(tokens, first_at)
+
+        def tick():
+            # 首个字到达前每 0.2 秒刷新一次等待时间
+            if state["running"] and compare_win.winfo_exists() and state["chars"] == 0:
+                update_labels(0, None)
+                compare_win.after(200, tick)
+
+        def finish(status):
+            state["running"] = False
+            if compare_win.winfo_exists():
+                text_mod.config(state=tk.NORMAL)
+                save_button.config(state=tk.NORMAL)
+                stop_button.config(state=tk.DISABLED)
+                stream_label.config(text=stream_label.cget("text") + f"   |   {status}")
+                refresh_diff()
+
+        def on_complete(result, tokens, first_at, model_name=None):
+            if not state["running"] or not compare_win.winfo_exists():
+                return
+            state["model"] = model_name
+            if result is None:
+                finish("已停止" if cancel.is_set() else "请求失败，已保留生成的部分")
+                return
+            current = text_mod.get("1.0", "end-1c")
+            if current != result:
+                # 缓存命中或非流式模式：一次性填入完整结果
+                text_mod.config(state=tk.NORMAL)
+                text_mod.delete("1.0", tk.END)
+                text_mod.insert(tk.END, result)
+                state["chars"] = len(result)
+            update_labels(tokens, first_at if first_at is not None else time.monotonic(), time.monotonic())
+            if models is not None:
+                finish(f"由【{model_name}】完成，用时 {time.monotonic() - started:.1f}s")
+            else:
+                finish(f"完成，用时 {time.monotonic() - started:.1f}s")
+
+        def stop_keep():
+            cancel.cancel()
+            finish("已停止，保留已生成的部分")
+
+        def on_close():
+            cancel.cancel()
+            state["running"] = False
+            compare_win.destroy()
+
+        stop_button = tk.Button(bottom_frame, text="停止生成（保留已生成部分）", command=stop_keep)
+        stop_button.pack(side=tk.RIGHT, padx=10)
+        tk.Button(bottom_frame, text="放弃", command=on_close).pack(side=tk.RIGHT, padx=10)
+        compare_win.protocol("WM_DELETE_WINDOW", on_close)
+        tick()
+        self.call_api_in_thread(original_text, on_complete, on_text=on_text, cancel=cancel, direction=direction,
+                                models=models, prefix=prefix)
+
+    def show_fanout_dialog(self, original_text, direction, selection, model_names, prefix=""):
+        """把同一选区同时交给多个模型配置改写，原文与各模型的结果并排显示，可任选一个保存"""
+        win = tk.Toplevel(self.root)
+        win.title("多模型对比（选中内容）")
         try:
-            with open(self.current_file_path, 'r', encoding='utf-8') as f:
-                file_text = f.read()
-        except Exception as e:
-            messagebox.showerror("错误", f"读取文件失败：{str(e)}")
-            return
+            win.state("zoomed")
+        except:
+            win.geometry("1600x800")
+        paned = tk.PanedWindow(win, orient=tk.HORIZONTAL)
+        paned.pack(fill=tk.BOTH, expand=True)
+        cancel = CancelToken()
+        started = time.monotonic()
+        panes = {}
 
-        def remove_leading_spaces(text):
-            lines = text.splitlines(True)
-            new_lines = []
-            for ln in lines:
-                new_lines.append(ln[2:] if ln.startswith("　　") else ln)
-            return "".join(new_lines)
+        def add_pane(title):
+            frame = tk.Frame(win)
+            paned.add(frame, stretch="always")
+            label = tk.Label(frame, text=title, anchor="w")
+            label.pack(side=tk.TOP, fill=tk.X)
+            bottom = tk.Frame(frame)
+            bottom.pack(side=tk.BOTTOM, fill=tk.X)
+            scroll = tk.Scrollbar(frame, orient=tk.VERTICAL)
+            scroll.pack(side=tk.RIGHT, fill=tk.Y)
+            text = tk.Text(frame, wrap=tk.WORD, font=("思源黑体", 12), yscrollcommand=scroll.set)
+            text.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+            scroll.config(command=text.yview)
+            return label, text, bottom
 
-        clean_original = remove_leading_spaces(original_text).strip('\r\n')
-        clean_modified = remove_leading_spaces(modified_text).rstrip('\r\n')
+        _, text_orig, _ = add_pane(f"原文（{len(original_text)} 字）")
+        text_orig.insert(tk.END, original_text)
 
-        if not clean_original:
-            messagebox.showwarning("提示", "无法识别要替换的原文内容（可能只选了缩进空格）。")
+        def adopt(name):
+            cancel.cancel()
+            self.save_modified_selection(selection, original_text, panes[name]["text"].get("1.0", tk.END),
+                                         model_name=name)
+            win.destroy()
+
+        for name in model_names:
+            label, text, bottom = add_pane(f"【{name}】等待首个字……")
+            text.config(state=tk.DISABLED)
+            button = tk.Button(bottom, text="采用此结果", state=tk.DISABLED, command=lambda n=name: adopt(n))
+            button.pack(side=tk.RIGHT, padx=5, pady=5)
+            panes[name] = {"label": label, "text": text, "button": button, "chars": 0, "first_at": None}
+
+        def on_text(name, piece):
+            if not win.winfo_exists():
+                return
+            pane = panes[name]
+            if pane["first_at"] is None:
+                pane["first_at"] = time.monotonic()
+            pane["text"].config(state=tk.NORMAL)
+            pane["text"].insert(tk.END, piece)
+            pane["text"].config(state=tk.DISABLED)
+            pane["chars"] += len(piece)
+            pane["label"].config(text=f"【{name}】首字 {pane['first_at'] - started:.2f}s   {pane['chars']} 字……")
+
+        def on_done(name, result, error):
+            if not win.winfo_exists():
+                return
+            pane = panes[name]
+            pane["text"].config(state=tk.NORMAL)
+            if error is not None:
+                status = "已停止" if isinstance(error, RequestCancelled) else f"失败：{error}"
+                if pane["chars"]:
+                    # 已生成的部分也可以采用
+                    pane["button"].config(state=tk.NORMAL)
+            else:
+                if pane["text"].get("1.0", "end-1c") != result:
+                    # 缓存命中或非流式模式：一次性填入完整结果
+                    pane["text"].delete("1.0", tk.END)
+                    pane["text"].insert(tk.END, result)
+                pane["button"].config(state=tk.NORMAL)
+                status = f"完成 {len(result)} 字，用时 {time.monotonic() - started:.1f}s"
+            pane["label"].config(text=f"【{name}】{status}")
+
+        # 各模型的增量文本分别合并后再交给界面线程
+        coalescers = {}
+        for name in model_names:
+            coalescers[name] = TokenCoalescer(lambda piece, n=name: self.root.after(0, lambda: on_text(n, piece)))
+
+        def finished(name, result, error):
+            coalescers[name].flush()
+            self.root.after(0, lambda: on_done(name, result, error))
+
+        use_cache = self.use_cache.get()
+        threading.Thread(target=lambda: self.engine.rewrite_fanout(
+            model_names, direction, original_text, on_token=lambda n, piece: coalescers[n](piece),
+            on_done=finished, cancel=cancel, use_cache=use_cache, prefix=prefix), daemon=True).start()
+
+        def on_close():
+            cancel.cancel()
+            win.destroy()
+        bottom_frame = tk.Frame(win)
+        bottom_frame.pack(side=tk.BOTTOM, fill=tk.X, pady=5)
+        tk.Button(bottom_frame, text="全部停止", command=cancel.cancel).pack(side=tk.RIGHT, padx=10)
+        tk.Button(bottom_frame, text="放弃", command=on_close).pack(side=tk.RIGHT, padx=10)
+        win.protocol("WM_DELETE_WINDOW", on_close)
+
+    def generate_new_filename(self):
+        """按当前文件与当前模型生成新文件名，规则见 novel_engine.new_revision_filename"""
+        return new_revision_filename(self.current_file_path, self.current_model_name)
+
+    def save_modified_selection(self, selection, original_text, modified_text, model_name=None):
+        # 保存大模型修改后的结果：按选区偏移生成一条补丁追加到修订日志，不修改原文件
+        if not self.current_file_path or self.journal is None or selection is None:
+            messagebox.showwarning("提示", "未记录小说文件名，请先加载小说文件。")
             return
 
-        replaced_block = f"{clean_modified}"
-        new_file_text = file_text.replace(clean_original, replaced_block, 1)
-        if new_file_text == file_text:
+        clean_modified = modified_text.rstrip('\r\n')
+        chapter_index, start, end, revision = selection
+        # 选中之后同章节若又保存过其他修订，按这些补丁平移偏移
+        mapped = self.journal.map_range(chapter_index, start, end, revision)
+        if mapped is None:
+            messagebox.showwarning("提示", "选中的原文已被其他修订改动，替换失败。")
+            return
+        start, end = mapped
+        if self.get_chapter_content(chapter_index)[start:end] != original_text:
             messagebox.showwarning("提示", "未能在原文件中找到选中的文本，替换失败。")
             return
-
-        # --- 通过选中的原文文字计算当前所在的章节及滚动位置 ---
-        chapter_index, scroll_fraction = self.get_chapter_info_from_text(clean_original)
-        # ------------------------------------------------------------------------
-
-        dir_name = os.path.dirname(self.current_file_path)
-        new_file_name = self.generate_new_filename()
-        new_file_path = os.path.join(dir_name, new_file_name)
         try:
-            with open(new_file_path, 'w', encoding='utf-8') as f:
-                f.write(new_file_text)
-            messagebox.showinfo("提示", f"修改内容已保存到文件：\n{new_file_path}")
+            revision = self.journal.append(chapter_index, self.chapters.titles[chapter_index], start,
+                                           original_text, clean_modified,
+                                           model=model_name or self.current_model_name)
         except Exception as e:
             messagebox.showerror("错误", f"保存修改内容失败：{str(e)}")
             return
 
-        self.current_file_path = new_file_path
-        self.reload_current_file()
+        # 只刷新受影响的章节，无需重新读取文件
+        if self.search_index is not None:
+            self.search_index.update(chapter_index)
         self.chapter_listbox.selection_clear(0, tk.END)
         self.chapter_listbox.selection_set(chapter_index)
-        self.display_chapter_content(None)
-        self.chapter_text.yview_moveto(scroll_fraction)
-        self.file_label.config(text="当前文件: " + os.path.basename(new_file_path))
+        self.display_chapter_content(None, focus_offset=start)
+        self.scroll_to_offset(start)
+        self.update_file_label()
+        self.show_toast(f"修改已保存为第 {revision} 条修订")
 
-    def reload_current_file(self):
+    def update_file_label(self):
         if not self.current_file_path:
+            self.file_label.config(text="未加载文件")
             return
-        try:
-            with open(self.current_file_path, 'r', encoding='utf-8') as f:
-                novel_text = f.read()
-            self.chapters = self.split_into_chapters(novel_text)
-        except Exception as e:
-            messagebox.showerror("错误", f"重新加载文件失败: {str(e)}")
+        text = "当前文件: " + os.path.basename(self.current_file_path)
+        if self.chapters is not None and self.chapters.encoding != "utf-8":
+            text += f"（{self.chapters.encoding.upper()}）"
+        if self.journal is not None and len(self.journal):
+            text += f"（修订 {len(self.journal)}）"
+            if self.journal.skipped:
+                text += f"（{len(self.journal.skipped)} 条修订与原文不符，已跳过）"
+            if self.journal.orphaned:
+                text += f"（{len(self.journal.orphaned)} 条修订找不到对应标题的章节，已跳过）"
+        self.file_label.config(text=text)
+
+    def export_revision(self):
+        """把原文件加上指定数量的修订物化为新的 txt 文件（按原有规则命名），在后台线程中写出并显示进度"""
+        if self.is_loading():
             return
-        self.chapter_listbox.delete(0, tk.END)
-        for chap_title in self.chapters.keys():
-            self.chapter_listbox.insert(tk.END, chap_title)
-        if self.chapter_listbox.size() > 0:
+        if self.chapters is None or not self.current_file_path:
+            messagebox.showwarning("提示", "未记录小说文件名，请先加载小说文件。")
+            return
+        total = len(self.journal)
+        if total == 0:
+            messagebox.showinfo("提示", "当前文件还没有任何修订。")
+            return
+        revision = simpledialog.askinteger("导出修订", f"导出到第几条修订（0～{total}）：",
+                                           initialvalue=total, minvalue=0, maxvalue=total, parent=self.root)
+        if revision is None:
+            return
+        new_file_path = os.path.join(os.path.dirname(self.current_file_path), self.generate_new_filename())
+        file_path, journal_path, grammar = self.current_file_path, self.journal.path, self.engine.grammar
+
+        win = tk.Toplevel(self.root)
+        win.title("导出修订")
+        progress = ttk.Progressbar(win, length=400, mode="determinate")
+        progress.pack(padx=10, pady=5)
+        status_label = tk.Label(win, text="正在导出……")
+        status_label.pack(pady=5)
+        win.protocol("WM_DELETE_WINDOW", lambda: None)  # 写出完成前不能关闭
+        win.transient(self.root)
+        win.grab_set()  # 导出期间不能编辑或重新加载当前文件
+
+        def on_progress(done, total):
+            progress.config(maximum=max(total, 1), value=done)
+            status_label.config(text=f"正在导出 {done}/{total} 章")
+
+        def on_finish(journal, error):
+            win.grab_release()
+            win.destroy()
+            if error is not None:
+                messagebox.showerror("错误", f"导出失败：{str(error)}")
+                return
+            message = f"修订内容已导出到文件：\n{new_file_path}"
+            skipped = len(journal.skipped) + len(journal.orphaned)
+            if skipped:
+                message += f"\n\n其中 {skipped} 条修订与原文对不上，未包含在导出内容中。"
+            messagebox.showinfo("提示", message)
+
+        def task():
+            try:
+                journal = EditJournal(journal_path)  # 单独的日志对象，不与界面线程共用
+                export_revision(file_path, journal, new_file_path, revision, grammar=grammar,
+                                on_progress=lambda d, t: self.root.after(0, lambda: on_progress(d, t)))
+                self.root.after(0, lambda: on_finish(journal, None))
+            except Exception as e:
+                self.root.after(0, lambda e=e: on_finish(None, e))
+        threading.Thread(target=task, daemon=True).start()
+
+    def reload_current_file(self, chapter_index=0, offset=0):
+        """在后台重新加载当前文件，完成后显示第 chapter_index 章并滚动到章内偏移 offset"""
+        if not self.current_file_path:
+            return
+
+        def on_done():
+            if self.chapter_listbox.size() == 0:
+                return
+            index = chapter_index if chapter_index < self.chapter_listbox.size() else 0
             self.chapter_listbox.selection_clear(0, tk.END)
-            self.chapter_listbox.selection_set(0)
-            self.display_chapter_content(None)
-        self.file_label.config(text="当前文件: " + os.path.basename(self.current_file_path))
-
-    # --------------- 辅助函数：计算章节与滚动位置 ---------------
-    def get_scroll_fraction_for_text(self, chapter_content, text_to_match):
-        pos = chapter_content.find(text_to_match)
-        if pos == -1:
-            return 0.0
-        lines = chapter_content.splitlines()
-        cumulative = 0
-        for i, line in enumerate(lines):
-            if cumulative + len(line) >= pos:
-                return i / max(len(lines), 1)
-            cumulative += len(line) + 1  # 加上换行符
-        return 0.0
-
-    def get_chapter_info_from_text(self, text_to_match):
-        for i, title in enumerate(self.chapter_listbox.get(0, tk.END)):
-            chapter_content = self.chapters.get(title, "")
-            if text_to_match in chapter_content:
-                fraction = self.get_scroll_fraction_for_text(chapter_content, text_to_match)
-                return i, fraction
-        try:
-            chapter_index = self.chapter_listbox.curselection()[0]
-        except IndexError:
-            chapter_index = 0
-        scroll_fraction = self.chapter_text.yview()[0]
-        return chapter_index, scroll_fraction
+            self.chapter_listbox.selection_set(index)
+            self.chapter_listbox.see(index)
+            self.display_chapter_content(None, focus_offset=offset)
+            self.scroll_to_offset(offset)
+        self.start_loading(self.current_file_path, on_done)
+
+    # --------------- 辅助函数：选区与章内偏移、滚动位置的换算 ---------------
+    def offset_from_index(self, index):
+        """文本框中显示的就是章节原文，位置（如 "3.7"）之前的字符数加上尚未补齐的前文字数即章内偏移"""
+        count = self.chapter_text.count("1.0", index, "chars")
+        return (count[0] if count else 0) + self.render_base
+
+    def index_from_offset(self, offset):
+        """章内偏移对应的文本框位置（落在尚未补齐的前文中时取开头）"""
+        return f"1.0 + {max(0, offset - self.render_base)} chars"
 
-    def get_chapter_info_from_selection(self):
+    def selection_offsets(self):
+        """返回当前选区对应的 (章节序号, 起始偏移, 结束偏移)，去掉首尾换行；没有选区时返回 None"""
+        if self.displayed_chapter is None:
+            return None
         try:
-            selected_text = self.chapter_text.get(tk.SEL_FIRST, tk.SEL_LAST).strip()
+            start = self.offset_from_index(tk.SEL_FIRST)
+            end = self.offset_from_index(tk.SEL_LAST)
         except tk.TclError:
-            selected_text = ""
-        if selected_text:
-            return self.get_chapter_info_from_text(selected_text)
-        else:
-            try:
-                chapter_index = self.chapter_listbox.curselection()[0]
-            except IndexError:
-                chapter_index = 0
-            scroll_fraction = self.chapter_text.yview()[0]
-            return chapter_index, scroll_fraction
+            return None
+        content = self.get_chapter_content(self.displayed_chapter)
+        end = min(end, len(content))
+        while start < end and content[start] in "\r\n":
+            start += 1
+        while end > start and content[end - 1] in "\r\n":
+            end -= 1
+        if start >= end:
+            return None
+        return self.displayed_chapter, start, end
+
+    def top_offset(self):
+        """文本框可见区域第一个字符的章内偏移，用于记录滚动位置"""
+        return self.offset_from_index("@0,0")
+
+    def scroll_to_offset(self, offset):
+        """把章内偏移所在的行滚动到可见区域顶部"""
+        self.chapter_text.yview(self.index_from_offset(offset))
 
     # --------------- 模型调用相关函数 ---------------
     def config_model(self):
@@ -652,97 +1375,237 @@ class NovelReader:
             stream_checkbox = tk.Checkbutton(frame, variable=stream_var)
             stream_checkbox.grid(row=row, column=1, padx=5, pady=5, sticky="w")
             entries[model_name]["stream"] = stream_var
+            # 连接参数与分段用的 token 预算
+            for key, label, default, _ in MODEL_NUMBER_FIELDS:
+                row += 1
+                tk.Label(frame, text=label).grid(row=row, column=0, padx=5, pady=5, sticky="e")
+                entry = tk.Entry(frame, width=10)
+                entry.grid(row=row, column=1, padx=5, pady=5, sticky="w")
+                entry.insert(0, str(cfg.get(key, default)))
+                entries[model_name][key] = entry
+            row += 1
+            client = self.engine.client(model_name, create=False)
+            tk.Label(frame, text=client.summary() if client else "尚未发起请求",
+                     fg="gray").grid(row=row, column=0, columnspan=2, padx=5, pady=5, sticky="w")
         def save_all_configs():
             for model_name, ctrls in entries.items():
+                try:
+                    numbers = {key: convert(ctrls[key].get()) for key, _, _, convert in MODEL_NUMBER_FIELDS}
+                except ValueError:
+                    messagebox.showwarning("提示", f"【{model_name}】的超时、重试次数和 token 数必须是数字。",
+                                           parent=config_win)
+                    return
                 self.model_configs[model_name]["api_key"] = ctrls["api_key"].get().strip()
                 self.model_configs[model_name]["url"] = ctrls["url"].get().strip()
                 self.model_configs[model_name]["model"] = ctrls["model"].get().strip()
                 self.model_configs[model_name]["stream"] = ctrls["stream"].get()
+                self.model_configs[model_name].update(numbers)
+            # 配置变化后重新创建客户端（进行中的请求仍使用旧客户端直至结束）
+            self.engine.reset_clients()
             self.save_model_configs()
             messagebox.showinfo("提示", "配置已保存！")
             config_win.destroy()
-        save_button = tk.Button(config_win, text="保存配置", command=save_all_configs)
-        save_button.pack(pady=10)
+        def clear_cache():
+            if self.rewrite_cache is None:
+                return
+            if messagebox.askyesno("确认", "确定清空全部改写缓存吗？", parent=config_win):
+                self.rewrite_cache.clear()
+                cache_label.config(text="改写缓存：0.0 MB")
+        def clear_summaries():
+            if self.summaries is None:
+                return
+            if messagebox.askyesno("确认", "确定清空全部章节摘要吗？", parent=config_win):
+                self.summaries.clear()
+                summary_label.config(text="章节摘要：0 章")
+        bottom = tk.Frame(config_win)
+        bottom.pack(pady=10)
+        cache_size = self.rewrite_cache.total_bytes / 1024 / 1024 if self.rewrite_cache is not None else 0
+        cache_label = tk.Label(bottom, text=f"改写缓存：{cache_size:.1f} MB")
+        cache_label.pack(side=tk.LEFT, padx=5)
+        tk.Button(bottom, text="清空缓存", command=clear_cache).pack(side=tk.LEFT, padx=5)
+        summary_count = self.summaries.count() if self.summaries is not None else 0
+        summary_label = tk.Label(bottom, text=f"章节摘要：{summary_count} 章")
+        summary_label.pack(side=tk.LEFT, padx=5)
+        tk.Button(bottom, text="清空摘要", command=clear_summaries).pack(side=tk.LEFT, padx=5)
+        tk.Button(bottom, text="请求统计", command=lambda: self.show_request_stats(config_win)).pack(side=tk.LEFT, padx=5)
+        save_button = tk.Button(bottom, text="保存配置", command=save_all_configs)
+        save_button.pack(side=tk.LEFT, padx=5)
+
+    def show_request_stats(self, parent):
+        """按模型配置显示请求耗时的 p50 / p95，用于比较各服务商"""
+        if self.telemetry is None:
+            messagebox.showwarning("提示", "请求统计不可用。", parent=parent)
+            return
+        stats_win = tk.Toplevel(parent)
+        stats_win.title("请求统计（单位：秒）")
+        columns = (("profile", "模型配置", 100), ("count", "请求", 50), ("errors", "失败", 50),
+                   ("cached", "缓存", 50), ("retries", "重试", 50), ("connect_p50", "建连p50", 70),
+                   ("ttft_p50", "首字p50", 70), ("ttft_p95", "首字p95", 70), ("total_p50", "总耗时p50", 80),
+                   ("total_p95", "总耗时p95", 80), ("tok_s_p50", "tok/s p50", 80), ("tok_s_p95", "tok/s p95", 80))
+        tree = ttk.Treeview(stats_win, columns=[c[0] for c in columns], show="headings", height=8)
+        for key, label, width in columns:
+            tree.heading(key, text=label)
+            tree.column(key, width=width, anchor="center")
+        tree.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+        days_var = tk.StringVar(value="全部")
+
+        def fmt(value, digits=2):
+            if value is None:
+                return "-"
+            return f"{value:.{digits}f}" if isinstance(value, float) else str(value)
+
+        def refresh(*_):
+            days = {"最近1天": 1, "最近7天": 7, "最近30天": 30}.get(days_var.get())
+            since = time.time() - days * 86400 if days else None
+            tree.delete(*tree.get_children())
+            for row in self.telemetry.stats(since):
+                tree.insert("", tk.END, values=[
+                    fmt(row[key], 3 if key == "connect_p50" else 1 if key.startswith("tok_s") else 2)
+                    for key, _, _ in columns])
+
+        def clear():
+            if messagebox.askyesno("确认", "确定清空全部请求记录吗？", parent=stats_win):
+                self.telemetry.clear()
+                refresh()
+
+        bottom = tk.Frame(stats_win)
+        bottom.pack(pady=(0, 10))
+        range_box = ttk.Combobox(bottom, textvariable=days_var, values=("全部", "最近1天", "最近7天", "最近30天"),
+                                 state="readonly", width=10)
+        range_box.pack(side=tk.LEFT, padx=5)
+        range_box.bind("<<ComboboxSelected>>", refresh)
+        tk.Button(bottom, text="刷新", command=refresh).pack(side=tk.LEFT, padx=5)
+        tk.Button(bottom, text="清空记录", command=clear).pack(side=tk.LEFT, padx=5)
+        refresh()
+
+    def call_api_in_thread(self, prompt, callback, on_text=None, cancel=None, direction=None, models=None,
+                           prefix=""):
+        """
+        在后台线程调用接口，完成后在界面线程执行 callback(result, tokens, first_at, model_name)。
+        on_text(text, tokens, first_at) 在界面线程中接收合并后的增量文本，
+        tokens 为已收到的 token 数，first_at 为首个 token 到达的 time.monotonic() 时间。
+        direction 不为 None 时 prompt 为待改写的原文，按 token 预算分段依次请求；
+        再给出 models 时按对冲方式依次使用这些模型配置；prefix 为加在每段提示词开头的前情提要。
+        模型配置使用异步请求时不新建线程，改为在引擎的后台事件循环中执行，cancel 后连接立即关闭。
+        """
+        # Tk 变量只能在界面线程中读取
+        use_cache = self.use_cache.get()
+        if not models and use_async_http(self.model_configs.get(self.current_model_name, {})):
+            meter = {}
+
+            def done(future):
+                # 无论结果如何都要回调，对比窗口才能结束“生成中”状态
+                result = None
+                if not future.cancelled():
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        self.show_error(f"调用接口出错：{str(e)}")
+                self.root.after(0, lambda: callback(result, meter.get("tokens", 0), meter.get("first_at"),
+                                                    meter.get("model")))
+            future = self.engine.submit(self.call_api_async(prompt, on_text=on_text, cancel=cancel, meter=meter,
+                                                            direction=direction, prefix=prefix,
+                                                            use_cache=use_cache), cancel)
+            future.add_done_callback(done)
+            return
 
-    def call_api_in_thread(self, prompt, callback):
         def task():
-            result = self.call_api(prompt)
-            self.root.after(0, lambda: callback(result))
+            meter = {}
+            result = self.call_api(prompt, on_text=on_text, cancel=cancel, meter=meter, direction=direction,
+                                   models=models, prefix=prefix, use_cache=use_cache)
+            self.root.after(0, lambda: callback(result, meter.get("tokens", 0), meter.get("first_at"),
+                                                meter.get("model")))
         t = threading.Thread(target=task)
         t.daemon = True
         t.start()
 
-    def call_api(self, prompt):
-        config = self.model_configs.get(self.current_model_name, {})
-        if not config.get("api_key"):
+    def call_api(self, prompt, on_text=None, cancel=None, meter=None, direction=None, models=None, prefix="",
+                 use_cache=True):
+        model_name = self.current_model_name
+        if not self.model_configs.get(model_name, {}).get("api_key"):
             self.show_error("请先在【配置模型】中设置 API Key。")
             return None
-        payload = {
-            "model": config.get("model", ""),
-            "messages": [
-                {"content": prompt, "role": "user", "name": "用户"}
-            ],
-            "stream": config.get("stream", True)
-        }
-        headers = {
-            "Authorization": f"Bearer {config.get('api_key')}",
-            "Content-Type": "application/json"
-        }
+        coalescer = self.make_coalescer(on_text)
         try:
-            if config.get("stream", True):
-                response = requests.post(config.get("url", ""),
-                                         headers=headers,
-                                         json=payload,
-                                         stream=True,
-                                         timeout=60)
-                if response.status_code != 200:
-                    self.show_error(f"HTTP错误：{response.status_code}\n{response.text}")
-                    return None
-                all_text = ""
-                for chunk in response.iter_content(chunk_size=None):
-                    if chunk:
-                        text_chunk = chunk.decode('utf-8', errors='ignore').strip()
-                        for line in text_chunk.splitlines():
-                            line = line.strip()
-                            if line.startswith("data: "):
-                                line_content = line[len("data: "):]
-                                if line_content in ["[DONE]", ""]:
-                                    continue
-                                try:
-                                    data = json.loads(line_content)
-                                    if "choices" in data and len(data["choices"]) > 0:
-                                        choice = data["choices"][0]
-                                        if "delta" in choice and "content" in choice["delta"]:
-                                            chunk_text = choice["delta"]["content"]
-                                        elif "message" in choice and "content" in choice["message"]:
-                                            chunk_text = choice["message"]["content"]
-                                        else:
-                                            chunk_text = ""
-                                        if chunk_text:
-                                            all_text += chunk_text
-                                            self.root.after(0, lambda text=chunk_text: self.show_toast(text))
-                                except json.JSONDecodeError:
-                                    pass
-                return all_text
-            else:
-                response = requests.post(config.get("url", ""),
-                                         headers=headers,
-                                         json=payload,
-                                         timeout=60)
-                if response.status_code != 200:
-                    self.show_error(f"HTTP错误：{response.status_code}\n{response.text}")
-                    return None
-                data = response.json()
-                if "choices" in data and len(data["choices"]) > 0:
-                    choice = data["choices"][0]
-                    if "message" in choice and "content" in choice["message"]:
-                        return choice["message"]["content"]
-                    elif "delta" in choice and "content" in choice["delta"]:
-                        return choice["delta"]["content"]
-                return "（未获取到内容）"
+            if direction is not None and models:
+                hedge_after = float(self.model_configs[model_name].get("hedge_after", HEDGE_AFTER))
+                model_name, result = self.engine.rewrite_hedged(models, direction, prompt, on_token=coalescer,
+                                                                cancel=cancel, use_cache=use_cache,
+                                                                hedge_after=hedge_after, prefix=prefix)
+                return result
+            if direction is not None:
+                # 按片段保存检查点：中途失败或停止后重新改写同一段文本时，已完成的片段不再请求
+                job = None
+                if self.jobs is not None:
+                    job = self.jobs.open("text", self.current_file_path, direction, model_name, text=prompt)
+                result = self.engine.rewrite_text(model_name, direction, prompt, on_token=coalescer, cancel=cancel,
+                                                  use_cache=use_cache, job=job, prefix=prefix)
+                if job is not None:
+                    job.finish()
+                return result
+            return self.engine.complete(model_name, prompt, on_token=coalescer, cancel=cancel,
+                                        use_cache=use_cache)
+        except RequestCancelled:
+            return None
+        except ApiError as e:
+            self.show_error(str(e))
+            return None
         except Exception as e:
+            # 其他意外错误（响应格式异常、本地文件或数据库出错等）同样提示并返回 None，调用方才能结束等待
             self.show_error(f"调用接口出错：{str(e)}")
             return None
+        finally:
+            coalescer.flush()
+            if meter is not None:
+                meter["model"] = model_name
+                meter["tokens"] = coalescer.tokens
+                meter["first_at"] = coalescer.first_at
+
+    async def call_api_async(self, prompt, on_text=None, cancel=None, meter=None, direction=None, prefix="",
+                             use_cache=True):
+        """call_api 的协程版本（不含对冲），由 call_api_in_thread 提交到引擎的事件循环；任务库读写交给线程池"""
+        loop = asyncio.get_running_loop()
+        model_name = self.current_model_name
+        if not self.model_configs.get(model_name, {}).get("api_key"):
+            self.show_error("请先在【配置模型】中设置 API Key。")
+            return None
+        coalescer = self.make_coalescer(on_text)
+        try:
+            if direction is not None:
+                job = None
+                if self.jobs is not None:
+                    job = await loop.run_in_executor(None, lambda: self.jobs.open(
+                        "text", self.current_file_path, direction, model_name, text=prompt))
+                result = await self.engine.rewrite_text_async(model_name, direction, prompt, on_token=coalescer,
+                                                              cancel=cancel, use_cache=use_cache, job=job,
+                                                              prefix=prefix)
+                if job is not None:
+                    await loop.run_in_executor(None, job.finish)
+                return result
+            return await self.engine.complete_async(model_name, prompt, on_token=coalescer, cancel=cancel,
+                                                    use_cache=use_cache)
+        except RequestCancelled:
+            return None
+        except ApiError as e:
+            self.show_error(str(e))
+            return None
+        except Exception as e:
+            self.show_error(f"调用接口出错：{str(e)}")
+            return None
+        finally:
+            coalescer.flush()
+            if meter is not None:
+                meter["model"] = model_name
+                meter["tokens"] = coalescer.tokens
+                meter["first_at"] = coalescer.first_at
+
+    def make_coalescer(self, on_text=None):
+        if on_text is None:
+            on_text = lambda text, tokens, first_at: self.show_toast(text)
+        # 逐 token 的回调合并为每 50ms 最多一次界面刷新
+        coalescer = TokenCoalescer(lambda text: self.root.after(
+            0, lambda n=coalescer.tokens, t=coalescer.first_at: on_text(text, n, t)))
+        return coalescer
 
     def show_error(self, msg):
         self.root.after(0, lambda: messagebox.showerror("错误", msg))
@@ -780,42 +1643,10 @@ class NovelReader:
         self.toast_timer = None
 
     def load_model_configs(self):
-        config_path = os.path.join(os.path.dirname(sys.argv[0]), "model_config.json")
-        if os.path.exists(config_path):
-            try:
-                with open(config_path, "r", encoding="utf-8") as f:
-                    self.model_configs = json.load(f)
-            except Exception as e:
-                print("读取模型配置文件出错：", e)
-        else:
-            self.model_configs = {
-                "思考模型": {
-                    "api_key": "",
-                    "url": "https://api.example.com/think",
-                    "model": "think-model-01",
-                    "stream": False
-                },
-                "全文模型": {
-                    "api_key": "",
-                    "url": "https://api.example.com/full",
-                    "model": "full-model-01",
-                    "stream": True
-                },
-                "小说模型": {
-                    "api_key": "",
-                    "url": "https://api.minimax.chat/v1/text/chatcompletion_v2",
-                    "model": "minimax-text-01",
-                    "stream": True
-                }
-            }
+        self.model_configs = read_model_configs(os.path.join(os.path.dirname(sys.argv[0]), MODEL_CONFIG_FILE))
 
     def save_model_configs(self):
-        config_path = os.path.join(os.path.dirname(sys.argv[0]), "model_config.json")
-        try:
-            with open(config_path, "w", encoding="utf-8") as f:
-                json.dump(self.model_configs, f, ensure_ascii=False, indent=4)
-        except Exception as e:
-            print("保存模型配置文件出错：", e)
+        write_model_configs(os.path.join(os.path.dirname(sys.argv[0]), MODEL_CONFIG_FILE), self.model_configs)
 
 if __name__ == "__main__":
     root = tk.Tk()
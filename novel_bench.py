@@ -0,0 +1,505 @@
+"""
+性能基准：合成小说上的章节索引、章节显示、保存替换与重新加载，
+以及本地模拟的 OpenAI 兼容接口（可设置首字延迟、生成速度、分片与 429/5xx 注入）上的流式请求。
+
+用法：
+    python novel_bench.py book --sizes 1,10,100,1000          # 各种大小（MB）的合成小说
+    python novel_bench.py stream --requests 50 --concurrency 8 --ttft 0.3 --tps 80 --error-429 0.1
+    python novel_bench.py stream --requests 500 --concurrency 200 --async-http   # 异步客户端（后台事件循环）
+    python novel_bench.py serve --port 8000 --ttft 0.5         # 只启动模拟接口，供界面或命令行手动测试
+    python novel_bench.py gen 小说.txt --size 50 --encoding gb18030
+"""
+import argparse
+import concurrent.futures
+import http.server
+import json
+import os
+import random
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from novel_engine import (NovelIndex, EditJournal, RewriteEngine, export_revision, write_book,
+                          build_rewrite_prompt, ApiError, percentile)
+
+
+# --------------- 合成小说 ---------------
+_DIGITS = "零一二三四五六七八九"
+_SYLLABLES = ("天地玄黄宇宙洪荒日月盈昃辰宿列张寒来暑往秋收冬藏闰余成岁律吕调阳云腾致雨露结为霜"
+              "金生丽水玉出昆冈剑号巨阙珠称夜光果珍李柰菜重芥姜海咸河淡鳞潜羽翔龙师火帝鸟官人皇")
+_PUNCTUATION = "，，，。。！？；"
+
+
+def chinese_number(n):
+    """把 1～99999 的整数写成中文数字（第一百零三章 之类的标题用）"""
+    if n < 10:
+        return _DIGITS[n]
+    parts = []
+    zero = False
+    for value, unit in ((10000, "万"), (1000, "千"), (100, "百"), (10, "十"), (1, "")):
+        digit = n // value % 10
+        if digit:
+            if zero:
+                parts.append("零")
+            parts.append(("" if digit == 1 and unit == "十" and n < 20 else _DIGITS[digit]) + unit)
+            zero = False
+        elif parts:
+            zero = True
+    return "".join(parts)
+
+
+def _paragraph(rng):
+    sentences = []
+    for _ in range(rng.randint(2, 6)):
+        sentences.append("".join(rng.choice(_SYLLABLES) for _ in range(rng.randint(6, 24))))
+        sentences.append(rng.choice(_PUNCTUATION))
+    return "　　" + "".join(sentences)
+
+
+def generate_novel(path, size_mb, encoding="utf-8", seed=1, newline="\n"):
+    """
+    生成约 size_mb MB 的合成小说：每 100 章一卷（第X卷 小标题），章节标题为“第X章 小标题”，
+    每章 2000～5000 字、段落以全角空格缩进。按块写出，内存占用与文件大小无关。返回章节数。
+    """
+    rng = random.Random(seed)
+    pool = [_paragraph(rng) for _ in range(500)]
+    target = int(size_mb * 1024 * 1024)
+    written = 0
+    chapter = 0
+    with open(path, "w", encoding=encoding, newline=newline) as f:
+        while written < target:
+            chapter += 1
+            lines = []
+            if chapter % 100 == 1:
+                lines.append(f"第{chinese_number(chapter // 100 + 1)}卷 {rng.choice(pool)[2:8]}")
+            lines.append(f"第{chinese_number(chapter)}章 {rng.choice(pool)[2:10]}")
+            chars = 0
+            limit = rng.randint(2000, 5000)
+            while chars < limit:
+                para = rng.choice(pool)
+                lines.append(para)
+                chars += len(para)
+            block = "\n".join(lines) + "\n\n"
+            f.write(block)
+            written += len(block.encode(encoding))
+    return chapter
+
+
+# --------------- 内存与计时 ---------------
+def peak_rss_mb():
+    """本进程的峰值常驻内存（MB），无法获取时返回 None"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        handle = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(handle, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize / 1024 / 1024
+    except Exception:
+        pass
+    return None
+
+
+def _timed(func, *args, **kwargs):
+    started = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - started, result
+
+
+# --------------- 书本基准 ---------------
+def bench_book(path, samples=200, seed=1):
+    """
+    对一本书计时：建立章节索引、随机显示 samples 个章节（解码并应用修订）、
+    保存一处修改（追加修订日志）、替换一章并写出整本书、以及重新加载。返回结果字典。
+    """
+    rng = random.Random(seed)
+    size_mb = os.path.getsize(path) / 1024 / 1024
+    result = {"file": os.path.basename(path), "size_mb": round(size_mb, 1)}
+    journal_path = EditJournal.path_for(path)
+    if os.path.exists(journal_path):
+        os.remove(journal_path)
+
+    seconds, novel = _timed(NovelIndex, path)
+    result["chapters"] = len(novel)
+    result["encoding"] = novel.encoding
+    result["split_s"] = round(seconds, 3)
+    result["split_mb_s"] = round(size_mb / seconds, 1) if seconds else None
+
+    journal = EditJournal(journal_path)
+    picks = [rng.randrange(len(novel)) for _ in range(samples)]
+    timings = []
+    for i in picks:
+        seconds, _ = _timed(lambda: journal.apply(i, novel.chapter_text(i)))
+        timings.append(seconds * 1000)
+    result["display_ms_p50"] = round(percentile(timings, 50), 3)
+    result["display_ms_p95"] = round(percentile(timings, 95), 3)
+
+    i = picks[0]
+    text = novel.chapter_text(i)
+    old = text[:20]
+    seconds, _ = _timed(journal.append, i, novel.titles[i], 0, old, old[::-1])
+    result["save_patch_ms"] = round(seconds * 1000, 3)
+
+    out_path = path + ".bench.txt"
+    try:
+        def replace_chapter():
+            with open(out_path, "wb") as out:
+                write_book(novel, out, [(i, text[::-1])])
+        seconds, _ = _timed(replace_chapter)
+        result["replace_s"] = round(seconds, 3)
+        novel.close()
+        seconds, _ = _timed(export_revision, path, journal, out_path)
+        result["export_s"] = round(seconds, 3)
+    finally:
+        if os.path.exists(out_path):
+            os.remove(out_path)
+        os.remove(journal_path)
+
+    seconds, novel = _timed(NovelIndex, path)
+    result["reload_s"] = round(seconds, 3)
+    novel.close()
+    result["peak_rss_mb"] = round(peak_rss_mb() or 0, 1)
+    return result
+
+
+def _cmd_book(args):
+    workdir = args.workdir or tempfile.gettempdir()
+    rows = []
+    for size in [float(s) for s in args.sizes.split(",")]:
+        path = os.path.join(workdir, f"novel_bench_{size:g}MB_{args.encoding}.txt")
+        if not os.path.exists(path):
+            print(f"生成 {size:g} MB 合成小说……", file=sys.stderr, flush=True)
+            generate_novel(path, size, encoding=args.encoding)
+        # 每本书在独立进程中测量，峰值内存互不影响
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), "book-one", path,
+                                 "--samples", str(args.samples)],
+                                check=True, capture_output=True, text=True).stdout
+        row = json.loads(output)
+        rows.append(row)
+        print(json.dumps(row, ensure_ascii=False), flush=True)
+        if not args.keep:
+            os.remove(path)
+    columns = ("size_mb", "chapters", "split_s", "split_mb_s", "display_ms_p50", "display_ms_p95",
+               "save_patch_ms", "replace_s", "export_s", "reload_s", "peak_rss_mb")
+    print("\t".join(columns))
+    for row in rows:
+        print("\t".join(str(row.get(c)) for c in columns))
+    return 0
+
+
+def _cmd_book_one(args):
+    print(json.dumps(bench_book(args.path, samples=args.samples), ensure_ascii=False))
+    return 0
+
+
+def _cmd_gen(args):
+    chapters = generate_novel(args.path, args.size, encoding=args.encoding)
+    print(f"已生成 {args.path}：{chapters} 章，{os.path.getsize(args.path) / 1024 / 1024:.1f} MB")
+    return 0
+
+
+# --------------- 模拟的 OpenAI 兼容接口 ---------------
+class MockChatServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """
+    本地模拟的 /chat/completions 接口（任意路径均可），用于离线测试与基准：
+    - ttft：首个 token 之前的延迟（秒）；tps：之后每秒生成的 token 数（0 表示不限速）；
+    - fragment：把每个 SSE 事件拆成最多 fragment 字节的小块分别发送（0 表示不拆），检验解码器的拼接；
+    - error_429 / error_5xx：请求直接返回 429（带 Retry-After）或 503 的概率；
+    - 回复内容为提示词中“【待修改文本】”之后的原文（没有时为固定文本），按 1～2 个字切成 token。
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024  # 异步客户端会同时发起大量连接，默认的 5 会导致 SYN 被丢弃、重传
+
+    def __init__(self, port=0, ttft=0.2, tps=50.0, fragment=0, error_429=0.0, error_5xx=0.0,
+                 retry_after=0, seed=None):
+        super().__init__(("127.0.0.1", port), _MockChatHandler)
+        self.ttft = ttft
+        self.tps = tps
+        self.fragment = fragment
+        self.error_429 = error_429
+        self.error_5xx = error_5xx
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.counts = {"requests": 0, "429": 0, "5xx": 0, "completed": 0}
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1/chat/completions"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] += 1
+
+    def roll(self):
+        with self.lock:
+            return self.rng.random()
+
+
+MOCK_REPLY = "这是模拟接口返回的改写结果。" * 20
+
+
+class _MockChatHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        server.count("requests")
+        roll = server.roll()
+        if roll < server.error_429:
+            server.count("429")
+            return self._plain(429, "rate limited", {"Retry-After": str(server.retry_after)})
+        if roll < server.error_429 + server.error_5xx:
+            server.count("5xx")
+            return self._plain(503, "unavailable")
+        prompt = (body.get("messages") or [{}])[-1].get("content", "")
+        marker = "【待修改文本】\n"
+        reply = prompt.split(marker, 1)[1].rstrip("\n") if marker in prompt else MOCK_REPLY
+        tokens = []
+        pos = 0
+        while pos < len(reply):
+            step = server.rng.randint(1, 2)
+            tokens.append(reply[pos:pos + step])
+            pos += step
+        time.sleep(server.ttft)
+        if not body.get("stream"):
+            if server.tps:
+                time.sleep(len(tokens) / server.tps)
+            server.count("completed")
+            data = json.dumps({"choices": [{"message": {"role": "assistant", "content": reply}}]},
+                              ensure_ascii=False).encode("utf-8")
+            return self._plain(200, data, {"Content-Type": "application/json"})
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        started = time.monotonic()
+        try:
+            for n, token in enumerate(tokens):
+                if server.tps:
+                    delay = started + n / server.tps - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                event = {"choices": [{"delta": {"content": token}, "index": 0}]}
+                self._event(("data: " + json.dumps(event, ensure_ascii=False) + "\n\n").encode("utf-8"))
+            self._event(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+            server.count("completed")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # 客户端取消
+
+    def _event(self, data):
+        size = self.server.fragment or len(data)
+        for i in range(0, len(data), size):
+            chunk = data[i:i + size]
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            self.wfile.flush()
+
+    def _plain(self, status, data, headers=None):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def _mock_server(args):
+    return MockChatServer(port=args.port, ttft=args.ttft, tps=args.tps, fragment=args.fragment,
+                          error_429=args.error_429, error_5xx=args.error_5xx,
+                          retry_after=args.retry_after, seed=args.seed)
+
+
+def _cmd_serve(args):
+    server = _mock_server(args)
+    print(f"模拟接口：{server.url}（Ctrl-C 退出）", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(server.counts, ensure_ascii=False))
+    return 0
+
+
+# --------------- 流式请求基准 ---------------
+def bench_stream(server, requests=20, concurrency=4, chars=300, stream=True, max_retries=5, seed=1,
+                 async_http=False):
+    """
+    通过 RewriteEngine 向模拟接口并发发送 requests 个改写请求，统计首字延迟、总耗时、生成速度、
+    重试与失败次数，并核对每个结果与原文一致（检验分片拼接与重试不丢字）。
+    async_http 为 True 时全部请求以协程提交到引擎的后台事件循环（complete_async），
+    并发由限流器的 max_concurrency 控制；否则每个请求占用线程池中的一个线程（complete）。
+    """
+    rng = random.Random(seed)
+    config = {"api_key": "bench", "url": server.url, "model": "mock", "stream": stream,
+              "max_retries": max_retries, "backoff_base": 0.05, "backoff_max": 1.0,
+              "max_concurrency": concurrency, "async_http": async_http}
+    engine = RewriteEngine({"bench": config})
+    texts = ["".join(rng.choice(_SYLLABLES) for _ in range(chars)) for _ in range(requests)]
+    records = []
+    lock = threading.Lock()
+
+    def record(text, started, first, result, error):
+        finished = time.monotonic()
+        with lock:
+            records.append({"ttft": (first[0] - started) if first else None, "total": finished - started,
+                            "chars": len(result or ""), "ok": result == text, "error": error})
+
+    def one(text):
+        first = []
+        started = time.monotonic()
+        error = None
+        result = None
+        try:
+            result = engine.complete("bench", build_rewrite_prompt("原样输出", text),
+                                     on_token=lambda piece: first or first.append(time.monotonic()),
+                                     use_cache=False)
+        except ApiError as e:
+            error = str(e)
+        record(text, started, first, result, error)
+
+    async def one_async(text):
+        first = []
+        started = time.monotonic()
+        error = None
+        result = None
+        try:
+            result = await engine.complete_async("bench", build_rewrite_prompt("原样输出", text),
+                                                 on_token=lambda piece: first or first.append(time.monotonic()),
+                                                 use_cache=False)
+        except ApiError as e:
+            error = str(e)
+        record(text, started, first, result, error)
+
+    started = time.monotonic()
+    if async_http:
+        try:
+            for future in [engine.submit(one_async(text)) for text in texts]:
+                future.result()
+            elapsed = time.monotonic() - started
+            client = engine.async_client("bench")
+        finally:
+            engine.runner.close()
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(one, texts))
+        elapsed = time.monotonic() - started
+        client = engine.client("bench")
+    ttfts = [r["ttft"] for r in records if r["ttft"] is not None]
+    totals = [r["total"] for r in records]
+    total_chars = sum(r["chars"] for r in records)
+    report = {
+        "requests": requests,
+        "concurrency": concurrency,
+        "client_kind": "async" if async_http else "threads",
+        "ok": sum(r["ok"] for r in records),
+        "failed": sum(r["error"] is not None for r in records),
+        "mismatched": sum(r["error"] is None and not r["ok"] for r in records),
+        "ttft_p50": percentile(ttfts, 50),
+        "ttft_p95": percentile(ttfts, 95),
+        "total_p50": percentile(totals, 50),
+        "total_p95": percentile(totals, 95),
+        "chars_per_s": total_chars / elapsed if elapsed else None,
+        "elapsed_s": elapsed,
+        "client": client.summary(),
+        "server": dict(server.counts),
+    }
+    return {k: round(v, 3) if isinstance(v, float) else v for k, v in report.items()}
+
+
+def _cmd_stream(args):
+    server = _mock_server(args).start()
+    try:
+        report = bench_stream(server, requests=args.requests, concurrency=args.concurrency, chars=args.chars,
+                              stream=not args.no_stream, max_retries=args.max_retries, seed=args.seed,
+                              async_http=args.async_http)
+    finally:
+        server.stop()
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0 if report["mismatched"] == 0 else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="novel_bench.py", description="小说阅读器的性能基准")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("gen", help="生成合成小说")
+    p.add_argument("path")
+    p.add_argument("--size", type=float, default=10, help="大小（MB）")
+    p.add_argument("--encoding", default="utf-8")
+    p.set_defaults(func=_cmd_gen)
+
+    p = sub.add_parser("book", help="章节索引 / 显示 / 保存替换 / 重新加载 的耗时与峰值内存")
+    p.add_argument("--sizes", default="1,10,100", help="逗号分隔的大小列表（MB），如 1,10,100,1000")
+    p.add_argument("--encoding", default="utf-8")
+    p.add_argument("--samples", type=int, default=200, help="随机显示的章节数")
+    p.add_argument("--workdir", help="合成小说的存放目录（默认系统临时目录）")
+    p.add_argument("--keep", action="store_true", help="保留生成的合成小说，下次直接复用")
+    p.set_defaults(func=_cmd_book)
+
+    p = sub.add_parser("book-one", help=argparse.SUPPRESS)
+    p.add_argument("path")
+    p.add_argument("--samples", type=int, default=200)
+    p.set_defaults(func=_cmd_book_one)
+
+    for name, help_text, func in (("serve", "只启动模拟接口", _cmd_serve),
+                                  ("stream", "对模拟接口做流式请求基准", _cmd_stream)):
+        p = sub.add_parser(name, help=help_text)
+        p.add_argument("--port", type=int, default=0 if name == "stream" else 8000)
+        p.add_argument("--ttft", type=float, default=0.2, help="首字延迟（秒）")
+        p.add_argument("--tps", type=float, default=50.0, help="每秒生成的 token 数，0 表示不限速")
+        p.add_argument("--fragment", type=int, default=0, help="把 SSE 事件拆成最多多少字节的小块")
+        p.add_argument("--error-429", type=float, default=0.0, help="返回 429 的概率")
+        p.add_argument("--error-5xx", type=float, default=0.0, help="返回 503 的概率")
+        p.add_argument("--retry-after", type=int, default=0, help="429 响应中 Retry-After 的秒数")
+        p.add_argument("--seed", type=int, default=1)
+        p.set_defaults(func=func)
+        if name == "stream":
+            p.add_argument("--requests", type=int, default=20)
+            p.add_argument("--concurrency", type=int, default=4)
+            p.add_argument("--chars", type=int, default=300, help="每个请求的原文字数")
+            p.add_argument("--max-retries", type=int, default=5)
+            p.add_argument("--no-stream", action="store_true", help="使用非流式请求")
+            p.add_argument("--async-http", action="store_true", help="使用异步客户端，在一个后台事件循环中并发请求")
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,3544 @@
+"""
+小说改写引擎：章节索引、提示词构造、接口调用、批量改写与修订日志，不依赖 Tk。
+图形界面（novel-ui.py）与命令行共用这里的实现。
+
+命令行用法：
+    python novel_engine.py chapters 小说.txt
+    python novel_engine.py rewrite 小说.txt --direction-index 1 --chapters 1-100 --concurrency 8
+    python novel_engine.py rewrite 小说.txt --direction-index 1 --summaries
+    python novel_engine.py export 小说.txt --revision 12
+    python novel_engine.py jobs
+    python novel_engine.py stats --days 7
+"""
+import argparse
+import codecs
+import re
+import string
+import sys
+import requests
+import requests.adapters
+import json
+import threading
+import os
+import time
+import mmap
+import collections
+import concurrent.futures
+import copy
+import hashlib
+import math
+import queue
+import sqlite3
+import random
+import socket
+import email.utils
+import bisect
+import shutil
+import itertools
+import operator
+import asyncio
+import ssl
+import urllib.parse
+import urllib.request
+from array import array
+
+# 章节标题中允许出现的数字（阿拉伯数字、全角数字、中文数字）
+CHAPTER_NUMERALS = "０１２３４５６７８９零〇一二三四五六七八九十百千万两"
+
+# 章节标题语法（可用脚本同目录的 章节标题.json 覆盖其中任意一项）：
+# - 独占一行（前面只能有空白）的“第 + 数字 + 单位”，如 第十二章、第3回、第一节、第二卷；
+# - 独占一行的“英文单词 + 阿拉伯数字或罗马数字”，如 Chapter 12、CHAPTER IV；
+# - 其后可以跟分隔符（separators 中的字符）和小标题，如“第一章 起航”“Chapter 3: Home”，
+#   整行作为章节标题；joined_units 中的单位后面也可以不加分隔符直接跟小标题，如“第一章起航”。
+#   “节”不在其中，因此“第三节课上……”这类正文不会被误认为标题。
+DEFAULT_HEADING_GRAMMAR = {
+    "numerals": CHAPTER_NUMERALS,
+    "units": "章回节卷",
+    "joined_units": "章回卷",
+    "words": ["Chapter", "CHAPTER"],
+    "separators": " \t　:：.、，,-—",
+}
+HEADING_TITLE_MAX_BYTES = 120  # 标题行（不含缩进）允许的最大字节数，更长的行视为正文
+
+
+def build_heading_regex(encoding='utf-8', grammar=None):
+    """
+    按文件编码与标题语法构造字节正则，可直接在 mmap 上扫描而无需先解码全文。
+    语法中的每个字符都按文件编码编码后再拼成正则，因此 GB18030、UTF-16 与 UTF-8 的扫描代价相同。
+    正则以换行符开头（只匹配行首标题，且以字面量开头时扫描最快），分组 1 为整行标题；
+    文件开头的标题由调用方在前面补一个换行后单独匹配。
+    """
+    grammar = dict(DEFAULT_HEADING_GRAMMAR, **(grammar or {}))
+
+    def lit(text):
+        return re.escape(text.encode(encoding))
+
+    def any_of(items):
+        return b"(?:" + b"|".join(lit(item) for item in items) + b")"
+
+    width = len("\n".encode(encoding))  # 一个 ASCII 字符的字节数：UTF-16 为 2，其余为 1
+    if width == 1:
+        line_char = rb"[^\r\n]"
+    else:
+        line_char = b"(?:(?!" + lit("\r") + b"|" + lit("\n") + rb")(?s:" + b"." * width + b"))"
+    digits = any_of(string.digits)
+    rest = line_char + b"{0,%d}" % (HEADING_TITLE_MAX_BYTES // width)  # 小标题，限制长度
+    subtitle = b"(?:" + any_of(grammar["separators"]) + rest + b")?"
+    number = lit("第") + any_of(string.digits + grammar["numerals"]) + b"+"
+    headings = [number + any_of(grammar["units"]) + subtitle]
+    if grammar["joined_units"]:
+        headings.insert(0, number + any_of(grammar["joined_units"]) + rest)
+    if grammar["words"]:
+        headings.append(any_of(grammar["words"]) + any_of(" \t") + b"*(?:" + digits + b"+|"
+                        + any_of("IVXLCDM") + b"+(?!" + any_of(string.ascii_letters) + b"))" + subtitle)
+    indent = any_of(" \t　\ufeff") + b"*"
+    line_end = b"(?=(?:" + lit("\r") + b")?" + lit("\n") + rb"|\Z)"
+    return re.compile(lit("\n") + indent + b"((?:" + b"|".join(headings) + b"))" + line_end)
+
+
+# 识别编码时读取的文件开头字节数
+ENCODING_SAMPLE_BYTES = 64 * 1024
+_BOMS = ((codecs.BOM_UTF8, "utf-8"), (codecs.BOM_UTF16_LE, "utf-16-le"), (codecs.BOM_UTF16_BE, "utf-16-be"))
+
+
+def _decodes(sample, encoding):
+    """sample（可能在多字节字符中间截断）能否按 encoding 无错误解码"""
+    try:
+        codecs.getincrementaldecoder(encoding)().decode(sample, final=False)
+        return True
+    except UnicodeDecodeError:
+        return False
+
+
+def detect_encoding(sample):
+    """
+    根据文件开头的一段字节判断编码，返回 (编码, BOM 字节)：
+    先看 BOM；再按 0 字节的分布识别无 BOM 的 UTF-16；能按 UTF-8 解码则为 UTF-8，否则按 GB18030
+    （兼容 GBK、GB2312）。返回的编码用于解码文件中任意一段正文，BOM 只出现在文件开头。
+    """
+    for bom, encoding in _BOMS:
+        if sample.startswith(bom):
+            return encoding, bom
+    if b"\x00" in sample:
+        # UTF-16 文本中的 ASCII 字符（例如换行）有一半字节为 0，小端时落在奇数位置
+        odd_zeros = sample[1::2].count(0)
+        even_zeros = sample[0::2].count(0)
+        encoding = "utf-16-le" if odd_zeros >= even_zeros else "utf-16-be"
+        if _decodes(sample[:len(sample) // 2 * 2], encoding):
+            return encoding, b""
+    if _decodes(sample, "utf-8"):
+        return "utf-8", b""
+    if _decodes(sample, "gb18030"):
+        return "gb18030", b""
+    return "utf-8", b""
+
+
+# 建立索引时每次扫描的窗口大小，以及允许的最长章节标题字节数（窗口之间的重叠量）
+SCAN_WINDOW_BYTES = 8 * 1024 * 1024
+HEADING_MAX_BYTES = 256
+
+
+class Chapter:
+    """NovelIndex 中一章的轻量视图：只保存所属索引与章节序号，标题、偏移与正文都在访问时读取"""
+    __slots__ = ("book", "index")
+
+    def __init__(self, book, index):
+        self.book = book
+        self.index = index
+
+    @property
+    def title(self):
+        return self.book.titles[self.index]
+
+    @property
+    def start(self):
+        return self.book.starts[self.index]
+
+    @property
+    def end(self):
+        return self.book.ends[self.index]
+
+    @property
+    def size(self):
+        """正文的字节数"""
+        return self.end - self.start
+
+    @property
+    def text(self):
+        return self.book.chapter_text(self.index)
+
+    def __repr__(self):
+        return f"Chapter({self.index}, {self.title!r}, {self.start}-{self.end})"
+
+
+class NovelIndex:
+    """
+    基于内存映射的章节索引：
+    - 打开时只扫描一遍文件，记录每章标题以及正文的字节起止偏移（array，每章 16 字节）；
+    - 章节正文不预先复制，调用 chapter_text 时才从映射中切片并解码；
+    - 按下标或迭代得到的是 Chapter 视图，不复制任何正文；
+    - replace_chapter 只重新编码被替换的一章，其余字节直接从映射写出，之后平移偏移而不重新扫描。
+    build=False 时只做映射，由调用方（通常在后台线程中）再调用 build() 分段扫描。
+    encoding 为 None 时根据文件开头识别编码（见 detect_encoding），bom 为文件开头的 BOM 字节。
+    """
+
+    def __init__(self, file_path, encoding=None, build=True, grammar=None):
+        self.file_path = file_path
+        self.encoding = encoding
+        self.bom = b""
+        self.grammar = grammar
+        self.build_seconds = None  # 最近一次完整扫描的耗时，用于计算吞吐量
+        self.titles = []
+        self.starts = array('q')  # 各章正文起始字节偏移
+        self.ends = array('q')    # 各章正文结束字节偏移
+        self.building = False
+        self._close_requested = False
+        self._file = None
+        self._data = b""
+        # replace_chapter 重新映射文件并平移偏移期间，其他线程（搜索索引、摘要）不能读取正文
+        self._lock = threading.RLock()
+        self._map()
+        try:
+            if self.encoding is None:
+                self.encoding, self.bom = detect_encoding(self._data[:ENCODING_SAMPLE_BYTES])
+            elif self._data[:3].startswith(codecs.BOM_UTF8) and codecs.lookup(self.encoding).name == "utf-8":
+                self.bom = codecs.BOM_UTF8
+            # 空白字符（按文件编码），用于判断章节正文是否为空
+            self._blank = re.compile(b"(?:" + b"|".join(re.escape(ch.encode(self.encoding))
+                                                         for ch in " \t\r\n\f\v") + b")*")
+            self._width = len("\n".encode(self.encoding))
+            if build:
+                self.build()
+        except Exception:
+            self.close()
+            raise
+
+    def build(self, on_progress=None, cancel=None):
+        """
+        按窗口分段扫描章节标题，每扫完一个窗口回调 on_progress(已扫描字节, 总字节, 新增标题列表)。
+        cancel 被取消时中止并返回 False，完成时返回 True。
+        """
+        data = self._data
+        size = len(data)
+        regex = build_heading_regex(self.encoding, self.grammar)
+        started = time.perf_counter()
+        self.building = True
+        try:
+            prev_title = None
+            prev_start = pos = len(self.bom)
+            # 正则以换行开头，文件第一行的标题补一个换行后单独匹配
+            newline = "\n".encode(self.encoding)
+            m = regex.match(newline + data[pos:pos + HEADING_MAX_BYTES])
+            if m is not None:
+                prev_title = self._title(m)
+                prev_start = pos = pos + m.end() - len(newline)
+            while pos < size:
+                if cancel is not None and cancel.is_set():
+                    return False
+                reported = len(self.titles)
+                window_end = min(pos + SCAN_WINDOW_BYTES, size)
+                next_pos = window_end
+                # 向后多看 HEADING_MAX_BYTES，保证跨越窗口边界的标题能完整匹配
+                for m in regex.finditer(data, pos, min(window_end + HEADING_MAX_BYTES, size)):
+                    if m.start() >= window_end:
+                        break
+                    if (m.start() - len(self.bom)) % self._width:
+                        continue  # UTF-16 中跨字符错位的匹配
+                    if prev_title is not None:
+                        self._add(prev_title, prev_start, m.start())
+                    prev_title = self._title(m)
+                    prev_start = m.end()
+                    next_pos = max(next_pos, m.end())
+                pos = next_pos
+                if on_progress is not None and pos < size:
+                    on_progress(pos, size, self.titles[reported:])
+            reported = len(self.titles)
+            if prev_title is not None:
+                self._add(prev_title, prev_start, size)
+            else:
+                # 没有识别到任何章节标题时，整本书作为一章
+                self.titles.append("全文")
+                self.starts.append(len(self.bom))
+                self.ends.append(size)
+            self.build_seconds = time.perf_counter() - started
+            if on_progress is not None:
+                on_progress(size, size, self.titles[reported:])
+            return True
+        finally:
+            self.building = False
+            if self._close_requested:
+                self.close()
+
+    def _map(self):
+        self._file = open(self.file_path, 'rb')
+        try:
+            size = os.fstat(self._file.fileno()).st_size
+            # 空文件无法映射，直接用空字节串代替
+            self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        except Exception:
+            self._file.close()
+            self._file = None
+            raise
+
+    def _unmap(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._data = b""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _title(self, m):
+        return m.group(1).decode(self.encoding, errors="replace").strip()
+
+    def _add(self, title, start, end):
+        # 与旧版保持一致：没有正文内容的章节标题不单独成章
+        if self._blank.fullmatch(self._data, start, end) is not None:
+            return
+        self.titles.append(title)
+        self.starts.append(start)
+        self.ends.append(end)
+
+    def __len__(self):
+        return len(self.titles)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.titles)
+        if not 0 <= index < len(self.titles):
+            raise IndexError(index)
+        return Chapter(self, index)
+
+    def __iter__(self):
+        for index in range(len(self.titles)):
+            yield Chapter(self, index)
+
+    @property
+    def size(self):
+        return len(self._data)
+
+    @property
+    def throughput(self):
+        """最近一次扫描的吞吐量（MB/s），尚未扫描完成时为 None"""
+        if not self.build_seconds:
+            return None
+        return self.size / 1024 / 1024 / self.build_seconds
+
+    def raw_bytes(self, start, end):
+        """返回原文件中 [start, end) 的原始字节"""
+        with self._lock:
+            return self._data[start:end]
+
+    def write_range(self, out, start, end):
+        """把原文件中 [start, end) 的字节写入二进制文件对象 out，直接从映射写出，不在内存中复制"""
+        with self._lock, memoryview(self._data) as view, view[start:end] as part:
+            out.write(part)
+
+    def chapter_text(self, index):
+        """按需解码第 index 章的正文（换行统一为 \\n，与按文本模式读取时一致）"""
+        with self._lock:
+            data = self._data[self.starts[index]:self.ends[index]]
+        text = data.decode(self.encoding)
+        if "\r" in text:
+            text = text.replace("\r\n", "\n")
+        return text.strip()
+
+    def replace_chapter(self, index, text):
+        """
+        把第 index 章的正文替换为 text 并写回原文件，返回文件字节数的变化：
+        新内容先完整写入同目录的临时文件（只有这一章重新编码，其余字节直接从映射写出，
+        内存占用与书的大小无关），落盘并沿用原文件的权限后再原子地替换原文件，中途断电或出错时原文件不受影响；
+        之后重新映射，后续章节的偏移整体平移，标题表不变，不重新扫描。
+        text 中即使含有形似章节标题的行，也要到下次加载时才会被拆成新章节。
+        """
+        if self.building:
+            raise RuntimeError("章节索引尚未建立完成")
+        tmp_path = self.file_path + ".tmp"
+        with self._lock:
+            try:
+                with open(tmp_path, 'wb') as out:
+                    write_book(self, out, [(index, text)])
+                    out.flush()
+                    os.fsync(out.fileno())
+                shutil.copymode(self.file_path, tmp_path)
+                delta = os.path.getsize(tmp_path) - self.size
+                # 先释放映射再替换（Windows 下被映射的文件无法替换）
+                self._unmap()
+                try:
+                    os.replace(tmp_path, self.file_path)
+                finally:
+                    self._map()
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+            if delta:
+                self.ends[index] += delta
+                tail = index + 1
+                self.starts[tail:] = array('q', [s + delta for s in self.starts[tail:]])
+                self.ends[tail:] = array('q', [e + delta for e in self.ends[tail:]])
+        return delta
+
+    def close(self):
+        """释放映射（Windows 下映射未释放时无法覆盖写入原文件）；正在扫描时推迟到扫描结束后释放"""
+        if self.building:
+            self._close_requested = True
+            return
+        with self._lock:
+            self._unmap()
+
+
+# --------------- 全文搜索（二元组索引） ---------------
+SEARCH_BLOCK_CHARS = 65536  # 相邻章节合并为约这么多字的块，块内的二元组去重后保存
+SEARCH_MAX_HITS = 1000
+
+
+def bigram_keys(text):
+    """
+    text 中相邻两个字符组成的二元组，按 UTF-16 码元编码为 32 位整数（前一码元 << 16 | 后一码元）。
+    全部由 C 实现的迭代完成，不逐字执行 Python 代码。
+    """
+    units = array('H', text.encode('utf-16-le'))
+    return map(operator.or_, map(operator.lshift, units, itertools.repeat(16)), units[1:])
+
+
+class SearchIndex:
+    """
+    全书搜索索引：相邻章节按约 SEARCH_BLOCK_CHARS 字合并为块，每块保存其中出现过的全部二元组
+    （升序 array('I')，每个 4 字节）。搜索时只在含有查询中全部二元组的块里逐章定位，
+    因此结果总是准确的，索引只负责跳过不可能命中的块。
+    text_of(i) 返回第 i 章当前的正文（含修订）。build() 在后台线程中逐块建立索引，尚未建立索引的章节
+    在搜索时直接查看正文；章节修改后调用 update() 重新计算其所在的块。
+    """
+
+    def __init__(self, chapter_count, text_of):
+        self.chapter_count = chapter_count
+        self.text_of = text_of
+        self.build_seconds = None
+        self._blocks = []  # 每块的二元组
+        self._block_starts = array('I')  # 每块第一章的序号
+        self._indexed = 0  # 已完成的块覆盖的章节数
+        self._pending = set()  # 正在建立的块中已读取章节的二元组
+        self._next = 0  # 下一个要读取的章节
+        self._lock = threading.Lock()
+
+    @property
+    def indexed(self):
+        """已建立索引的章节数"""
+        return self._indexed
+
+    def build(self, on_progress=None, cancel=None):
+        """逐章建立索引，每完成一块回调 on_progress(已完成章数, 总章数)；被取消时返回 False"""
+        started = time.perf_counter()
+        chars = 0
+        while self._next < self.chapter_count:
+            if cancel is not None and cancel.is_set():
+                return False
+            # 读取正文与登记都在锁内完成，保证与 update() 不会交错
+            with self._lock:
+                text = self.text_of(self._next)
+                self._pending.update(bigram_keys(text))
+                self._next += 1
+                chars += len(text)
+                if chars < SEARCH_BLOCK_CHARS and self._next < self.chapter_count:
+                    continue
+                self._blocks.append(array('I', sorted(self._pending)))
+                self._block_starts.append(self._indexed)
+                self._indexed = self._next
+                self._pending = set()
+            chars = 0
+            if on_progress is not None:
+                on_progress(self._indexed, self.chapter_count)
+        self.build_seconds = time.perf_counter() - started
+        return True
+
+    def _block_range(self, block):
+        first = self._block_starts[block]
+        last = self._block_starts[block + 1] if block + 1 < len(self._blocks) else self._indexed
+        return first, last
+
+    def update(self, index):
+        """第 index 章的正文修改后调用"""
+        with self._lock:
+            if index < self._indexed:
+                block = bisect.bisect_right(self._block_starts, index) - 1
+                keys = set()
+                for i in range(*self._block_range(block)):
+                    keys.update(bigram_keys(self.text_of(i)))
+                self._blocks[block] = array('I', sorted(keys))
+            elif index < self._next:
+                # 正在建立的块：旧正文的二元组留着只会多出候选，不影响结果
+                self._pending.update(bigram_keys(self.text_of(index)))
+
+    def candidates(self, query):
+        """可能含有 query 的章节序号（升序）"""
+        keys = set(bigram_keys(query))
+        result = []
+        with self._lock:
+            for block, present in enumerate(self._blocks):
+                for key in keys:
+                    pos = bisect.bisect_left(present, key)
+                    if pos == len(present) or present[pos] != key:
+                        break
+                else:
+                    result.extend(range(*self._block_range(block)))
+            result.extend(range(self._indexed, self.chapter_count))
+        return result
+
+    def search(self, query, max_hits=SEARCH_MAX_HITS, cancel=None):
+        """返回 query 出现的位置 [(章节序号, 章内偏移), ...]，按章节与偏移排序，最多 max_hits 个"""
+        hits = []
+        if not query:
+            return hits
+        for i in self.candidates(query):
+            if cancel is not None and cancel.is_set():
+                break
+            text = self.text_of(i)
+            pos = text.find(query)
+            while pos >= 0:
+                hits.append((i, pos))
+                if len(hits) >= max_hits:
+                    return hits
+                pos = text.find(query, pos + len(query))
+        return hits
+
+
+# --------------- 大模型接口调用（与界面无关，可在工作线程中使用） ---------------
+NO_CONTENT_TEXT = "（未获取到内容）"
+
+
+class ApiError(Exception):
+    """调用大模型接口失败，消息可直接展示给用户"""
+
+
+class RequestCancelled(ApiError):
+    """请求被用户取消"""
+
+    def __init__(self, message="请求已取消"):
+        super().__init__(message)
+
+
+class CancelToken:
+    """
+    可在任意线程调用 cancel() 的取消标记。
+    请求进行中可以登记关闭回调（例如关闭响应），取消时立即执行以打断阻塞的读取。
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+
+    def is_set(self):
+        return self._event.is_set()
+
+    def wait(self, timeout):
+        """最多等待 timeout 秒，期间被取消则返回 True"""
+        return self._event.wait(timeout)
+
+    def add_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+
+
+def extract_choice_text(choice):
+    """从 choices[0] 中取出文本（兼容 delta / message 两种格式）"""
+    if "delta" in choice and "content" in choice["delta"]:
+        return choice["delta"]["content"] or ""
+    if "message" in choice and "content" in choice["message"]:
+        return choice["message"]["content"] or ""
+    return ""
+
+
+# 以下状态码视为临时错误，退避后重试
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+RETRY_AFTER_MAX = 120.0  # Retry-After 最多等待的秒数
+
+
+class ApiStats:
+    """客户端计数器：请求数、新建连接数、重试次数（线程安全）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+        self.retries = 0
+
+    def add(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    @property
+    def reused_connections(self):
+        return max(self.requests - self.new_connections, 0)
+
+    def summary(self):
+        return (f"请求 {self.requests}  新建连接 {self.new_connections}  "
+                f"复用连接 {self.reused_connections}  重试 {self.retries}")
+
+
+# 当前线程最近一次请求中建立连接所用的秒数（复用连接时为 0），供遥测使用
+_connect_timing = threading.local()
+
+
+class _CountingAdapter(requests.adapters.HTTPAdapter):
+    """在连接池新建连接时计数，用于统计连接复用情况；同时记录建立连接（含 TLS 握手）的耗时"""
+
+    def __init__(self, stats, **kwargs):
+        self._stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        stats = self._stats
+        pool_classes = {}
+        for scheme, pool_class in self.poolmanager.pool_classes_by_scheme.items():
+            class CountingPool(pool_class):
+                def _new_conn(self):
+                    stats.add("new_connections")
+                    conn = super()._new_conn()
+                    connect = conn.connect
+
+                    def timed_connect():
+                        started = time.monotonic()
+                        try:
+                            return connect()
+                        finally:
+                            _connect_timing.seconds = (getattr(_connect_timing, "seconds", 0.0)
+                                                       + time.monotonic() - started)
+                    conn.connect = timed_connect
+                    return conn
+            pool_classes[scheme] = CountingPool
+        self.poolmanager.pool_classes_by_scheme = pool_classes
+
+
+# 限流：模型配置中的 rpm（每分钟请求数）、tpm（每分钟 token 数）为服务商配额，0 表示不限制；
+# 同时进行的请求数在 1～max_concurrency 之间按 AIMD 自适应调整
+DEFAULT_MAX_CONCURRENCY = 8
+LATENCY_SPIKE_FACTOR = 3.0  # 响应延迟超过平均延迟的倍数时视为拥塞
+AIMD_DECREASE_INTERVAL = 1.0  # 两次减半之间至少间隔的秒数（同一波 429 只减半一次）
+
+
+class TokenBucket:
+    """
+    容量与每分钟补充量均为 per_minute 的令牌桶，per_minute <= 0 表示不限制。
+    本身不加锁，由 RateLimiter 在锁内使用。
+    """
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def wait_time(self, amount, now):
+        """还需等待多少秒才能取出 amount 个令牌（超过容量时按容量计）"""
+        if self.capacity <= 0:
+            return 0.0
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+        amount = min(amount, self.capacity)
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) * 60.0 / self.capacity
+
+    def take(self, amount):
+        # 允许扣成负数：事后按实际用量补扣时，后续请求相应多等一会儿
+        if self.capacity > 0:
+            self.level -= amount
+
+
+def _wake_waiter(waiter):
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class RateLimiter:
+    """
+    单个模型配置的限流器，由使用该配置的所有请求共享：
+    - acquire(tokens) 等待并发名额与 tpm 配额，release(estimated, used) 归还名额并按实际用量补扣；
+    - 每次发出 HTTP 请求（含重试）前 before_request() 扣除一次 rpm 配额；
+    - on_throttled()（429）与 on_response(latency) 按 AIMD 调整并发上限：
+      拥塞时减半，正常完成时每轮约加 1。
+    """
+
+    def __init__(self, config):
+        self.max_concurrency = max(1, int(config.get("max_concurrency") or DEFAULT_MAX_CONCURRENCY))
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.throttled = 0
+        self._requests = TokenBucket(float(config.get("rpm") or 0))
+        self._tokens = TokenBucket(float(config.get("tpm") or 0))
+        self._latency = None
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = collections.deque()  # 在事件循环中排队等待名额的 [loop, Future, 仍在排队]
+
+    def _wait(self, delay_of, cancel):
+        """
+        在锁内等待，直到 delay_of() 返回的剩余等待秒数为 0；期间被取消则抛出 RequestCancelled。
+        按剩余时间整段等待，名额或配额提前归还时由 release / on_response 的 notify 唤醒，取消时由回调唤醒。
+        """
+        def wake():
+            with self._cond:
+                self._cond.notify_all()
+        if cancel is not None:
+            cancel.add_callback(wake)
+        try:
+            while True:
+                delay = delay_of()
+                if delay <= 0:
+                    return
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled()
+                self._cond.wait(None if delay == math.inf else delay)
+        finally:
+            if cancel is not None:
+                cancel.remove_callback(wake)
+
+    def acquire(self, tokens=0, cancel=None):
+        def delay_of():
+            if self.in_flight >= int(self.limit):
+                return math.inf
+            return self._tokens.wait_time(tokens, time.monotonic())
+        with self._cond:
+            self._wait(delay_of, cancel)
+            self._tokens.take(tokens)
+            self.in_flight += 1
+
+    async def _wait_async(self, delay_of, take, cancel):
+        """_wait 的协程版本：不持锁等待（名额释放时被唤醒），条件满足时在锁内执行 take()"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._cond:
+                delay = delay_of()
+                if delay <= 0:
+                    take()
+                    return
+                entry = [loop, loop.create_future(), True]
+                self._async_waiters.append(entry)
+            woken = False
+            try:
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled()
+                # 只等名额时靠 release 唤醒，超时仅用于检查 cancel；等 tpm / rpm 配额时按剩余时间醒来
+                await asyncio.wait_for(entry[1], 1.0 if delay == math.inf else min(delay, 1.0))
+                woken = True
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                with self._cond:
+                    if entry[2]:
+                        entry[2] = False  # 放弃排队，由 _notify_async 跳过
+                    elif not woken:
+                        self._notify_async()  # 已被选中却不再等待（取消或恰好超时），把名额让给下一个
+
+    def _notify_async(self):
+        """唤醒最早排队的一个协程（每次只释放一个名额，避免惊群）；调用方持有 self._cond"""
+        while self._async_waiters:
+            entry = self._async_waiters.popleft()
+            if entry[2]:
+                entry[2] = False
+                entry[0].call_soon_threadsafe(_wake_waiter, entry[1])
+                return
+
+    async def acquire_async(self, tokens=0, cancel=None):
+        """acquire 的协程版本（在事件循环中等待，不占用线程）"""
+        def delay_of():
+            if self.in_flight >= int(self.limit):
+                return math.inf
+            return self._tokens.wait_time(tokens, time.monotonic())
+
+        def take():
+            self._tokens.take(tokens)
+            self.in_flight += 1
+        await self._wait_async(delay_of, take, cancel)
+
+    async def before_request_async(self, cancel=None):
+        await self._wait_async(lambda: self._requests.wait_time(1, time.monotonic()),
+                               lambda: self._requests.take(1), cancel)
+
+    def release(self, estimated=0, used=None):
+        with self._cond:
+            self.in_flight -= 1
+            if used is not None:
+                self._tokens.take(used - estimated)
+            self._cond.notify_all()
+            self._notify_async()
+
+    def before_request(self, cancel=None):
+        with self._cond:
+            self._wait(lambda: self._requests.wait_time(1, time.monotonic()), cancel)
+            self._requests.take(1)
+
+    def on_throttled(self):
+        with self._cond:
+            self.throttled += 1
+            self._decrease()
+
+    def on_response(self, latency):
+        """收到 200 响应：延迟突增视为拥塞，否则加性增长"""
+        with self._cond:
+            if self._latency is not None and latency > LATENCY_SPIKE_FACTOR * self._latency:
+                self._decrease()
+            else:
+                self.limit = min(float(self.max_concurrency), self.limit + 1.0 / self.limit)
+            self._latency = latency if self._latency is None else self._latency * 0.8 + latency * 0.2
+            self._cond.notify_all()
+            self._notify_async()
+
+    def _decrease(self):
+        now = time.monotonic()
+        if now - self._last_decrease >= AIMD_DECREASE_INTERVAL:
+            self.limit = max(1.0, self.limit / 2)
+            self._last_decrease = now
+
+    def summary(self):
+        return f"并发上限 {int(self.limit)}/{self.max_concurrency}  被限流 {self.throttled}"
+
+
+class _RetryPolicy:
+    """ApiClient 与 AsyncApiClient 共用的超时与退避重试参数"""
+
+    def __init__(self, config):
+        self.connect_timeout = float(config.get("connect_timeout", 10))
+        self.read_timeout = float(config.get("read_timeout", 120))
+        self.max_retries = int(config.get("max_retries", 3))
+        self.backoff_base = float(config.get("backoff_base", 1.0))
+        self.backoff_max = float(config.get("backoff_max", 30.0))
+
+    def backoff_delay(self, attempt, retry_after=None):
+        """第 attempt 次重试前的等待秒数"""
+        delay = min(self.backoff_max, self.backoff_base * (2 ** attempt)) * random.uniform(0.5, 1.0)
+        wait = parse_retry_after(retry_after)
+        if wait is not None:
+            delay = max(delay, min(wait, RETRY_AFTER_MAX))
+        return delay
+
+
+class ApiClient(_RetryPolicy):
+    """
+    单个模型配置对应的长连接客户端：
+    - 复用同一个 Session 的连接池（keep-alive），连接超时与读取超时分开设置；
+    - 连接失败、429 与 5xx 时按带随机抖动的指数退避重试，优先遵循 Retry-After；
+    - 请求经过 limiter（RateLimiter）限速并自适应调整并发。
+    """
+
+    def __init__(self, config, limiter=None):
+        super().__init__(config)
+        self.stats = ApiStats()
+        self.limiter = limiter or RateLimiter(config)
+        self.session = requests.Session()
+        pool_size = int(config.get("pool_size", 16))
+        adapter = _CountingAdapter(self.stats, pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def post(self, url, headers, payload, stream=False, cancel=None, metrics=None):
+        """
+        发送请求并返回状态码为 200 的响应，重试耗尽后抛出 ApiError，被取消时抛出 RequestCancelled。
+        metrics 为 dict 时写入 retries（重试次数）、status（最后一次的 HTTP 状态码）与 connect_s（建连耗时）。
+        """
+        attempt = 0
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled()
+            self.limiter.before_request(cancel)
+            self.stats.add("requests")
+            sent = time.monotonic()
+            _connect_timing.seconds = 0.0
+            try:
+                response = self.session.post(url, headers=headers, json=payload, stream=stream,
+                                             timeout=(self.connect_timeout, self.read_timeout))
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if metrics is not None:
+                    metrics["retries"] = attempt
+                    metrics["status"] = None
+                    metrics["connect_s"] = metrics.get("connect_s", 0.0) + _connect_timing.seconds
+                if attempt >= self.max_retries:
+                    raise ApiError(f"调用接口出错：{str(e)}") from e
+                delay = self.backoff_delay(attempt)
+            else:
+                if metrics is not None:
+                    metrics["retries"] = attempt
+                    metrics["status"] = response.status_code
+                    metrics["connect_s"] = metrics.get("connect_s", 0.0) + _connect_timing.seconds
+                if response.status_code == 200:
+                    self.limiter.on_response(time.monotonic() - sent)
+                    return response
+                if response.status_code == 429:
+                    self.limiter.on_throttled()
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    message = f"HTTP错误：{response.status_code}\n{response.text}"
+                    response.close()
+                    raise ApiError(message)
+                delay = self.backoff_delay(attempt, response.headers.get("Retry-After"))
+                response.close()
+            attempt += 1
+            self.stats.add("retries")
+            if cancel is not None:
+                if cancel.wait(delay):
+                    raise RequestCancelled()
+            else:
+                time.sleep(delay)
+
+    def summary(self):
+        return f"{self.stats.summary()}  {self.limiter.summary()}"
+
+    def close(self):
+        self.session.close()
+
+
+def parse_retry_after(value):
+    """解析 Retry-After（秒数或 HTTP 日期），无法解析时返回 None"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when is None:
+        return None
+    return max(when.timestamp() - time.time(), 0.0)
+
+
+class SSEDecoder:
+    """
+    增量式 SSE 解码器：按字节缓冲网络数据，只在遇到完整的行和事件边界（空行）时才解析，
+    因此被拆分到多个网络分块中的 data: 行或多字节字符都能正确还原。
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._data_lines = []
+
+    def feed(self, chunk):
+        """喂入一段字节，返回本次解析出的完整事件的 data 文本列表"""
+        events = []
+        if not chunk:
+            return events
+        self._buffer += chunk
+        start = 0
+        while True:
+            end = self._buffer.find(b"\n", start)
+            if end == -1:
+                break
+            line = bytes(self._buffer[start:end]).rstrip(b"\r")
+            start = end + 1
+            self._handle_line(line, events)
+        del self._buffer[:start]
+        return events
+
+    def close(self):
+        """数据流结束：处理残留的最后一行以及没有以空行结尾的事件"""
+        events = []
+        if self._buffer:
+            self._handle_line(bytes(self._buffer).rstrip(b"\r"), events)
+            self._buffer.clear()
+        self._dispatch(events)
+        return events
+
+    def _handle_line(self, line, events):
+        if not line:
+            self._dispatch(events)
+            return
+        if line.startswith(b":"):
+            return  # 注释行（常用于心跳）
+        field, _, value = line.partition(b":")
+        if field == b"data":
+            if value.startswith(b" "):
+                value = value[1:]
+            self._data_lines.append(value)
+
+    def _dispatch(self, events):
+        if self._data_lines:
+            events.append(b"\n".join(self._data_lines).decode("utf-8", errors="replace"))
+            self._data_lines = []
+
+
+def iter_sse_payloads(data):
+    """把一个事件的 data 解析为 JSON 对象；兼容把多条 JSON 放在同一事件中逐行发送的服务端"""
+    data = data.strip()
+    if not data or data == "[DONE]":
+        return
+    try:
+        yield json.loads(data)
+        return
+    except json.JSONDecodeError:
+        pass
+    for line in data.split("\n"):
+        line = line.strip()
+        if line.startswith("data:"):
+            line = line[len("data:"):].strip()
+        if not line or line == "[DONE]":
+            continue
+        try:
+            yield json.loads(line)
+        except json.JSONDecodeError:
+            pass
+
+
+class TokenCoalescer:
+    """
+    把高频的逐 token 回调合并为最多每 interval 秒一次的批量回调，避免刷爆 Tk 事件队列。
+    暂存的文本在窗口结束时由定时器补发，生成停顿时已收到的文本也能及时显示。
+    """
+
+    def __init__(self, emit, interval=0.05):
+        self.emit = emit
+        self.interval = interval
+        self.tokens = 0         # 已收到的 token（回调）次数
+        self.first_at = None    # 首个 token 到达时间（time.monotonic）
+        self._pending = []
+        self._last = 0.0
+        self._timer = None
+        self._lock = threading.Lock()   # 调用线程与补发定时器都会 flush
+
+    def __call__(self, text):
+        with self._lock:
+            now = time.monotonic()
+            if self.first_at is None:
+                self.first_at = now
+            self.tokens += 1
+            self._pending.append(text)
+            wait = self._last + self.interval - now
+            if wait <= 0:
+                self._flush_locked(now)
+            elif self._timer is None:
+                self._timer = threading.Timer(wait, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            self._flush_locked(time.monotonic())
+
+    def _flush_locked(self, now):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._pending:
+            text = "".join(self._pending)
+            self._pending = []
+            self._last = now
+            # 持锁调用 emit，保证各批文本按顺序交出
+            self.emit(text)
+
+
+def abort_response(response):
+    """从其他线程中止流式响应：先关闭套接字读写以唤醒阻塞的 recv，再关闭响应"""
+    sock = None
+    try:
+        sock = response.raw._connection.sock
+    except AttributeError:
+        try:
+            sock = response.raw._fp.fp.raw._sock
+        except AttributeError:
+            pass
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+def request_completion(config, prompt, on_token=None, client=None, cancel=None, metrics=None):
+    """
+    按模型配置调用 OpenAI 兼容接口并返回完整文本，失败时抛出 ApiError。
+    on_token 为流式模式下每收到一段文本时的回调（在调用线程中执行）。
+    client 为该模型配置的长连接客户端；不传时临时创建一个。
+    cancel 为 CancelToken，取消后关闭响应并抛出 RequestCancelled。
+    metrics 为 dict 时写入本次请求的计时与计数（见 TelemetryStore.record）。
+    """
+    if not config.get("api_key"):
+        raise ApiError("请先在【配置模型】中设置 API Key。")
+    if client is None:
+        client = ApiClient(config)
+        try:
+            return request_completion(config, prompt, on_token, client, cancel, metrics)
+        finally:
+            client.close()
+    # 按“输入 + 预计输出”预扣 tpm 配额，完成后按实际字数补扣
+    estimated = estimate_tokens(prompt, config)
+    estimated += int(estimated * float(config.get("output_ratio", DEFAULT_OUTPUT_RATIO)))
+    queued = time.monotonic()
+    client.limiter.acquire(estimated, cancel)
+    if metrics is not None:
+        metrics["wait_s"] = time.monotonic() - queued
+    used = None
+    try:
+        result = _post_completion(config, prompt, on_token, client, cancel, metrics)
+        used = estimate_tokens(prompt + result, config)
+        return result
+    finally:
+        client.limiter.release(estimated, used)
+
+
+def _completion_request(config, prompt):
+    """按模型配置构造对话补全请求的 (url, headers, payload)"""
+    payload = {
+        "model": config.get("model", ""),
+        "messages": [
+            {"content": prompt, "role": "user", "name": "用户"}
+        ],
+        "stream": config.get("stream", True)
+    }
+    if config.get("max_output_tokens"):
+        payload["max_tokens"] = int(config["max_output_tokens"])
+    headers = {
+        "Authorization": f"Bearer {config.get('api_key')}",
+        "Content-Type": "application/json"
+    }
+    return config.get("url", ""), headers, payload
+
+
+class _CompletionCollector:
+    """把流式事件或非流式响应解析为文本，同时在 metrics 中记录首字时间（ttft_s）与接口返回的输出 token 数"""
+
+    def __init__(self, on_token, metrics):
+        self.on_token = on_token
+        self.metrics = metrics
+        self.parts = []
+        self.started = time.monotonic()
+
+    def _usage(self, payload):
+        usage = payload.get("usage")
+        if isinstance(usage, dict) and usage.get("completion_tokens"):
+            self.metrics["tokens"] = usage["completion_tokens"]
+
+    def event(self, data):
+        """处理一个 SSE 事件的 data"""
+        for payload in iter_sse_payloads(data):
+            self._usage(payload)
+            if "choices" in payload and len(payload["choices"]) > 0:
+                chunk_text = extract_choice_text(payload["choices"][0])
+                if chunk_text:
+                    if not self.parts:
+                        self.metrics["ttft_s"] = time.monotonic() - self.started
+                    self.parts.append(chunk_text)
+                    if self.on_token is not None:
+                        self.on_token(chunk_text)
+
+    def text(self):
+        return "".join(self.parts)
+
+    def message(self, data):
+        """非流式响应：整段文本一次到达，首字时间即为收到完整响应的时间"""
+        self.metrics["ttft_s"] = time.monotonic() - self.started
+        self._usage(data)
+        if "choices" in data and len(data["choices"]) > 0:
+            choice = data["choices"][0]
+            if "message" in choice and "content" in choice["message"]:
+                return choice["message"]["content"]
+            elif "delta" in choice and "content" in choice["delta"]:
+                return choice["delta"]["content"]
+        return NO_CONTENT_TEXT
+
+
+def _post_completion(config, prompt, on_token, client, cancel, metrics=None):
+    """发送一次对话补全请求（含重试）并返回完整文本"""
+    url, headers, payload = _completion_request(config, prompt)
+    collector = _CompletionCollector(on_token, {} if metrics is None else metrics)
+    try:
+        if config.get("stream", True):
+            response = client.post(url, headers, payload, stream=True, cancel=cancel, metrics=metrics)
+            if cancel is not None and cancel.is_set():
+                # 在等待响应头时被取消：此时还没有登记关闭回调，直接放弃这个响应
+                response.close()
+                raise RequestCancelled()
+            decoder = SSEDecoder()
+            abort = lambda: abort_response(response)
+            if cancel is not None:
+                # 取消时直接关闭底层连接，阻塞中的读取会立即出错返回
+                cancel.add_callback(abort)
+            try:
+                with response:
+                    for chunk in response.iter_content(chunk_size=None):
+                        if cancel is not None and cancel.is_set():
+                            raise RequestCancelled()
+                        for data in decoder.feed(chunk):
+                            collector.event(data)
+                    for data in decoder.close():
+                        collector.event(data)
+            finally:
+                if cancel is not None:
+                    cancel.remove_callback(abort)
+            if cancel is not None and cancel.is_set():
+                # 取消时关闭连接会让读取循环悄悄结束，已收到的部分不能当作完整结果返回
+                raise RequestCancelled()
+            return collector.text()
+        else:
+            response = client.post(url, headers, payload, cancel=cancel, metrics=metrics)
+            with response:
+                data = response.json()
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled()
+            return collector.message(data)
+    except ApiError:
+        raise
+    except Exception as e:
+        if cancel is not None and cancel.is_set():
+            raise RequestCancelled() from e
+        raise ApiError(f"调用接口出错：{str(e)}") from e
+
+
+# --------------- 异步请求（一个后台事件循环承载全部请求，可随时中止） ---------------
+# 标准库没有异步 HTTP 客户端，这里实现对话补全所需的 HTTP/1.1 子集：
+# keep-alive 连接池、Content-Length / chunked / 读到连接关闭三种响应体。不支持代理，
+# 因此设置了系统代理时默认仍使用 requests（见 use_async_http）。
+
+
+def use_async_http(config):
+    """该模型配置是否走异步请求：配置项 async_http 优先，未设置时在没有系统代理的情况下使用"""
+    value = config.get("async_http")
+    if value is None:
+        return not urllib.request.getproxies()
+    return bool(value)
+
+
+async def _cancellable(coro):
+    # 协程内部把 CancelledError 转成了 RequestCancelled；这里转回去，使 Future 处于 cancelled 状态，
+    # 否则 Future 先被 cancel() 时协程的异常无人读取，事件循环会打印警告
+    try:
+        return await coro
+    except RequestCancelled:
+        raise asyncio.CancelledError()
+
+
+async def _in_executor(func, *args):
+    # 阻塞调用（SQLite 读写等）交给默认线程池，不阻塞事件循环；
+    # 解释器退出时（如 Ctrl+C 后被取消的请求仍在收尾）线程池已不接受任务，此时直接执行
+    loop = asyncio.get_running_loop()
+    try:
+        future = loop.run_in_executor(None, func, *args)
+    except RuntimeError:
+        return func(*args)
+    return await future
+
+
+class AsyncRunner:
+    """在一个后台线程中运行 asyncio 事件循环，其他线程（包括 Tk 主线程）通过 submit() 提交协程"""
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name="asyncio", daemon=True)
+        self._thread.start()
+
+    def submit(self, coro, cancel=None):
+        """
+        提交协程并返回 concurrent.futures.Future。调用 Future.cancel() 或 cancel（CancelToken）被取消时
+        立即取消该协程，协程中进行的请求随之关闭连接，Future 处于 cancelled 状态。
+        """
+        future = asyncio.run_coroutine_threadsafe(_cancellable(coro), self.loop)
+        if cancel is not None:
+            abort = future.cancel
+            cancel.add_callback(abort)
+            future.add_done_callback(lambda f: cancel.remove_callback(abort))
+        return future
+
+    def run(self, coro, cancel=None):
+        """提交协程并在当前线程等待结果（不可在事件循环线程中调用），被取消时抛出 RequestCancelled"""
+        try:
+            return self.submit(coro, cancel).result()
+        except concurrent.futures.CancelledError:
+            raise RequestCancelled()
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout=5)
+
+
+class _AsyncConnection:
+    def __init__(self, key, reader, writer):
+        self.key = key
+        self.reader = reader
+        self.writer = writer
+
+    def abort(self):
+        """立即关闭连接（不等待未发送完的数据），套接字马上释放"""
+        self.writer.transport.abort()
+
+
+class AsyncResponse:
+    """异步 HTTP 响应；响应体读完且服务端允许 keep-alive 时连接归还连接池，否则关闭"""
+
+    def __init__(self, pool, conn, status_code, headers, read_timeout, connect_s=0.0):
+        self.status_code = status_code
+        self.headers = headers  # 键为小写
+        self.connect_s = connect_s  # 建立新连接所用的秒数，复用连接时为 0
+        self._pool = pool
+        self._conn = conn
+        self._read_timeout = read_timeout
+        self._complete = False
+        self._keep_alive = headers.get("connection", "").lower() != "close"
+
+    async def _read(self, coro):
+        return await asyncio.wait_for(coro, self._read_timeout)
+
+    async def iter_chunks(self):
+        """逐块产出响应体；读取超时抛出 asyncio.TimeoutError"""
+        reader = self._conn.reader
+        try:
+            if "chunked" in self.headers.get("transfer-encoding", "").lower():
+                # 每次读取能拿到的全部字节再在缓冲区中拆块：流式回复的每个 SSE 事件通常单独成块，
+                # 逐块 readuntil / readexactly 会让每个 token 多出两次带超时的等待
+                buffer = b""
+                while True:
+                    pieces = []
+                    pos = 0
+                    while True:
+                        line_end = buffer.find(b"\r\n", pos)
+                        if line_end < 0:
+                            break
+                        size = int(buffer[pos:line_end].split(b";", 1)[0].strip(), 16)
+                        if size == 0:
+                            # 最后一块之后是可选的 trailer 与一个空行
+                            if buffer.find(b"\r\n\r\n", line_end) < 0:
+                                break
+                            if pieces:
+                                yield b"".join(pieces)
+                            self._complete = True
+                            return
+                        end = line_end + 2 + size
+                        if len(buffer) < end + 2:
+                            break
+                        pieces.append(buffer[line_end + 2:end])
+                        pos = end + 2
+                    buffer = buffer[pos:]
+                    if pieces:
+                        yield b"".join(pieces)
+                    data = await self._read(reader.read(65536))
+                    if not data:
+                        raise ConnectionError("连接在响应体结束前被关闭")
+                    buffer += data
+            elif "content-length" in self.headers:
+                remaining = int(self.headers["content-length"])
+                while remaining > 0:
+                    data = await self._read(reader.read(min(remaining, 65536)))
+                    if not data:
+                        raise ConnectionError("连接在响应体结束前被关闭")
+                    remaining -= len(data)
+                    yield data
+            else:
+                self._keep_alive = False
+                while True:
+                    data = await self._read(reader.read(65536))
+                    if not data:
+                        break
+                    yield data
+            self._complete = True
+        finally:
+            self.close()
+
+    async def read(self):
+        return b"".join([chunk async for chunk in self.iter_chunks()])
+
+    def close(self):
+        if self._conn is None:
+            return
+        if self._complete and self._keep_alive:
+            self._pool.release(self._conn)
+        else:
+            self._conn.abort()
+        self._conn = None
+
+
+class AsyncConnectionPool:
+    """按 (协议, 主机, 端口) 复用 keep-alive 连接，只在事件循环线程中使用"""
+
+    def __init__(self, stats, connect_timeout, read_timeout, max_idle=16):
+        self.stats = stats
+        self.max_idle = max_idle  # 每个主机保留的空闲连接数
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = collections.defaultdict(list)
+        self._ssl = None
+
+    async def _connect(self, key):
+        scheme, host, port = key
+        ssl_context = None
+        if scheme == "https":
+            if self._ssl is None:
+                self._ssl = ssl.create_default_context()
+            ssl_context = self._ssl
+        self.stats.add("new_connections")
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=ssl_context, server_hostname=host if ssl_context else None,
+                                    limit=1 << 20),
+            self.connect_timeout)
+        return _AsyncConnection(key, reader, writer)
+
+    def release(self, conn):
+        idle = self._idle[conn.key]
+        if len(idle) < self.max_idle and not conn.writer.transport.is_closing():
+            idle.append(conn)
+        else:
+            conn.abort()
+
+    async def request(self, method, url, headers, body=b""):
+        """发送请求并读完响应头，返回 AsyncResponse；连接或读取失败抛出 OSError / asyncio.TimeoutError"""
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        if scheme not in ("http", "https"):
+            raise ValueError(f"不支持的 URL：{url}")
+        port = parts.port or (443 if scheme == "https" else 80)
+        key = (scheme, parts.hostname, port)
+        target = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        host = parts.hostname if parts.port is None else f"{parts.hostname}:{parts.port}"
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {host}", f"Content-Length: {len(body)}",
+                 "Connection: keep-alive", "Accept-Encoding: identity"]
+        lines.extend(f"{name}: {value}" for name, value in headers.items())
+        data = ("\r\n".join(lines) + "\r\n\r\n").encode("utf-8") + body
+        while True:
+            idle = self._idle[key]
+            reused = bool(idle)
+            connect_s = 0.0
+            if reused:
+                conn = idle.pop()
+            else:
+                started = time.monotonic()
+                conn = await self._connect(key)
+                connect_s = time.monotonic() - started
+            try:
+                conn.writer.write(data)
+                await asyncio.wait_for(conn.writer.drain(), self.read_timeout)
+                head = await asyncio.wait_for(conn.reader.readuntil(b"\r\n\r\n"), self.read_timeout)
+            except (asyncio.IncompleteReadError, ConnectionError):
+                conn.abort()
+                if reused:
+                    continue  # 空闲连接已被服务端关闭，换新连接重发
+                raise
+            except BaseException:
+                conn.abort()
+                raise
+            status_line, *header_lines = head.decode("latin-1").split("\r\n")
+            status_code = int(status_line.split(" ", 2)[1])
+            response_headers = {}
+            for line in header_lines:
+                name, sep, value = line.partition(":")
+                if sep:
+                    name = name.strip().lower()
+                    value = value.strip()
+                    response_headers[name] = (response_headers[name] + ", " + value
+                                              if name in response_headers else value)
+            return AsyncResponse(self, conn, status_code, response_headers, self.read_timeout, connect_s)
+
+    def close(self):
+        for idle in self._idle.values():
+            for conn in idle:
+                conn.abort()
+        self._idle.clear()
+
+
+class AsyncApiClient(_RetryPolicy):
+    """
+    ApiClient 的异步版本：同样的超时、退避重试与限流（limiter 可与同一配置的 ApiClient 共用），
+    全部请求在一个事件循环中进行，取消时立即关闭连接。只能在 AsyncRunner 的事件循环中使用。
+    """
+
+    def __init__(self, config, limiter=None):
+        super().__init__(config)
+        self.stats = ApiStats()
+        self.limiter = limiter or RateLimiter(config)
+        # 异步请求的并发不受线程数限制，空闲连接数至少与并发上限相同，免得每轮都重新建连
+        max_idle = max(int(config.get("pool_size", 16)), self.limiter.max_concurrency)
+        self.pool = AsyncConnectionPool(self.stats, self.connect_timeout, self.read_timeout, max_idle)
+
+    async def post(self, url, headers, payload, cancel=None, metrics=None):
+        """发送请求并返回状态码为 200 的 AsyncResponse，重试耗尽后抛出 ApiError"""
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        attempt = 0
+        while True:
+            if cancel is not None and cancel.is_set():
+                raise RequestCancelled()
+            await self.limiter.before_request_async(cancel)
+            self.stats.add("requests")
+            sent = time.monotonic()
+            try:
+                response = await self.pool.request("POST", url, headers, body)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+                if metrics is not None:
+                    metrics["retries"] = attempt
+                    metrics["status"] = None
+                if attempt >= self.max_retries:
+                    raise ApiError(f"调用接口出错：{str(e) or type(e).__name__}") from e
+                delay = self.backoff_delay(attempt)
+            else:
+                if metrics is not None:
+                    metrics["retries"] = attempt
+                    metrics["status"] = response.status_code
+                    metrics["connect_s"] = metrics.get("connect_s", 0.0) + response.connect_s
+                if response.status_code == 200:
+                    self.limiter.on_response(time.monotonic() - sent)
+                    return response
+                if response.status_code == 429:
+                    self.limiter.on_throttled()
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    try:
+                        text = (await response.read()).decode("utf-8", errors="replace")
+                    except Exception:
+                        text = ""
+                    raise ApiError(f"HTTP错误：{response.status_code}\n{text}")
+                delay = self.backoff_delay(attempt, response.headers.get("retry-after"))
+                response.close()
+            attempt += 1
+            self.stats.add("retries")
+            await asyncio.sleep(delay)
+
+    def summary(self):
+        return f"{self.stats.summary()}  {self.limiter.summary()}"
+
+    def close(self):
+        self.pool.close()
+
+
+async def request_completion_async(config, prompt, on_token=None, client=None, cancel=None, metrics=None):
+    """
+    request_completion 的协程版本，client 为 AsyncApiClient（不传时临时创建一个）。
+    协程被取消（AsyncRunner.submit 的 cancel）时立即关闭连接并抛出 RequestCancelled。
+    """
+    if not config.get("api_key"):
+        raise ApiError("请先在【配置模型】中设置 API Key。")
+    if client is None:
+        client = AsyncApiClient(config)
+        try:
+            return await request_completion_async(config, prompt, on_token, client, cancel, metrics)
+        finally:
+            client.close()
+    estimated = estimate_tokens(prompt, config)
+    estimated += int(estimated * float(config.get("output_ratio", DEFAULT_OUTPUT_RATIO)))
+    queued = time.monotonic()
+    await client.limiter.acquire_async(estimated, cancel)
+    if metrics is not None:
+        metrics["wait_s"] = time.monotonic() - queued
+    used = None
+    try:
+        url, headers, payload = _completion_request(config, prompt)
+        collector = _CompletionCollector(on_token, {} if metrics is None else metrics)
+        response = await client.post(url, headers, payload, cancel=cancel, metrics=metrics)
+        try:
+            if config.get("stream", True):
+                decoder = SSEDecoder()
+                async for chunk in response.iter_chunks():
+                    for data in decoder.feed(chunk):
+                        collector.event(data)
+                for data in decoder.close():
+                    collector.event(data)
+                result = collector.text()
+            else:
+                result = collector.message(json.loads(await response.read()))
+        finally:
+            response.close()
+        used = estimate_tokens(prompt + result, config)
+        return result
+    except asyncio.CancelledError:
+        raise RequestCancelled()
+    except ApiError:
+        raise
+    except Exception as e:
+        raise ApiError(f"调用接口出错：{str(e) or type(e).__name__}") from e
+    finally:
+        client.limiter.release(estimated, used)
+
+
+# --------------- 改写结果缓存（SQLite，按最近使用淘汰） ---------------
+DEFAULT_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+
+class RewriteCache:
+    """
+    以 (url, model, 完整提示词) 的哈希为键缓存接口返回的文本：
+    - 命中时直接返回，不发起任何网络请求；
+    - 总大小超过 max_bytes 时按最近访问时间淘汰最旧的条目。
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rewrite_cache ("
+            "key TEXT PRIMARY KEY, url TEXT, model TEXT, result TEXT NOT NULL, "
+            "size INTEGER NOT NULL, created REAL NOT NULL, last_access REAL NOT NULL)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS rewrite_cache_lru ON rewrite_cache(last_access)")
+        self._total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM rewrite_cache").fetchone()[0]
+
+    @staticmethod
+    def make_key(config, prompt):
+        digest = hashlib.sha256()
+        for part in (config.get("url", ""), config.get("model", ""), prompt):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, config, prompt):
+        key = self.make_key(config, prompt)
+        with self._lock:
+            row = self._conn.execute("SELECT result FROM rewrite_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._conn.execute("UPDATE rewrite_cache SET last_access = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def put(self, config, prompt, result):
+        key = self.make_key(config, prompt)
+        size = len(result.encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM rewrite_cache WHERE key = ?", (key,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rewrite_cache (key, url, model, result, size, created, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, config.get("url", ""), config.get("model", ""), result, size, now, now))
+            self._total += size - (old[0] if old else 0)
+            if self._total > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # 淘汰到上限的 90%，避免每次写入都触发淘汰
+        target = self.max_bytes * 0.9
+        self._conn.execute("BEGIN")
+        try:
+            cursor = self._conn.execute("SELECT key, size FROM rewrite_cache ORDER BY last_access")
+            doomed = []
+            for key, size in cursor:
+                if self._total <= target:
+                    break
+                doomed.append((key,))
+                self._total -= size
+            self._conn.executemany("DELETE FROM rewrite_cache WHERE key = ?", doomed)
+            self._conn.execute("COMMIT")
+        except Exception:
+            self._conn.execute("ROLLBACK")
+            self._total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM rewrite_cache").fetchone()[0]
+            raise
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM rewrite_cache")
+            self._total = 0
+
+    @property
+    def total_bytes(self):
+        return self._total
+
+
+def cached_completion(cache, config, prompt, on_token=None, client=None, cancel=None, metrics=None):
+    """先查缓存，未命中时调用接口并写入缓存；cache 为 None 时等同于 request_completion"""
+    if cache is not None:
+        hit = cache.get(config, prompt)
+        if hit is not None:
+            if metrics is not None:
+                metrics["cached"] = True
+            return hit
+    result = request_completion(config, prompt, on_token=on_token, client=client, cancel=cancel,
+                                metrics=metrics)
+    if cache is not None and result and result != NO_CONTENT_TEXT:
+        cache.put(config, prompt, result)
+    return result
+
+
+def build_rewrite_prompt(direction, text, context="", prefix=""):
+    """
+    构造“按修改方向改写文本”的提示词；context 为仅供衔接参考的上文，
+    prefix 为前情提要（见 build_context_prefix），放在最前面，同一章的请求共用同样的开头。
+    """
+    if prefix:
+        prefix += "\n\n"
+    if context:
+        return (
+            f"{prefix}请对我选中的这部分文本进行改写或润色：\n\n"
+            f"【修改方向】{direction}\n\n"
+            f"【上文】（仅供衔接参考，不要改写或输出）\n{context}\n\n"
+            f"【待修改文本】\n{text}\n"
+        )
+    return (
+        f"{prefix}请对我选中的这部分文本进行改写或润色：\n\n"
+        f"【修改方向】{direction}\n\n"
+        f"【待修改文本】\n{text}\n"
+    )
+
+
+# --------------- 请求遥测（每次接口调用的耗时与吞吐，SQLite） ---------------
+def percentile(values, p):
+    """按最近秩法取百分位数，values 为空时返回 None"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    # 秩为 ceil(p% × n)；先乘后除，避免 0.07 × 100 这类浮点误差多算一位
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p * len(ordered) / 100.0) - 1))]
+
+
+class TelemetryStore:
+    """
+    记录每次接口调用：排队、建连、首字（TTFT）与总耗时，输出字数 / token 数与生成速度，重试次数与 HTTP 状态码，
+    并标注模型配置名称与修改方向，用于按数据比较各服务商。缓存命中也会记录，但不计入延迟统计。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS requests ("
+            "id INTEGER PRIMARY KEY, time REAL NOT NULL, profile TEXT, model TEXT, direction TEXT, "
+            "outcome TEXT NOT NULL, status INTEGER, error TEXT, wait_s REAL, connect_s REAL, ttft_s REAL, "
+            "total_s REAL, chars INTEGER, tokens INTEGER, tok_s REAL, retries INTEGER)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS requests_time ON requests(time)")
+
+    def record(self, profile, config, direction, metrics, total_s, result=None, error=None):
+        """记录一次调用；metrics 为 request_completion 填写的 dict，error 为失败时的异常"""
+        if metrics.get("cached"):
+            outcome = "cached"
+        elif isinstance(error, RequestCancelled):
+            outcome = "cancelled"
+        elif error is not None:
+            outcome = "error"
+        else:
+            outcome = "ok"
+        chars = len(result) if result else 0
+        tokens = metrics.get("tokens") or (estimate_tokens(result, config) if result else 0)
+        ttft = metrics.get("ttft_s")
+        # 生成速度按首字之后的时间计算，排除排队、建连与模型“思考”的时间
+        generating = total_s - (ttft or 0.0) - metrics.get("wait_s", 0.0)
+        if generating < 0.05:
+            generating = total_s
+        tok_s = tokens / generating if outcome == "ok" and tokens and generating > 0 else None
+        row = (time.time(), profile, config.get("model", ""), direction, outcome, metrics.get("status"),
+               str(error)[:500] if error is not None else None, metrics.get("wait_s"), metrics.get("connect_s"),
+               ttft, total_s, chars, tokens, tok_s, metrics.get("retries", 0))
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO requests (time, profile, model, direction, outcome, status, error, wait_s, connect_s, "
+                "ttft_s, total_s, chars, tokens, tok_s, retries) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                row)
+
+    def stats(self, since=None):
+        """
+        按模型配置汇总 since（time.time() 时间戳，None 表示全部）之后的记录，返回按名称排序的 dict 列表：
+        profile、count、errors、cached、retries，以及 ttft / total / tok_s 的 p50 与 p95、connect 的 p50。
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT profile, outcome, connect_s, ttft_s, total_s, tok_s, retries FROM requests WHERE time >= ?",
+                (since or 0,)).fetchall()
+        groups = {}
+        for profile, outcome, connect_s, ttft_s, total_s, tok_s, retries in rows:
+            g = groups.setdefault(profile, {"count": 0, "errors": 0, "cached": 0, "retries": 0,
+                                            "connect": [], "ttft": [], "total": [], "tok_s": []})
+            g["count"] += 1
+            g["retries"] += retries or 0
+            if outcome == "cached":
+                g["cached"] += 1
+                continue
+            if outcome == "error":
+                g["errors"] += 1
+            if outcome != "ok":
+                continue
+            for key, value in (("connect", connect_s), ("ttft", ttft_s), ("total", total_s), ("tok_s", tok_s)):
+                if value is not None:
+                    g[key].append(value)
+        result = []
+        for profile in sorted(groups, key=lambda name: name or ""):
+            g = groups[profile]
+            result.append({
+                "profile": profile, "count": g["count"], "errors": g["errors"], "cached": g["cached"],
+                "retries": g["retries"], "connect_p50": percentile(g["connect"], 50),
+                "ttft_p50": percentile(g["ttft"], 50), "ttft_p95": percentile(g["ttft"], 95),
+                "total_p50": percentile(g["total"], 50), "total_p95": percentile(g["total"], 95),
+                "tok_s_p50": percentile(g["tok_s"], 50), "tok_s_p95": percentile(g["tok_s"], 95),
+            })
+        return result
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM requests")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def format_telemetry_stats(stats):
+    """把 TelemetryStore.stats() 的结果排成文本表格（命令行使用）"""
+    def fmt(value, digits=2):
+        return "-" if value is None else f"{value:.{digits}f}"
+
+    lines = ["模型配置\t请求\t失败\t缓存\t重试\t建连p50\t首字p50\t首字p95\t总耗时p50\t总耗时p95\t"
+             "tok/s p50\ttok/s p95"]
+    for row in stats:
+        lines.append("\t".join([
+            str(row["profile"]), str(row["count"]), str(row["errors"]), str(row["cached"]), str(row["retries"]),
+            fmt(row["connect_p50"], 3), fmt(row["ttft_p50"]), fmt(row["ttft_p95"]), fmt(row["total_p50"]),
+            fmt(row["total_p95"]), fmt(row["tok_s_p50"], 1), fmt(row["tok_s_p95"], 1)]))
+    return "\n".join(lines)
+
+
+# --------------- 按 token 预算分段（避免超出上下文窗口或输出被截断） ---------------
+# 以下默认值可在每个模型配置中用同名小写键覆盖（context_tokens、max_output_tokens 等）
+DEFAULT_CONTEXT_TOKENS = 32768  # 模型上下文窗口
+DEFAULT_MAX_OUTPUT_TOKENS = 4096  # 单次请求最多生成的 token 数
+DEFAULT_OUTPUT_RATIO = 1.2  # 改写结果长度相对原文的估计倍数
+DEFAULT_TOKENS_PER_CJK = 1.0  # 每个汉字（含全角标点）估计的 token 数
+DEFAULT_CHARS_PER_TOKEN = 4.0  # 其他字符平均每个 token 所含字符数
+MIN_SEGMENT_TOKENS = 200  # 配置不合理时每段原文的最低预算
+
+_CJK_RE = re.compile("[\u2e80-\u9fff\uf900-\ufaff\ufe30-\ufe4f\uff00-\uffef]")
+# 句末标点（连同其后的右引号、右括号）之后可以断开
+_SENTENCE_END_RE = re.compile("[。！？!?…；;]+[”’」』）)]*")
+
+
+def estimate_tokens(text, config=None):
+    """按模型配置估算文本的 token 数（汉字与其他字符分别计算，宁多勿少）"""
+    config = config or {}
+    cjk = _CJK_RE.subn("", text)[1]
+    per_cjk = float(config.get("tokens_per_cjk", DEFAULT_TOKENS_PER_CJK))
+    chars_per_token = float(config.get("chars_per_token", DEFAULT_CHARS_PER_TOKEN))
+    return int(math.ceil(cjk * per_cjk + (len(text) - cjk) / chars_per_token))
+
+
+def segment_budget(config, direction="", prefix=""):
+    """
+    返回 (每段原文的 token 上限, 上文重叠的 token 数)，需同时满足：
+    提示词（含前情提要 prefix）+ 上文 + 原文 + 预计输出 ≤ 上下文窗口，预计输出 ≤ 单次输出上限。
+    """
+    context = int(config.get("context_tokens", DEFAULT_CONTEXT_TOKENS))
+    max_output = int(config.get("max_output_tokens", DEFAULT_MAX_OUTPUT_TOKENS))
+    ratio = float(config.get("output_ratio", DEFAULT_OUTPUT_RATIO))
+    overlap = int(config.get("overlap_tokens", 0))
+    overhead = estimate_tokens(build_rewrite_prompt(direction, "", "　" if overlap else "", prefix), config)
+    budget = min((context - overhead - overlap) / (1 + ratio), max_output / ratio)
+    return max(int(budget), MIN_SEGMENT_TOKENS), overlap
+
+
+def _split_long(text, budget, config):
+    """把超出预算的段落按句末标点切开，单句仍超长时按字数硬切"""
+    sentences = []
+    pos = 0
+    for m in _SENTENCE_END_RE.finditer(text):
+        sentences.append(text[pos:m.end()])
+        pos = m.end()
+    if pos < len(text):
+        sentences.append(text[pos:])
+    pieces = []
+    for sentence in sentences:
+        tokens = estimate_tokens(sentence, config)
+        if tokens <= budget:
+            pieces.append(sentence)
+            continue
+        step = max(1, len(sentence) * budget // tokens)
+        pieces.extend(sentence[i:i + step] for i in range(0, len(sentence), step))
+    return pieces
+
+
+def _overlap_context(text, overlap, config):
+    """取 text 末尾约 overlap 个 token 的原文作为下一段的上文，尽量从段落开头截起"""
+    tokens = estimate_tokens(text, config)
+    if tokens <= overlap:
+        return text
+    tail = text[len(text) - max(1, len(text) * overlap // tokens):]
+    newline = tail.find("\n")
+    if 0 <= newline < len(tail) - 1:
+        tail = tail[newline + 1:]
+    return tail
+
+
+def split_segments(text, budget, overlap=0, config=None):
+    """
+    把文本按段落打包成若干片段，返回 [(上文, 片段, 连接符)]：
+    - 每个片段装入尽量多的完整段落，估计 token 数不超过 budget；
+    - 超长段落按句子切开（单句超长时按字数硬切）；
+    - 连接符是该片段与下一片段之间原有的分隔（"\n" 或 ""），
+      依次拼接“片段 + 连接符”即得到原文；
+    - overlap > 0 时，上文为前一片段末尾约 overlap 个 token 的原文，只供模型衔接参考。
+    """
+    # 先拆成 (文本, 其后的分隔) 的小块：普通段落一块，超长段落按句子拆成多块
+    pieces = []
+    paragraphs = text.split("\n")
+    for n, para in enumerate(paragraphs):
+        glue = "\n" if n < len(paragraphs) - 1 else ""
+        if estimate_tokens(para, config) <= budget:
+            pieces.append((para, glue))
+        else:
+            parts = _split_long(para, budget, config)
+            pieces.extend((part, "") for part in parts[:-1])
+            pieces.append((parts[-1], glue))
+
+    segments = []
+    current = []
+    current_tokens = 0
+    context = ""
+
+    def flush():
+        nonlocal context
+        body = "".join(piece + glue for piece, glue in current[:-1]) + current[-1][0]
+        segments.append((context, body, current[-1][1]))
+        if overlap > 0:
+            context = _overlap_context(body, overlap, config)
+
+    for piece, glue in pieces:
+        tokens = estimate_tokens(piece, config) + len(glue)
+        if current and current_tokens + tokens > budget:
+            flush()
+            current = []
+            current_tokens = 0
+        current.append((piece, glue))
+        current_tokens += tokens
+    flush()
+    return segments
+
+
+# --------------- 章节摘要与设定表（按正文哈希缓存，作为前情提要） ---------------
+SUMMARY_PREVIOUS_CHAPTERS = 3  # 前情提要包含的前文章节数（另加本章）
+DEFAULT_SUMMARY_TOKENS = 800  # 前情提要的 token 上限，可在模型配置中用 summary_tokens 覆盖
+SUMMARY_GLOSSARY_MAX = 15  # 每章设定表最多保留的条目数
+SUMMARY_OUTPUT_TOKENS = 1024  # 为摘要输出预留的 token 数
+_SUMMARY_MARK = "【摘要】"
+_GLOSSARY_MARK = "【设定】"
+
+
+def chapter_digest(text):
+    """章节正文的哈希，正文不变时摘要一直有效"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def build_summary_prompt(text):
+    """构造“为一章（或一章中的一段）生成摘要与设定表”的提示词，输出格式见 parse_summary"""
+    return (
+        f"请阅读下面的小说正文，写出供之后改写其他段落时参考的摘要与设定表。严格按以下格式输出，不要输出其他内容：\n"
+        f"{_SUMMARY_MARK}不超过150字的情节摘要\n"
+        f"{_GLOSSARY_MARK}\n"
+        f"名称：不超过30字的说明（人物、地点、组织、物品、称谓等，每行一个，最多{SUMMARY_GLOSSARY_MAX}个）\n\n"
+        f"【正文】\n{text}\n"
+    )
+
+
+def parse_summary(result):
+    """从模型输出中取出 (摘要, [(名称, 说明)])，格式不符时整段作为摘要"""
+    text = result.strip()
+    glossary = []
+    head, mark, tail = text.partition(_GLOSSARY_MARK)
+    if mark:
+        for line in tail.splitlines():
+            name, sep, note = line.strip().lstrip("-*·• ").replace(":", "：", 1).partition("：")
+            name = name.strip()
+            if sep and name and len(name) <= 20:
+                glossary.append((name, note.strip()))
+    summary = head.replace(_SUMMARY_MARK, "", 1).strip()
+    return summary, glossary[:SUMMARY_GLOSSARY_MAX]
+
+
+class SummaryStore:
+    """
+    章节摘要与设定表缓存（SQLite）：以章节正文的哈希为键，正文改动后自然失效，
+    同一章在不同文件、不同改写方向之间共用。摘要只增不淘汰（每章约几百字节）。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS summaries ("
+            "digest TEXT PRIMARY KEY, summary TEXT NOT NULL, glossary TEXT NOT NULL, model TEXT, "
+            "created REAL NOT NULL)")
+
+    def get(self, digest):
+        """返回 (摘要, [(名称, 说明)])，没有时返回 None"""
+        with self._lock:
+            row = self._conn.execute("SELECT summary, glossary FROM summaries WHERE digest = ?",
+                                     (digest,)).fetchone()
+        if row is None:
+            return None
+        return row[0], [tuple(item) for item in json.loads(row[1])]
+
+    def put(self, digest, summary, glossary, model=""):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO summaries (digest, summary, glossary, model, created) VALUES (?, ?, ?, ?, ?)",
+                (digest, summary, json.dumps(glossary, ensure_ascii=False), model, time.time()))
+
+    def count(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM summaries").fetchone()[0]
+
+    def clear(self):
+        with self._lock:
+            self._conn.execute("DELETE FROM summaries")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def build_context_prefix(entries, text, config=None, max_tokens=None):
+    """
+    把 [(章节标题, 摘要, 设定表)]（按章节顺序，最后一项为本章）拼成前情提要：
+    设定表只保留在本章正文 text 中出现的名称；超出 max_tokens 时先舍弃最早的章节摘要，再截短设定表。
+    同一章的结果只取决于各章正文，章内各次请求的提示词开头完全相同，便于服务商的前缀缓存。
+    没有可用内容时返回空字符串。
+    """
+    config = config or {}
+    if max_tokens is None:
+        max_tokens = int(config.get("summary_tokens", DEFAULT_SUMMARY_TOKENS))
+    if not entries or max_tokens <= 0:
+        return ""
+    notes = {}
+    for _, _, glossary in entries:
+        for name, note in glossary:
+            if name in text:
+                notes.pop(name, None)
+                notes[name] = note  # 以最近一章的说明为准
+    lines = [f"{name}：{note}" if note else name for name, note in notes.items()]
+    summaries = [f"{title.strip()}：{summary}" for title, summary, _ in entries if summary]
+
+    def render():
+        parts = []
+        if summaries:
+            parts.append("【前情提要】（仅供保持人物与情节一致，不要改写或输出）\n" + "\n".join(summaries))
+        if lines:
+            parts.append("【人物与设定】\n" + "\n".join(lines))
+        return "\n\n".join(parts)
+
+    prefix = render()
+    while prefix and estimate_tokens(prefix, config) > max_tokens:
+        if len(summaries) > 1:
+            summaries.pop(0)
+        elif lines:
+            lines.pop()
+        else:
+            summaries.pop()
+        prefix = render()
+    return prefix
+
+
+def chapter_context_prefix(summaries, titles, digest_of, index, text, config=None,
+                           chapters=SUMMARY_PREVIOUS_CHAPTERS):
+    """
+    用 summaries（SummaryStore）中已有的摘要为第 index 章（正文 text）构造前情提要，不发起请求；
+    digest_of(i) 返回第 i 章正文的 chapter_digest。
+    """
+    entries = []
+    for i in range(max(0, index - chapters), index + 1):
+        hit = summaries.get(digest_of(i))
+        if hit is not None:
+            entries.append((titles[i], hit[0], hit[1]))
+    return build_context_prefix(entries, text, config)
+
+
+# --------------- 字符级差异（对比窗口中标出改动） ---------------
+DIFF_TIME_BUDGET = 0.5  # 一次比较允许的秒数，超时后尚未细化的部分整体标为替换
+DIFF_MAX_STEPS = 4000000  # 单次 Myers 比较允许的步数上限，D 超出 步数/(长度之和) 时放弃细化
+DIFF_REFINE_CHARS = 20000  # 两侧合计不超过该字数的差异块才继续细化到下一层
+# 由粗到细的切分层级：先按句子（含换行）比较，差异块内再按分句比较，最后逐字比较
+_DIFF_SPLITS = (re.compile("[。！？!?…；;\n]+[”’」』）)]*"), re.compile("[，,、：:]+"))
+
+
+def _common_prefix(a, b):
+    """a、b 公共前缀的长度（二分比较切片，比逐字循环快得多）"""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix(a, b, limit):
+    """a、b 公共后缀的长度（不超过 limit）"""
+    lo, hi = 0, min(len(a), len(b), limit)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a) - mid:len(a) - lo] == b[len(b) - mid:len(b) - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _split_units(text, regex):
+    """在 regex 的每个匹配之后切开，返回各部分（拼起来即原文）"""
+    units = []
+    pos = 0
+    for m in regex.finditer(text):
+        units.append(text[pos:m.end()])
+        pos = m.end()
+    if pos < len(text):
+        units.append(text[pos:])
+    return units
+
+
+def _myers(a, b, max_d, deadline):
+    """
+    Myers O((N+M)D) 差异算法，a、b 为序列，返回 [(相同, i1, i2, j1, j2)] 形式的区段（相同为 True 表示相等的一段）；
+    编辑距离超过 max_d 或超过 deadline 时返回 None。
+    """
+    n, m = len(a), len(b)
+    max_d = min(max_d, n + m)
+    off = max_d + 1
+    v = [0] * (2 * max_d + 3)  # v[off + k] 为对角线 k 上走得最远的 x
+    trace = []
+    for d in range(max_d + 1):
+        if d & 63 == 0 and time.monotonic() > deadline:
+            return None
+        # 保存本轮开始前对角线 -d-1～d+1 的状态，回溯时使用
+        trace.append(v[off - d - 1:off + d + 2])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[off + k - 1] < v[off + k + 1]):
+                x = v[off + k + 1]
+            else:
+                x = v[off + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[off + k] = x
+            if x >= n and y >= m:
+                return _myers_path(trace, n, m)
+    return None
+
+
+def _myers_path(trace, x, y):
+    # 从终点沿每轮保存的状态回溯到起点：每轮是一步增删加其后的一段相等（对角线）
+    spans = []
+    for d in range(len(trace) - 1, 0, -1):
+        prev = trace[d]
+        k = x - y
+        if k == -d or (k != d and prev[k + d] < prev[k + d + 2]):
+            prev_k = k + 1  # 从上方下移：插入 b 中的一个元素
+        else:
+            prev_k = k - 1  # 从左方右移：删除 a 中的一个元素
+        px = prev[prev_k + d + 1]
+        py = px - prev_k
+        sx = px if prev_k == k + 1 else px + 1
+        sy = sx - k
+        if x > sx:
+            spans.append((True, sx, x, sy, y))
+        spans.append((False, px, sx, py, sy))
+        x, y = px, py
+    if x > 0:
+        spans.append((True, 0, x, 0, y))
+    spans.reverse()
+    return spans
+
+
+def diff_text(a, b, budget=DIFF_TIME_BUDGET):
+    """
+    逐字比较 a、b，返回与 difflib 相同形式的 [(tag, i1, i2, j1, j2)]，tag 为 equal / delete / insert / replace。
+    由粗到细：先去掉公共前后缀，按句子做 Myers 比较，差异块内再按分句、最后逐字比较；
+    某一层差异过大（编辑距离超出步数上限）或总耗时超过 budget 秒时，该块不再细化，整体标为替换。
+    """
+    deadline = time.monotonic() + budget
+    ops = []
+    _diff_block(a, b, 0, 0, 0, deadline, ops)
+    # 合并相邻的同类区段，并把相邻的删除与插入合并为替换
+    merged = []
+    for equal, i1, i2, j1, j2 in ops:
+        if i1 == i2 and j1 == j2:
+            continue
+        if merged and merged[-1][0] == equal:
+            _, pi1, _, pj1, _ = merged[-1]
+            merged[-1] = (equal, pi1, i2, pj1, j2)
+        else:
+            merged.append((equal, i1, i2, j1, j2))
+    result = []
+    for equal, i1, i2, j1, j2 in merged:
+        if equal:
+            tag = "equal"
+        elif i1 == i2:
+            tag = "insert"
+        elif j1 == j2:
+            tag = "delete"
+        else:
+            tag = "replace"
+        result.append((tag, i1, i2, j1, j2))
+    return result
+
+
+def _shared_bigrams(a, b):
+    # a、b 共有的相邻字对个数（按出现次数计）
+    return sum((collections.Counter(map(operator.add, a, a[1:]))
+                & collections.Counter(map(operator.add, b, b[1:]))).values())
+
+
+def _diff_block(a, b, i0, j0, level, deadline, ops):
+    # 比较 a、b（分别位于原文的 i0、新文的 j0 处），把 (相同, i1, i2, j1, j2) 依次追加到 ops
+    prefix = _common_prefix(a, b)
+    suffix = _common_suffix(a, b, min(len(a), len(b)) - prefix)
+    if prefix:
+        ops.append((True, i0, i0 + prefix, j0, j0 + prefix))
+    a_mid = a[prefix:len(a) - suffix]
+    b_mid = b[prefix:len(b) - suffix]
+    i1, j1 = i0 + prefix, j0 + prefix
+    if a_mid or b_mid:
+        if not a_mid or not b_mid:
+            ops.append((False, i1, i1 + len(a_mid), j1, j1 + len(b_mid)))
+        else:
+            _diff_units(a_mid, b_mid, i1, j1, level, deadline, ops)
+    if suffix:
+        ops.append((True, i0 + len(a) - suffix, i0 + len(a), j0 + len(b) - suffix, j0 + len(b)))
+
+
+def _diff_units(a, b, i0, j0, level, deadline, ops):
+    # 在第 level 层切分后比较；逐字一层直接比较字符
+    while level < len(_DIFF_SPLITS):
+        units_a = _split_units(a, _DIFF_SPLITS[level])
+        units_b = _split_units(b, _DIFF_SPLITS[level])
+        if len(units_a) > 1 or len(units_b) > 1:
+            break
+        level += 1  # 这一层切不开，直接看下一层
+    else:
+        units_a, units_b = a, b
+    if level >= len(_DIFF_SPLITS) and _shared_bigrams(a, b) * 4 < min(len(a), len(b)):
+        # 两边几乎没有共同的相邻字对，逐字比较也只会得到零散的相同字，不必跑 Myers
+        ops.append((False, i0, i0 + len(a), j0, j0 + len(b)))
+        return
+    max_d = DIFF_MAX_STEPS // (len(units_a) + len(units_b))
+    spans = _myers(units_a, units_b, max_d, deadline)
+    if spans is None:
+        if level >= len(_DIFF_SPLITS):
+            ops.append((False, i0, i0 + len(a), j0, j0 + len(b)))
+            return
+        # 单元几乎都不相同（例如逐句润色）：整段交给下面按位置配对细化
+        spans = [(False, 0, len(units_a), 0, len(units_b))]
+    if level >= len(_DIFF_SPLITS):
+        same = sum(i2 - i1 for equal, i1, i2, _, _ in spans if equal)
+        if same * 4 < min(len(a), len(b)):
+            # 几乎没有相同的字：整体标为替换，免得满屏零散的“相同”字
+            ops.append((False, i0, i0 + len(a), j0, j0 + len(b)))
+            return
+        for equal, i1, i2, j1, j2 in spans:
+            ops.append((equal, i0 + i1, i0 + i2, j0 + j1, j0 + j2))
+        return
+    # Myers 给出的删除、插入是交替的单个单元，先把相邻的差异段合成一块再配对
+    blocks = []
+    for span in spans:
+        if blocks and not span[0] and not blocks[-1][0]:
+            blocks[-1] = (False, blocks[-1][1], span[2], blocks[-1][3], span[4])
+        else:
+            blocks.append(span)
+    # 各单元在原文中的字符偏移
+    starts_a = list(itertools.accumulate(map(len, units_a), initial=0))
+    starts_b = list(itertools.accumulate(map(len, units_b), initial=0))
+    for equal, u1, u2, v1, v2 in blocks:
+        if equal:
+            ops.append((True, i0 + starts_a[u1], i0 + starts_a[u2], j0 + starts_b[v1], j0 + starts_b[v2]))
+            continue
+        # 两侧各有多个单元时按位置分组配对后分别细化（改写结果通常与原文逐句对应），
+        # 而不是把整块交给下一层比较
+        na, nb = u2 - u1, v2 - v1
+        groups = max(1, min(na, nb))
+        for g in range(groups):
+            ca1, ca2 = starts_a[u1 + g * na // groups], starts_a[u1 + (g + 1) * na // groups]
+            cb1, cb2 = starts_b[v1 + g * nb // groups], starts_b[v1 + (g + 1) * nb // groups]
+            if (ca2 - ca1) and (cb2 - cb1) and (ca2 - ca1) + (cb2 - cb1) <= DIFF_REFINE_CHARS \
+                    and time.monotonic() < deadline:
+                _diff_block(a[ca1:ca2], b[cb1:cb2], i0 + ca1, j0 + cb1, level + 1, deadline, ops)
+            else:
+                ops.append((False, i0 + ca1, i0 + ca2, j0 + cb1, j0 + cb2))
+
+
+def map_offset(opcodes, offset, reverse=False):
+    """按 diff_text 的结果把原文中的字符偏移换算为新文中的对应位置（reverse=True 时反向），用于两栏同步滚动"""
+    keys = [op[3] if reverse else op[1] for op in opcodes]
+    idx = bisect.bisect_right(keys, offset) - 1
+    if idx < 0:
+        return 0
+    tag, i1, i2, j1, j2 = opcodes[idx]
+    if reverse:
+        i1, i2, j1, j2 = j1, j2, i1, i2
+    if tag == "equal":
+        return j1 + min(offset - i1, j2 - j1)
+    # 差异块内按比例换算
+    return j1 + ((offset - i1) * (j2 - j1) // (i2 - i1) if i2 > i1 else 0)
+
+
+# --------------- 可恢复的改写任务（SQLite 检查点） ---------------
+class JobStore:
+    """
+    持久化的改写任务：jobs 表记录任务参数与状态，segments 表按片段（以完整提示词的哈希为键）保存状态与输出。
+    每个片段完成后立即以单条语句提交（自动提交模式下即一个事务），程序退出、断网或休眠后
+    以相同参数重新开始即可继续：已完成的片段直接取用保存的结果，不会重新请求。
+    与改写缓存不同，任务中的结果不会被淘汰，也不受“使用缓存”开关影响。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY, kind TEXT NOT NULL, book TEXT, direction TEXT NOT NULL, model TEXT NOT NULL, "
+            "first INTEGER, last INTEGER, source TEXT, out_path TEXT, status TEXT NOT NULL, "
+            "created REAL NOT NULL, updated REAL NOT NULL)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS segments ("
+            "job_id INTEGER NOT NULL, key TEXT NOT NULL, status TEXT NOT NULL, output TEXT, error TEXT, "
+            "updated REAL NOT NULL, PRIMARY KEY (job_id, key))")
+
+    def open(self, kind, book, direction, model, first=None, last=None, text=None, out_path=None):
+        """
+        返回参数相同的未完成任务（继续执行），没有时新建一个。
+        kind 为 "book"（章节范围批量改写）或 "text"（选中文本改写，text 为原文，按哈希匹配）。
+        """
+        book = os.path.abspath(book) if book else None
+        source = hashlib.sha256(text.encode("utf-8")).hexdigest() if text is not None else None
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, out_path FROM jobs WHERE status = 'running' AND kind = ? AND book IS ? AND direction = ? "
+                "AND model = ? AND first IS ? AND last IS ? AND source IS ? ORDER BY id DESC LIMIT 1",
+                (kind, book, direction, model, first, last, source)).fetchone()
+            if row is not None:
+                return RewriteJob(self, row[0], row[1], resumed=True)
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (kind, book, direction, model, first, last, source, out_path, status, created, "
+                "updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'running', ?, ?)",
+                (kind, book, direction, model, first, last, source, out_path, now, now))
+            return RewriteJob(self, cursor.lastrowid, out_path)
+
+    def unfinished(self, kind=None):
+        """未完成的任务（dict 列表，最近的在前），含已完成片段数 done"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "SELECT j.id, j.kind, j.book, j.direction, j.model, j.first, j.last, j.out_path, j.updated, "
+                "(SELECT COUNT(*) FROM segments s WHERE s.job_id = j.id AND s.status = 'done') "
+                "FROM jobs j WHERE j.status = 'running' AND (? IS NULL OR j.kind = ?) ORDER BY j.updated DESC",
+                (kind, kind))
+            names = ("id", "kind", "book", "direction", "model", "first", "last", "out_path", "updated", "done")
+            return [dict(zip(names, row)) for row in cursor]
+
+    def prune(self, days=30):
+        """删除 days 天内没有进展的未完成任务及其片段"""
+        cutoff = time.time() - days * 86400
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM segments WHERE job_id IN "
+                                   "(SELECT id FROM jobs WHERE status = 'running' AND updated < ?)", (cutoff,))
+                self._conn.execute("UPDATE jobs SET status = 'abandoned' WHERE status = 'running' AND updated < ?",
+                                   (cutoff,))
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class RewriteJob:
+    """JobStore 中的一个任务；lookup / save 可在多个工作线程中并发调用"""
+
+    def __init__(self, store, job_id, out_path=None, resumed=False):
+        self.store = store
+        self.id = job_id
+        self.out_path = out_path
+        self.resumed = resumed
+
+    @staticmethod
+    def make_key(prompt):
+        return hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+
+    def lookup(self, prompt):
+        """已完成片段的输出，未完成时返回 None"""
+        with self.store._lock:
+            row = self.store._conn.execute(
+                "SELECT output FROM segments WHERE job_id = ? AND key = ? AND status = 'done'",
+                (self.id, self.make_key(prompt))).fetchone()
+        return row[0] if row else None
+
+    def save(self, prompt, output=None, error=None):
+        """记录一个片段的结果（output）或失败原因（error）；失败的片段在继续执行时会重新请求"""
+        now = time.time()
+        status = "done" if error is None and output else "failed"
+        with self.store._lock:
+            self.store._conn.execute(
+                "INSERT OR REPLACE INTO segments (job_id, key, status, output, error, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (self.id, self.make_key(prompt), status, output if status == "done" else None,
+                 str(error)[:500] if error is not None else None, now))
+            self.store._conn.execute("UPDATE jobs SET updated = ? WHERE id = ?", (now, self.id))
+
+    def done_count(self):
+        with self.store._lock:
+            return self.store._conn.execute(
+                "SELECT COUNT(*) FROM segments WHERE job_id = ? AND status = 'done'", (self.id,)).fetchone()[0]
+
+    def finish(self):
+        """全部片段已写入结果文件（或交给调用方）后标记完成，并删除保存的片段输出"""
+        with self.store._lock:
+            self.store._conn.execute("BEGIN")
+            try:
+                self.store._conn.execute("DELETE FROM segments WHERE job_id = ?", (self.id,))
+                self.store._conn.execute("UPDATE jobs SET status = 'done', updated = ? WHERE id = ?",
+                                         (time.time(), self.id))
+                self.store._conn.execute("COMMIT")
+            except Exception:
+                self.store._conn.execute("ROLLBACK")
+                raise
+
+
+def _checkpointed(complete, job):
+    """包装 complete(prompt)：已完成的片段从任务中取结果，新结果立即保存"""
+    def run(prompt):
+        result = job.lookup(prompt)
+        if result is not None:
+            return result
+        try:
+            result = complete(prompt)
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            job.save(prompt, error=e)
+            raise
+        job.save(prompt, result)
+        return result
+    return run
+
+
+def _checkpointed_submit(submit, job):
+    """_checkpointed 的 submit 版本：已完成的片段直接返回已有结果的 Future，新结果在 Future 完成时保存"""
+    def run(prompt):
+        result = job.lookup(prompt)
+        if result is not None:
+            future = concurrent.futures.Future()
+            future.set_result(result)
+            return future
+
+        def done(f):
+            if f.cancelled():
+                return
+            error = f.exception()
+            if error is None:
+                job.save(prompt, f.result())
+            elif not isinstance(error, RequestCancelled):
+                job.save(prompt, error=error)
+        future = submit(prompt)
+        future.add_done_callback(done)
+        return future
+    return run
+
+
+# --------------- 批量改写（整本书 / 章节范围） ---------------
+DEFAULT_BATCH_CONCURRENCY = 4
+
+
+class BatchRewriter:
+    """
+    有界并发的改写执行器：
+    - complete(prompt) 在线程池中执行，最多 concurrency 个请求同时进行；
+    - 任务按需从可迭代对象中取出，在途数量有上限，内存占用不随书本大小增长；
+    - 结果严格按提交顺序产出。
+    """
+
+    def __init__(self, complete, concurrency=DEFAULT_BATCH_CONCURRENCY, submit=None):
+        self.complete = complete
+        self.concurrency = max(1, int(concurrency))
+        # submit(prompt) 返回 concurrent.futures.Future 时改用它提交（例如提交到 AsyncRunner 的协程），不占用线程
+        self.submit = submit
+
+    def run(self, jobs, cancel_event=None):
+        """
+        jobs 为 (key, prompt) 的可迭代对象，按顺序产出 (key, result, error)。
+        提前结束（cancel_event 被设置、调用方关闭生成器或 Ctrl+C）时设置 cancel_event 并取消尚未开始的请求，
+        不等待正在进行的请求；要打断它们，complete / submit 需另外使用 CancelToken（见 RewriteEngine.rewrite_book）。
+        """
+        jobs = iter(jobs)
+        window = self.concurrency * 2
+        # 线程池只在真正提交任务时才创建线程，使用 submit 时不会产生任何线程
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency)
+        submit = self.submit or (lambda prompt: pool.submit(self.complete, prompt))
+        pending = collections.deque()
+
+        def fill():
+            while len(pending) < window:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                try:
+                    key, prompt = next(jobs)
+                except StopIteration:
+                    return
+                pending.append((key, submit(prompt)))
+
+        try:
+            fill()
+            while pending:
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                key, future = pending.popleft()
+                try:
+                    result, error = future.result(), None
+                except Exception as e:
+                    result, error = None, e
+                yield key, result, error
+                fill()
+        finally:
+            if pending and cancel_event is not None:
+                cancel_event.set()
+            for _, future in pending:
+                future.cancel()
+            pool.shutdown(wait=False, cancel_futures=True)
+
+
+def write_book(novel, out, texts):
+    """
+    把 novel 写入二进制文件对象 out：texts 按章节序号递增产出 (章节序号, 新正文)，
+    这些章节的正文被替换（保留原正文首尾的空白），其余字节（标题、章节间内容）原样复制。
+    texts 可以是惰性生成器，写出过程只需常数内存。
+    """
+    encoding = novel.encoding
+    pos = 0
+    for i, text in texts:
+        start, end = novel.starts[i], novel.ends[i]
+        novel.write_range(out, pos, start)
+        raw = novel.raw_bytes(start, end).decode(encoding)
+        lead = raw[:len(raw) - len(raw.lstrip())]
+        trail = raw[len(raw.rstrip()):]
+        if "\r\n" in raw:
+            # 保持原文件的 CRLF 换行风格
+            text = text.replace("\n", "\r\n")
+        out.write((lead + text + trail).encode(encoding))
+        pos = end
+    novel.write_range(out, pos, novel.size)
+
+
+def batch_rewrite(file_path, out_path, direction, complete, first=0, last=None,
+                  concurrency=DEFAULT_BATCH_CONCURRENCY, on_progress=None, cancel_event=None,
+                  journal=None, config=None, grammar=None, job=None, submit=None, summaries=None):
+    """
+    改写 file_path 中第 first～last 章（含两端，从 0 开始），结果写入 out_path。
+    grammar 为章节标题语法，须与建立修订日志时所用的一致。
+    summaries 为 SummaryStore 时每章的提示词以其中已有的摘要构成的前情提要开头（见 chapter_context_prefix）。
+    job 为 RewriteJob 时按片段保存检查点：已完成的片段不再请求，全部片段成功后任务标记为完成。
+    submit 不为 None 时各片段通过 submit(prompt) 提交（见 BatchRewriter），complete 不再使用。
+    每章按模型配置 config 的 token 预算分段请求（见 segment_budget）。
+    范围外的内容按原字节原样保留（若给出修订日志 journal，则先应用其中的修订）；
+    某个片段请求失败时保留该片段原文。
+    on_progress(已完成章数, 总章数, 失败片段数) 在工作线程中回调。
+    返回 (完成章数, 失败片段数)；被取消时删除未完成的输出文件并返回 None。
+    """
+    novel = NovelIndex(file_path, grammar=grammar)
+    try:
+        if last is None or last >= len(novel):
+            last = len(novel) - 1
+        total = last - first + 1
+        stats = {"done": 0, "failed": 0}
+        config = config or {}
+        budget, overlap = segment_budget(config, direction)
+        if job is not None:
+            if submit is not None:
+                submit = _checkpointed_submit(submit, job)
+            else:
+                complete = _checkpointed(complete, job)
+
+        if journal is not None:
+            journal.bind(novel.titles)
+
+        def chapter_text(i):
+            text = novel.chapter_text(i)
+            return journal.apply(i, text) if journal is not None else text
+
+        digests = {}
+
+        def digest_of(i):
+            if i not in digests:
+                digests[i] = chapter_digest(chapter_text(i))
+            return digests[i]
+
+        def jobs():
+            for i in range(first, last + 1):
+                text = chapter_text(i)
+                prefix = ""
+                chapter_budget = budget
+                if summaries is not None:
+                    prefix = chapter_context_prefix(summaries, novel.titles, digest_of, i, text, config)
+                    chapter_budget = segment_budget(config, direction, prefix)[0]
+                    digests.pop(i - SUMMARY_PREVIOUS_CHAPTERS, None)
+                for context, unit, glue in split_segments(text, chapter_budget, overlap, config):
+                    yield (i, unit, glue), build_rewrite_prompt(direction, unit, context, prefix)
+
+        def rewritten():
+            # 把按片段产出的结果重新拼成整章，按章节顺序交给 write_book
+            results = BatchRewriter(complete, concurrency, submit).run(jobs(), cancel_event)
+            pending = None
+            for i in range(len(novel)):
+                if not first <= i <= last:
+                    if journal is not None and journal.has_patches(i):
+                        yield i, chapter_text(i)
+                    continue
+                pieces = []
+                if pending is not None:
+                    pieces.append(pending)
+                    pending = None
+                for (j, unit, glue), result, error in results:
+                    if error is not None or not result:
+                        stats["failed"] += 1
+                        piece = unit + glue
+                    else:
+                        piece = result.strip("\n") + glue
+                    if j != i:
+                        pending = piece
+                        break
+                    pieces.append(piece)
+                if cancel_event is not None and cancel_event.is_set():
+                    return
+                yield i, "".join(pieces)
+                stats["done"] += 1
+                if on_progress is not None:
+                    on_progress(stats["done"], total, stats["failed"])
+
+        tmp_path = out_path + ".part"
+        try:
+            with open(tmp_path, 'wb') as out:
+                write_book(novel, out, rewritten())
+        except BaseException:
+            # 出错或 Ctrl+C 时不在书旁边留下不完整的输出（已完成的片段保存在任务检查点中）
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        if cancel_event is not None and cancel_event.is_set():
+            os.remove(tmp_path)
+            return None
+        os.replace(tmp_path, out_path)
+        if job is not None and not stats["failed"]:
+            job.finish()
+        return stats["done"], stats["failed"]
+    finally:
+        novel.close()
+
+
+# --------------- 修订日志（追加写入的补丁，替代每次另存整本书） ---------------
+class EditJournal:
+    """
+    与原文件放在一起的追加式修订日志（每行一条 JSON 补丁）：
+    {"chapter": 章节序号, "title": 章节标题, "offset": 章内字符偏移, "old": 原文, "new": 新文本, ...}
+    偏移相对于“已应用此前所有同章补丁”的章节正文。接受一次改写只需追加一行，
+    原文件保持不变；需要普通 txt 时再通过导出把任意修订版本物化出来。
+    调用 bind() 给出书中当前的章节标题后，补丁按记录的标题核对所属章节，而不只凭序号。
+    """
+
+    SUFFIX = ".journal.jsonl"
+
+    def __init__(self, path):
+        self.path = path
+        self.patches = []       # 按追加顺序排列的全部补丁
+        self._by_chapter = {}   # 章节序号 -> [(修订序号, 补丁)]
+        self.skipped = set()    # 与原文对不上而被 apply 跳过的修订序号，由调用方统一提示
+        self.orphaned = set()   # 书中找不到所记录标题的修订序号（bind 之后），不再应用
+        self._titles = None     # bind() 给出的章节标题表
+        self._positions = {}    # 标题 -> [章节序号]
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        self._remember(json.loads(line))
+                    except (json.JSONDecodeError, KeyError, TypeError):
+                        # 写入中途崩溃可能留下不完整的最后一行，忽略即可
+                        continue
+
+    @classmethod
+    def path_for(cls, file_path):
+        return file_path + cls.SUFFIX
+
+    def __len__(self):
+        return len(self.patches)
+
+    def _remember(self, patch):
+        seq = len(self.patches)
+        chapter = self._chapter_of(patch)
+        if chapter is None:
+            self.orphaned.add(seq)
+        else:
+            self._by_chapter.setdefault(chapter, []).append((seq, patch))
+        self.patches.append(patch)
+
+    def _chapter_of(self, patch):
+        """补丁所属章节的序号：记录的标题与同序号章节不符时按标题查找（有多处时取最近的），找不到返回 None"""
+        chapter = int(patch["chapter"])
+        title = patch.get("title")
+        if self._titles is None or title is None:
+            return chapter
+        if chapter < len(self._titles) and self._titles[chapter] == title:
+            return chapter
+        found = self._positions.get(title)
+        if not found:
+            return None
+        return min(found, key=lambda i: abs(i - chapter))
+
+    def bind(self, titles):
+        """
+        按书中当前的章节标题 titles 重新核对全部补丁（章节有增删或改用了别的标题语法后，序号会错位）：
+        标题相符的按序号应用，不符的改到标题相同的章节，书中没有该标题的记入 orphaned。
+        """
+        self._titles = list(titles)
+        self._positions = {}
+        for i, title in enumerate(self._titles):
+            self._positions.setdefault(title, []).append(i)
+        patches = self.patches
+        self.patches = []
+        self._by_chapter = {}
+        self.orphaned = set()
+        self.skipped = set()
+        for patch in patches:
+            self._remember(patch)
+
+    def has_patches(self, chapter):
+        return chapter in self._by_chapter
+
+    def append(self, chapter, title, offset, old, new, **meta):
+        """追加一条补丁并立即落盘，返回新的修订号（补丁总数）"""
+        patch = {"chapter": chapter, "title": title, "offset": offset, "old": old, "new": new,
+                 "time": time.strftime("%Y-%m-%d %H:%M:%S")}
+        patch.update(meta)
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(patch, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self._remember(patch)
+        return len(self.patches)
+
+    def apply(self, chapter, text, revision=None):
+        """把该章修订号小于 revision（默认全部）的补丁依次应用到 text 上"""
+        for seq, patch in self._by_chapter.get(chapter, ()):
+            if revision is not None and seq >= revision:
+                break
+            offset, old = patch["offset"], patch["old"]
+            if text[offset:offset + len(old)] != old:
+                # 原文件已被外部修改，补丁对不上时跳过，避免写坏正文（记入 skipped，不逐次输出）
+                self.skipped.add(seq)
+                continue
+            text = text[:offset] + patch["new"] + text[offset + len(old):]
+        return text
+
+    def patched_chapters(self, revision=None):
+        """修订号小于 revision 的补丁涉及的章节序号（升序）"""
+        return sorted(i for i, items in self._by_chapter.items()
+                      if revision is None or items[0][0] < revision)
+
+    def map_range(self, chapter, start, end, revision):
+        """
+        把修订号 revision 时刻的章内区间 [start, end) 换算到最新内容上：
+        位于区间之前的补丁使其平移，与区间重叠时返回 None。
+        """
+        for seq, patch in self._by_chapter.get(chapter, ()):
+            if seq < revision:
+                continue
+            offset, old_len, new_len = patch["offset"], len(patch["old"]), len(patch["new"])
+            if offset + old_len <= start:
+                start += new_len - old_len
+                end += new_len - old_len
+            elif offset < end:
+                return None
+        return start, end
+
+    def drop_chapter(self, chapter):
+        """原文件中该章已被整体改写时，删除该章的补丁（重写日志文件）"""
+        if chapter not in self._by_chapter:
+            return
+        dropped = {seq for seq, _ in self._by_chapter[chapter]}
+        kept = [p for seq, p in enumerate(self.patches) if seq not in dropped]
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for patch in kept:
+                f.write(json.dumps(patch, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+        self.patches = []
+        self._by_chapter = {}
+        self.skipped = set()  # 修订序号已重新编号
+        self.orphaned = set()
+        for patch in kept:
+            self._remember(patch)
+
+
+def export_revision(file_path, journal, out_path, revision=None, grammar=None, on_progress=None):
+    """
+    把原文件加上前 revision 条补丁（默认全部）物化为普通 txt 文件。
+    on_progress(已写出的章数, 总章数) 在调用线程中回调。
+    """
+    novel = NovelIndex(file_path, grammar=grammar)
+    try:
+        journal.bind(novel.titles)
+
+        def texts():
+            for i in journal.patched_chapters(revision):
+                if i >= len(novel):
+                    continue
+                yield i, journal.apply(i, novel.chapter_text(i), revision)
+                if on_progress is not None:
+                    on_progress(i + 1, len(novel))
+
+        tmp_path = out_path + ".part"
+        try:
+            with open(tmp_path, 'wb') as out:
+                write_book(novel, out, texts())
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        os.replace(tmp_path, out_path)
+        if on_progress is not None:
+            on_progress(len(novel), len(novel))
+    finally:
+        novel.close()
+
+
+# --------------- 配置文件 ---------------
+MODEL_CONFIG_FILE = "model_config.json"
+DIRECTIONS_FILE = "修改方向.json"
+HEADING_GRAMMAR_FILE = "章节标题.json"
+CACHE_FILE = "rewrite_cache.db"
+JOBS_FILE = "rewrite_jobs.db"
+TELEMETRY_FILE = "telemetry.db"
+SUMMARY_FILE = "summaries.db"
+
+DEFAULT_MODEL_CONFIGS = {
+    "思考模型": {
+        "api_key": "",
+        "url": "https://api.example.com/think",
+        "model": "think-model-01",
+        "stream": False
+    },
+    "全文模型": {
+        "api_key": "",
+        "url": "https://api.example.com/full",
+        "model": "full-model-01",
+        "stream": True
+    },
+    "小说模型": {
+        "api_key": "",
+        "url": "https://api.minimax.chat/v1/text/chatcompletion_v2",
+        "model": "minimax-text-01",
+        "stream": True
+    }
+}
+
+
+def read_model_configs(path):
+    """读取模型配置；文件不存在时返回默认配置，读取出错时返回空字典"""
+    if not os.path.exists(path):
+        return copy.deepcopy(DEFAULT_MODEL_CONFIGS)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print("读取模型配置文件出错：", e)
+        return {}
+
+
+def write_model_configs(path, configs):
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(configs, f, ensure_ascii=False, indent=4)
+    except Exception as e:
+        print("保存模型配置文件出错：", e)
+
+
+def read_directions(path):
+    """读取修改方向列表（每一项为一条文本），文件不存在或出错时返回空列表"""
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        print("读取修改方向配置出错：", e)
+        return []
+
+
+def read_heading_grammar(path):
+    """读取自定义的章节标题语法（见 DEFAULT_HEADING_GRAMMAR），文件不存在或出错时返回 None（使用默认语法）"""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            grammar = json.load(f)
+        return {key: grammar[key] for key in DEFAULT_HEADING_GRAMMAR if key in grammar}
+    except Exception as e:
+        print("读取章节标题配置出错：", e)
+        return None
+
+
+def write_directions(path, directions):
+    try:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(directions, f, ensure_ascii=False, indent=4)
+    except Exception as e:
+        print("保存修改方向配置出错：", e)
+
+
+def new_revision_filename(file_path, model_name):
+    """
+    根据原文件名、模型名称以及当前时间生成新文件名：
+    - 如果原文件名最前方没有序号，则新文件名为 "1-原文件名称-模型名称→当前时间.txt"。
+    - 如果原文件名最前方有序号且包含“思考模型”、“全文模型”或“小说模型”中的任意一个，
+      则提取最前方的序号（并加 1）和原文件名称（去掉旧的模型名称和时间部分），
+      生成新文件名为 "新序号-原文件名称-模型名称→当前时间.txt"。
+    """
+    timestamp = time.strftime("%Y%m%d%H%M%S")
+    base_name = os.path.splitext(os.path.basename(file_path))[0]
+    pattern_full = r'^(\d+)-(.+)-(思考模型|全文模型|小说模型)→\d{14}$'
+    m = re.match(pattern_full, base_name)
+    if m:
+        old_serial = int(m.group(1))
+        original_name = m.group(2)
+        new_serial = old_serial + 1
+        new_file_name = f"{new_serial}-{original_name}-{model_name}→{timestamp}.txt"
+    elif re.match(r'^\d+-', base_name) and any(model in base_name for model in ["思考模型", "全文模型", "小说模型"]):
+        parts = base_name.split('-', 1)
+        try:
+            old_serial = int(parts[0])
+        except:
+            old_serial = 0
+        new_serial = old_serial + 1
+        remainder = parts[1]
+        pattern_trailing = r'(.+)-(思考模型|全文模型|小说模型)→\d{14}$'
+        m2 = re.match(pattern_trailing, remainder)
+        if m2:
+            original_name = m2.group(1)
+        else:
+            original_name = remainder
+        new_file_name = f"{new_serial}-{original_name}-{model_name}→{timestamp}.txt"
+    else:
+        new_file_name = f"1-{base_name}-{model_name}→{timestamp}.txt"
+    return new_file_name
+
+
+# --------------- 改写引擎 ---------------
+HEDGE_AFTER = 10.0  # 对冲模式下，等待首个 token 超过该秒数时向下一个模型配置补发请求
+
+
+class RewriteEngine:
+    """
+    与界面无关的改写引擎：持有模型配置、每个配置对应的长连接客户端、改写缓存以及章节标题语法。
+    model_configs 以引用方式保存，调用方修改配置后调用 reset_clients() 即可生效。
+    """
+
+    def __init__(self, model_configs, cache=None, grammar=None, telemetry=None, summaries=None):
+        self.model_configs = model_configs
+        self.cache = cache
+        self.grammar = grammar  # 章节标题语法，None 表示默认语法
+        self.telemetry = telemetry  # TelemetryStore，None 表示不记录
+        self.summaries = summaries  # SummaryStore，None 表示不使用前情提要
+        self.output_chars = 0  # 累计得到的改写结果字数（含缓存命中）
+        self._clients = {}
+        self._async_clients = {}
+        self._runner = None
+        self._lock = threading.Lock()
+
+    def client(self, model_name, create=True):
+        """返回模型配置对应的长连接客户端；create=False 时不存在则返回 None"""
+        with self._lock:
+            client = self._clients.get(model_name)
+            if client is None and create:
+                client = ApiClient(self.model_configs.get(model_name, {}))
+                self._clients[model_name] = client
+            return client
+
+    def async_client(self, model_name, create=True):
+        """模型配置对应的 AsyncApiClient，与同一配置的 ApiClient 共用限流器（只在事件循环中使用）"""
+        limiter = self.client(model_name).limiter if create else None
+        with self._lock:
+            client = self._async_clients.get(model_name)
+            if client is None and create:
+                client = AsyncApiClient(self.model_configs.get(model_name, {}), limiter)
+                self._async_clients[model_name] = client
+            return client
+
+    @property
+    def runner(self):
+        """后台事件循环（第一次使用时启动）"""
+        with self._lock:
+            if self._runner is None:
+                self._runner = AsyncRunner()
+            return self._runner
+
+    def submit(self, coro, cancel=None):
+        """把协程（如 rewrite_text_async(...)）提交到后台事件循环，返回 concurrent.futures.Future"""
+        return self.runner.submit(coro, cancel)
+
+    def reset_clients(self):
+        """配置变化后丢弃旧客户端（进行中的请求仍使用旧客户端直至结束）"""
+        with self._lock:
+            self._clients = {}
+            old, self._async_clients = self._async_clients, {}
+            if self._runner is not None:
+                for client in old.values():
+                    self._runner.loop.call_soon_threadsafe(client.close)
+
+    def _record(self, model_name, config, direction, metrics, started, result, error):
+        if metrics is not None:
+            try:
+                self.telemetry.record(model_name, config, direction, metrics, time.monotonic() - started,
+                                      result, error)
+            except sqlite3.Error:
+                pass  # 遥测失败不影响改写
+        if result is not None:
+            with self._lock:
+                self.output_chars += len(result)
+
+    def complete(self, model_name, prompt, on_token=None, cancel=None, use_cache=True, direction=None):
+        """用指定模型配置完成一次请求，失败时抛出 ApiError；direction 仅用于遥测记录"""
+        config = self.model_configs.get(model_name, {})
+        metrics = {} if self.telemetry is not None else None
+        started = time.monotonic()
+        result = error = None
+        try:
+            result = cached_completion(self.cache if use_cache else None, config, prompt, on_token=on_token,
+                                       client=self.client(model_name), cancel=cancel, metrics=metrics)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            self._record(model_name, config, direction, metrics, started, result, error)
+
+    async def complete_async(self, model_name, prompt, on_token=None, cancel=None, use_cache=True, direction=None):
+        """complete 的协程版本，在后台事件循环中执行；缓存与遥测的 SQLite 读写交给线程池，不阻塞事件循环"""
+        config = self.model_configs.get(model_name, {})
+        cache = self.cache if use_cache else None
+        metrics = {} if self.telemetry is not None else None
+        started = time.monotonic()
+        result = error = None
+        try:
+            if cache is not None:
+                result = await _in_executor(cache.get, config, prompt)
+                if result is not None:
+                    if metrics is not None:
+                        metrics["cached"] = True
+                    return result
+            result = await request_completion_async(config, prompt, on_token=on_token,
+                                                    client=self.async_client(model_name), cancel=cancel,
+                                                    metrics=metrics)
+            if cache is not None and result and result != NO_CONTENT_TEXT:
+                await _in_executor(cache.put, config, prompt, result)
+            return result
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            await _in_executor(self._record, model_name, config, direction, metrics, started, result, error)
+
+    def _segment_prompts(self, model_name, direction, text, prefix=""):
+        """按 token 预算把 text 分段，产出每段的 (提示词, 段后分隔)"""
+        config = self.model_configs.get(model_name, {})
+        budget, overlap = segment_budget(config, direction, prefix)
+        for context, segment, glue in split_segments(text, budget, overlap, config):
+            yield build_rewrite_prompt(direction, segment, context, prefix), glue
+
+    def _rewrite_steps(self, model_name, direction, text, on_token=None, job=None, prefix=""):
+        """
+        rewrite_text 与 rewrite_text_async 共用的分段与检查点流程（生成器），最终返回拼接后的全文。
+        产出 (None, 提示词, 增量回调) 表示需要请求该段，产出 (函数, 参数...) 表示需要执行的任务库操作；
+        调用方执行后用 send() 送回结果，两个版本只在执行方式上不同。
+        """
+        streamed = []
+
+        def emit(piece):
+            streamed.append(piece)
+            on_token(piece)
+        parts = []
+        for prompt, glue in self._segment_prompts(model_name, direction, text, prefix):
+            streamed.clear()
+            result = (yield job.lookup, prompt) if job is not None else None
+            if result is None:
+                result = yield None, prompt, emit if on_token is not None else None
+                if job is not None:
+                    yield job.save, prompt, result
+            if on_token is not None:
+                if not streamed:
+                    on_token(result)
+                if glue:
+                    on_token(glue)
+            parts.append(result + glue)
+        return "".join(parts)
+
+    def rewrite_text(self, model_name, direction, text, on_token=None, cancel=None, use_cache=True, job=None,
+                     prefix=""):
+        """
+        按 token 预算把 text 分段，依次请求改写并按原有分隔拼接结果，失败时抛出 ApiError。
+        on_token 依次收到各段的增量文本与段间分隔；缓存命中、任务中已完成或非流式的片段整段回调一次。
+        job 为 RewriteJob 时每段完成后立即保存，重新执行同一任务时跳过已完成的片段（任务由调用方标记完成）。
+        prefix 为加在每段提示词开头的前情提要（见 context_prefix）。
+        """
+        steps = self._rewrite_steps(model_name, direction, text, on_token, job, prefix)
+        value = None
+        while True:
+            try:
+                step = steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            if step[0] is None:
+                value = self.complete(model_name, step[1], on_token=step[2], cancel=cancel, use_cache=use_cache,
+                                      direction=direction)
+            else:
+                value = step[0](*step[1:])
+
+    async def rewrite_text_async(self, model_name, direction, text, on_token=None, cancel=None, use_cache=True,
+                                 job=None, prefix=""):
+        """rewrite_text 的协程版本，用 submit() 提交；取消时正在进行的请求立即关闭连接，任务库读写交给线程池"""
+        steps = self._rewrite_steps(model_name, direction, text, on_token, job, prefix)
+        value = None
+        while True:
+            try:
+                step = steps.send(value)
+            except StopIteration as stop:
+                return stop.value
+            if step[0] is None:
+                value = await self.complete_async(model_name, step[1], on_token=step[2], cancel=cancel,
+                                                  use_cache=use_cache, direction=direction)
+            else:
+                value = await _in_executor(*step)
+
+    def rewrite_hedged(self, model_names, direction, text, on_token=None, cancel=None, use_cache=True,
+                       hedge_after=HEDGE_AFTER, prefix=""):
+        """
+        对冲请求：先向 model_names[0] 发送改写请求，hedge_after 秒内仍没有任何一路出字（或某一路失败）时，
+        再向下一个模型配置发送同样的请求。采用最先完成的一路并取消其余请求，返回 (模型名称, 结果)；
+        全部失败时抛出最后一个 ApiError。
+        on_token 只接收最先出字的那一路的增量文本；最终采用的若是另一路，调用方应以返回的结果为准。
+        """
+        results = queue.Queue()
+        tokens = [CancelToken() for _ in model_names]
+        state = {"leader": None, "started": 0, "running": 0}
+        lock = threading.Lock()
+        first_token = threading.Event()
+
+        def cancel_all():
+            for token in tokens:
+                token.cancel()
+
+        def start():
+            i = state["started"]
+            state["started"] += 1
+            state["running"] += 1
+
+            def emit(piece):
+                first_token.set()
+                with lock:
+                    if state["leader"] is None:
+                        state["leader"] = i
+                    leading = state["leader"] == i
+                if leading and on_token is not None:
+                    on_token(piece)
+
+            def run():
+                try:
+                    results.put((i, self.rewrite_text(model_names[i], direction, text, on_token=emit,
+                                                      cancel=tokens[i], use_cache=use_cache, prefix=prefix), None))
+                except Exception as e:
+                    results.put((i, None, e))
+            threading.Thread(target=run, daemon=True).start()
+
+        if cancel is not None:
+            cancel.add_callback(cancel_all)
+        try:
+            start()
+            error = None
+            while True:
+                can_hedge = state["started"] < len(model_names)
+                try:
+                    i, result, e = results.get(timeout=hedge_after if can_hedge and not first_token.is_set() else None)
+                except queue.Empty:
+                    if not first_token.is_set():
+                        start()
+                    continue
+                state["running"] -= 1
+                if e is None:
+                    return model_names[i], result
+                if cancel is not None and cancel.is_set():
+                    raise RequestCancelled()
+                error = e
+                if can_hedge:
+                    start()
+                elif state["running"] == 0:
+                    raise error if isinstance(error, ApiError) else ApiError(f"调用接口出错：{error}")
+        finally:
+            if cancel is not None:
+                cancel.remove_callback(cancel_all)
+            cancel_all()
+
+    def rewrite_fanout(self, model_names, direction, text, on_token=None, on_done=None, cancel=None,
+                       use_cache=True, prefix=""):
+        """
+        同时向多个模型配置发送同一改写请求，全部结束后返回 {模型名称: (结果, 错误)}。
+        on_token(模型名称, 增量文本) 与 on_done(模型名称, 结果, 错误) 在各自的工作线程中回调。
+        """
+        outcomes = {}
+
+        def run(name):
+            emit = None
+            if on_token is not None:
+                emit = lambda piece: on_token(name, piece)
+            try:
+                result, error = self.rewrite_text(name, direction, text, on_token=emit, cancel=cancel,
+                                                  use_cache=use_cache, prefix=prefix), None
+            except Exception as e:
+                result, error = None, e
+            outcomes[name] = (result, error)
+            if on_done is not None:
+                on_done(name, result, error)
+
+        threads = [threading.Thread(target=run, args=(name,), daemon=True) for name in model_names]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return {name: outcomes[name] for name in model_names}
+
+    def summarize(self, model_name, text, cancel=None):
+        """
+        返回一章正文 text 的 (摘要, [(名称, 说明)])：SummaryStore 中已有时直接返回，
+        否则请求模型生成并保存（超出上下文窗口的章节分段生成后合并）。失败时抛出 ApiError。
+        """
+        digest = chapter_digest(text)
+        hit = self.summaries.get(digest)
+        if hit is not None:
+            return hit
+        config = self.model_configs.get(model_name, {})
+        context = int(config.get("context_tokens", DEFAULT_CONTEXT_TOKENS))
+        # 摘要的输出很短，原文几乎可以占满上下文窗口
+        budget = max(context - estimate_tokens(build_summary_prompt(""), config) - SUMMARY_OUTPUT_TOKENS,
+                     MIN_SEGMENT_TOKENS)
+        summaries = []
+        notes = {}
+        for _, segment, _ in split_segments(text, budget, 0, config):
+            result = self.complete(model_name, build_summary_prompt(segment), cancel=cancel, use_cache=False,
+                                   direction="章节摘要")
+            summary, glossary = parse_summary(result)
+            summaries.append(summary)
+            for name, note in glossary:
+                notes.setdefault(name, note)
+        summary = "".join(summaries)
+        glossary = list(notes.items())[:SUMMARY_GLOSSARY_MAX]
+        self.summaries.put(digest, summary, glossary, config.get("model", ""))
+        return summary, glossary
+
+    def summarize_chapters(self, model_name, text_of, indices, concurrency=DEFAULT_BATCH_CONCURRENCY,
+                           on_progress=None, cancel_event=None, cancel=None):
+        """
+        为 indices 中还没有摘要的章节生成摘要（text_of(i) 返回第 i 章正文），有界并发，
+        on_progress(已完成数, 总数) 在工作线程中回调。返回失败的章节数。
+        """
+        pending = [i for i in indices if self.summaries.get(chapter_digest(text_of(i))) is None]
+        failed = 0
+        rewriter = BatchRewriter(lambda i: self.summarize(model_name, text_of(i), cancel=cancel), concurrency)
+        for n, (_, _, error) in enumerate(rewriter.run(((i, i) for i in pending), cancel_event), 1):
+            if error is not None:
+                failed += 1
+            if on_progress is not None:
+                on_progress(n, len(pending))
+        return failed
+
+    def context_prefix(self, model_name, titles, text_of, index):
+        """用已有的摘要为第 index 章构造前情提要（不发起请求），没有 SummaryStore 时返回空字符串"""
+        if self.summaries is None:
+            return ""
+        return chapter_context_prefix(self.summaries, titles, lambda i: chapter_digest(text_of(i)), index,
+                                      text_of(index), self.model_configs.get(model_name, {}))
+
+    def rewrite_book(self, file_path, out_path, direction, model_name, first=0, last=None,
+                     concurrency=DEFAULT_BATCH_CONCURRENCY, on_progress=None, cancel_event=None,
+                     journal=None, use_cache=True, job=None, summarize=False, on_summary=None):
+        """
+        按章节范围批量改写，参数与返回值同 batch_rewrite。
+        模型配置使用异步请求（见 use_async_http）时全部请求在后台事件循环中进行，并发数不受线程数限制。
+        summarize 为 True 且设置了 SummaryStore 时，先为范围内（及其前几章）缺少摘要的章节生成摘要，
+        进度通过 on_summary(已完成数, 总数) 回调，再以前情提要开头改写每一章。
+        """
+        config = self.model_configs.get(model_name, {})
+        # 提前结束（取消、出错或 Ctrl+C）时关闭仍在进行的请求，工作线程随即结束，不必等它们读完响应
+        abort = CancelToken()
+        try:
+            summaries = None
+            if summarize and self.summaries is not None:
+                novel = NovelIndex(file_path, grammar=self.grammar)
+                try:
+                    end = len(novel) - 1 if last is None else min(last, len(novel) - 1)
+                    text_of = novel.chapter_text
+                    if journal is not None:
+                        journal.bind(novel.titles)
+                        text_of = lambda i: journal.apply(i, novel.chapter_text(i))
+                    indices = range(max(0, first - SUMMARY_PREVIOUS_CHAPTERS), end + 1)
+                    self.summarize_chapters(model_name, text_of, indices, concurrency=concurrency,
+                                            on_progress=on_summary, cancel_event=cancel_event, cancel=abort)
+                finally:
+                    novel.close()
+                if cancel_event is not None and cancel_event.is_set():
+                    return None
+                summaries = self.summaries
+            submit = None
+            if use_async_http(config):
+                submit = lambda prompt: self.submit(self.complete_async(model_name, prompt, use_cache=use_cache,
+                                                                        direction=direction), abort)
+            return batch_rewrite(file_path, out_path, direction,
+                                 lambda prompt: self.complete(model_name, prompt, cancel=abort, use_cache=use_cache,
+                                                              direction=direction),
+                                 first=first, last=last, concurrency=concurrency, on_progress=on_progress,
+                                 cancel_event=cancel_event, journal=journal,
+                                 config=config, grammar=self.grammar, job=job, submit=submit, summaries=summaries)
+        finally:
+            abort.cancel()
+
+# --------------- 命令行 ---------------
+def parse_chapter_range(text, chapter_count):
+    """把 "3"、"1-100"、"50-" 之类的章节范围（从 1 开始，含两端）转换为从 0 开始的 (first, last)"""
+    if not text:
+        return 0, chapter_count - 1
+    m = re.fullmatch(r"\s*(\d+)\s*(?:(-)\s*(\d*)\s*)?", text)
+    if m is None:
+        raise ValueError(f"无法识别的章节范围：{text}")
+    first = int(m.group(1))
+    if m.group(2) is None:
+        last = first
+    else:
+        last = int(m.group(3)) if m.group(3) else chapter_count
+    if not 1 <= first <= last <= chapter_count:
+        raise ValueError(f"章节范围超出 1～{chapter_count}：{text}")
+    return first - 1, last - 1
+
+
+def _heading_grammar(args):
+    return read_heading_grammar(os.path.join(args.config_dir, HEADING_GRAMMAR_FILE))
+
+
+def _cmd_chapters(args):
+    novel = NovelIndex(args.book, grammar=_heading_grammar(args))
+    try:
+        for chapter in novel:
+            print(f"{chapter.index + 1}\t{chapter.title}\t{chapter.size} 字节")
+        print(f"共 {len(novel)} 章，扫描 {novel.size / 1024 / 1024:.1f} MB，用时 {novel.build_seconds:.3f}s，"
+              f"{novel.throughput or 0:.0f} MB/s", file=sys.stderr)
+    finally:
+        novel.close()
+    return 0
+
+
+def _cmd_rewrite(args):
+    configs = read_model_configs(os.path.join(args.config_dir, MODEL_CONFIG_FILE))
+    if args.model not in configs:
+        print(f"模型配置中没有【{args.model}】", file=sys.stderr)
+        return 2
+    if args.direction is not None:
+        direction = args.direction
+    else:
+        directions = read_directions(os.path.join(args.config_dir, DIRECTIONS_FILE))
+        if not 1 <= args.direction_index <= len(directions):
+            print(f"修改方向序号超出 1～{len(directions)}", file=sys.stderr)
+            return 2
+        direction = directions[args.direction_index - 1]
+    grammar = _heading_grammar(args)
+    novel = NovelIndex(args.book, grammar=grammar)
+    try:
+        chapter_count = len(novel)
+    finally:
+        novel.close()
+    try:
+        first, last = parse_chapter_range(args.chapters, chapter_count)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        return 2
+    out_path = args.output or os.path.join(os.path.dirname(os.path.abspath(args.book)),
+                                           new_revision_filename(args.book, args.model))
+    # 参数相同的未完成任务直接继续（沿用其输出文件名），已完成的片段不会重新请求
+    jobs = JobStore(os.path.join(args.config_dir, JOBS_FILE))
+    job = jobs.open("book", args.book, direction, args.model, first, last, out_path=out_path)
+    if job.resumed:
+        out_path = args.output or job.out_path or out_path
+        print(f"继续未完成的任务 #{job.id}，已完成 {job.done_count()} 个片段", flush=True)
+    cache = None if args.no_cache else RewriteCache(os.path.join(args.config_dir, CACHE_FILE))
+    summaries = SummaryStore(os.path.join(args.config_dir, SUMMARY_FILE)) if args.summaries else None
+    engine = RewriteEngine(configs, cache, grammar, TelemetryStore(os.path.join(args.config_dir, TELEMETRY_FILE)),
+                           summaries)
+    journal_path = EditJournal.path_for(args.book)
+    journal = EditJournal(journal_path) if os.path.exists(journal_path) else None
+    cancel_event = threading.Event()
+    started = time.monotonic()
+    last_print = [0.0]
+
+    def on_summary(done, total):
+        now = time.monotonic()
+        if done < total and now - last_print[0] < 1.0:
+            return
+        last_print[0] = now
+        print(f"[{now - started:7.1f}s] 章节摘要 {done}/{total}", flush=True)
+
+    def on_progress(done, total, failed):
+        now = time.monotonic()
+        if done < total and now - last_print[0] < 1.0:
+            return
+        last_print[0] = now
+        elapsed = max(now - started, 1e-6)
+        print(f"[{elapsed:7.1f}s] {done}/{total} 章  失败片段 {failed}  "
+              f"{done / elapsed * 60:.1f} 章/分钟  {engine.output_chars / elapsed:.0f} 字/秒", flush=True)
+
+    print(f"改写 {args.book} 第 {first + 1}～{last + 1} 章，模型【{args.model}】，并发 {args.concurrency}", flush=True)
+    try:
+        result = engine.rewrite_book(args.book, out_path, direction, args.model, first=first, last=last,
+                                     concurrency=args.concurrency, on_progress=on_progress,
+                                     cancel_event=cancel_event, journal=journal, job=job,
+                                     summarize=args.summaries, on_summary=on_summary)
+    except KeyboardInterrupt:
+        # BatchRewriter 已设置 cancel_event、取消排队中的请求，rewrite_book 已关闭进行中的请求
+        print(f"已取消，重新执行同一命令即可继续任务 #{job.id}", file=sys.stderr)
+        return 130
+    if result is None:
+        print(f"已取消，重新执行同一命令即可继续任务 #{job.id}", file=sys.stderr)
+        return 130
+    done, failed = result
+    _report_skipped(journal)
+    elapsed = max(time.monotonic() - started, 1e-6)
+    print(f"完成：{done} 章，失败片段 {failed} 个（保留原文），用时 {elapsed:.1f}s，"
+          f"平均 {engine.output_chars / elapsed:.0f} 字/秒", flush=True)
+    for client in (engine.client(args.model, create=False), engine.async_client(args.model, create=False)):
+        if client is not None and client.stats.requests:
+            print(client.summary())
+    print(f"已保存到文件：{out_path}")
+    if failed:
+        print(f"重新执行同一命令可只重试失败的片段（任务 #{job.id}）", file=sys.stderr)
+    return 1 if failed else 0
+
+
+def _cmd_export(args):
+    journal_path = EditJournal.path_for(args.book)
+    if not os.path.exists(journal_path):
+        print("该文件还没有任何修订", file=sys.stderr)
+        return 2
+    journal = EditJournal(journal_path)
+    out_path = args.output or os.path.join(os.path.dirname(os.path.abspath(args.book)),
+                                           new_revision_filename(args.book, args.model))
+    export_revision(args.book, journal, out_path, args.revision, grammar=_heading_grammar(args))
+    _report_skipped(journal)
+    print(f"已导出到文件：{out_path}")
+    return 0
+
+
+def _report_skipped(journal):
+    # 与原文对不上、或找不到所属章节的修订只在命令结束时汇总提示一次，输出到 stderr
+    if journal is None:
+        return
+    for seqs, reason in ((journal.skipped, "与原文不符"), (journal.orphaned, "找不到对应标题的章节")):
+        if seqs:
+            numbers = "、".join(str(seq + 1) for seq in sorted(seqs)[:10])
+            more = " 等" if len(seqs) > 10 else ""
+            print(f"修订日志中有 {len(seqs)} 条{reason}，已跳过（第 {numbers}{more} 条）", file=sys.stderr)
+
+
+def _cmd_jobs(args):
+    path = os.path.join(args.config_dir, JOBS_FILE)
+    rows = []
+    if os.path.exists(path):
+        jobs = JobStore(path)
+        try:
+            rows = jobs.unfinished("book")
+        finally:
+            jobs.close()
+    if not rows:
+        print("没有未完成的批量改写任务")
+    for row in rows:
+        updated = time.strftime("%Y-%m-%d %H:%M", time.localtime(row["updated"]))
+        print(f"#{row['id']}\t{updated}\t{row['book']}\t第 {row['first'] + 1}～{row['last'] + 1} 章\t"
+              f"【{row['model']}】\t已完成 {row['done']} 个片段\t{row['direction'][:30]}")
+    return 0
+
+
+def _cmd_stats(args):
+    path = os.path.join(args.config_dir, TELEMETRY_FILE)
+    if not os.path.exists(path):
+        print("还没有任何请求记录", file=sys.stderr)
+        return 2
+    telemetry = TelemetryStore(path)
+    try:
+        if args.clear:
+            telemetry.clear()
+            print("已清空请求记录")
+            return 0
+        since = time.time() - args.days * 86400 if args.days else None
+        print(format_telemetry_stats(telemetry.stats(since)))
+    finally:
+        telemetry.close()
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="novel_engine.py", description="无界面的小说改写工具")
+    parser.add_argument("--config-dir", default=os.path.dirname(os.path.abspath(__file__)),
+                        help="model_config.json、修改方向.json、章节标题.json、缓存、任务与请求统计所在目录（默认与本脚本相同）")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("chapters", help="列出章节")
+    p.add_argument("book")
+    p.set_defaults(func=_cmd_chapters)
+
+    p = sub.add_parser("rewrite", help="按修改方向批量改写章节")
+    p.add_argument("book")
+    group = p.add_mutually_exclusive_group(required=True)
+    group.add_argument("--direction", help="修改方向文本")
+    group.add_argument("--direction-index", type=int, help="修改方向.json 中的序号（从 1 开始）")
+    p.add_argument("--chapters", help="章节范围，如 1-100、50-、12（默认全书）")
+    p.add_argument("--model", default="小说模型", help="模型配置名称（默认：小说模型）")
+    p.add_argument("--concurrency", type=int, default=DEFAULT_BATCH_CONCURRENCY, help="并发请求数")
+    p.add_argument("--output", help="输出文件路径（默认按原有规则在原文件旁生成新文件名）")
+    p.add_argument("--no-cache", action="store_true", help="不使用改写缓存")
+    p.add_argument("--summaries", action="store_true",
+                   help="先为各章生成摘要与设定表（按正文缓存），改写时作为前情提要")
+    p.set_defaults(func=_cmd_rewrite)
+
+    p = sub.add_parser("export", help="把修订日志物化为 txt 文件")
+    p.add_argument("book")
+    p.add_argument("--revision", type=int, help="导出到第几条修订（默认全部）")
+    p.add_argument("--model", default="小说模型", help="用于生成文件名的模型名称")
+    p.add_argument("--output", help="输出文件路径")
+    p.set_defaults(func=_cmd_export)
+
+    p = sub.add_parser("jobs", help="列出未完成的批量改写任务（以相同参数重新执行 rewrite 即可继续）")
+    p.set_defaults(func=_cmd_jobs)
+
+    p = sub.add_parser("stats", help="按模型配置统计请求耗时（p50 / p95，单位：秒）")
+    p.add_argument("--days", type=float, help="只统计最近若干天（默认全部）")
+    p.add_argument("--clear", action="store_true", help="清空请求记录")
+    p.set_defaults(func=_cmd_stats)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
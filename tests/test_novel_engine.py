@@ -0,0 +1,432 @@
+# -*- coding: utf-8 -*-
+# novel_engine 的单元测试：python -m pytest tests 或 python -m unittest discover tests
+import asyncio
+import http.server
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from novel_engine import build_heading_regex, request_completion, CancelToken, RequestCancelled, percentile, \
+    EditJournal, export_revision, batch_rewrite, BatchRewriter, ApiError, JobStore, RewriteEngine, ApiStats, \
+    AsyncConnectionPool, AsyncApiClient, TokenCoalescer, RateLimiter
+
+
+# --------------- 章节标题识别 ---------------
+class HeadingRegexTest(unittest.TestCase):
+    def title_of(self, line, encoding="utf-8"):
+        m = build_heading_regex(encoding).match(("\n" + line + "\n").encode(encoding))
+        return None if m is None else m.group(1).decode(encoding)
+
+    def test_separated_subtitle(self):
+        for line in ("第一章 起航", "第二节 入门", "第3回：归来", "Chapter 3: Home", "CHAPTER IV"):
+            self.assertEqual(self.title_of(line), line)
+
+    def test_subtitle_without_separator(self):
+        for encoding in ("utf-8", "gb18030", "utf-16-le"):
+            for line in ("第一章起航", "第十章决战", "第二回风起", "第三卷终局"):
+                self.assertEqual(self.title_of(line, encoding), line)
+
+    def test_prose_is_not_heading(self):
+        self.assertIsNone(self.title_of("第三节课上，老师讲了一个故事。"))
+        self.assertIsNone(self.title_of("Chapter 3Home"))
+        self.assertIsNone(self.title_of("第一章" + "长" * 80))
+
+
+# --------------- 修订日志 ---------------
+class EditJournalTest(unittest.TestCase):
+    def test_mismatched_patch_is_skipped_and_recorded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = EditJournal(os.path.join(tmp, "book.txt" + EditJournal.SUFFIX))
+            journal.append(0, "第一章", 0, "甲", "乙")
+            journal.append(0, "第一章", 1, "丙", "丁")
+            self.assertEqual(journal.apply(0, "甲丙"), "乙丁")
+            self.assertEqual(journal.skipped, set())
+            self.assertEqual(journal.apply(0, "甲戊"), "乙戊")
+            self.assertEqual(journal.apply(0, "甲戊"), "乙戊")
+            self.assertEqual(journal.skipped, {1})
+
+    def test_patch_follows_its_chapter_title(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            journal = EditJournal(os.path.join(tmp, "book.txt" + EditJournal.SUFFIX))
+            journal.append(1, "第二章", 0, "甲", "乙")
+            journal.append(2, "第三章", 0, "丙", "丁")
+            # 书前插入了一章，第三章被删掉：第一条跟着标题移到序号 2，第二条找不到所属章节
+            journal.bind(["序", "第一章", "第二章"])
+            self.assertEqual(journal.patched_chapters(), [2])
+            self.assertEqual(journal.apply(1, "甲"), "甲")
+            self.assertEqual(journal.apply(2, "甲丙"), "乙丙")
+            self.assertEqual(journal.orphaned, {1})
+
+    def test_export_uses_chapter_titles(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            book = os.path.join(tmp, "book.txt")
+            with open(book, "w", encoding="utf-8") as f:
+                f.write("第零章 楔子\n正文零\n第一章 开端\n正文一\n第二章 转折\n正文二\n")
+            # 补丁记录时还没有楔子，第二章的序号是 1
+            journal = EditJournal(EditJournal.path_for(book))
+            journal.append(1, "第二章 转折", 0, "正文二", "新正文")
+            out = os.path.join(tmp, "out.txt")
+            progress = []
+            export_revision(book, journal, out, on_progress=lambda done, total: progress.append((done, total)))
+            with open(out, encoding="utf-8") as f:
+                self.assertEqual(f.read(), "第零章 楔子\n正文零\n第一章 开端\n正文一\n第二章 转折\n新正文\n")
+            self.assertEqual(journal.orphaned, set())
+            self.assertEqual(progress[-1], (3, 3))
+
+
+# --------------- 批量改写 ---------------
+class BatchRewriteTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.book = os.path.join(self.tmp.name, "book.txt")
+        self.out = os.path.join(self.tmp.name, "out.txt")
+        with open(self.book, "w", encoding="utf-8") as f:
+            f.write("".join(f"第{i}章 标题\n正文{i}。\n" for i in range(1, 6)))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_rewrites_into_output(self):
+        self.assertEqual(batch_rewrite(self.book, self.out, "改写", lambda prompt: "新的正文。"), (5, 0))
+        with open(self.out, encoding="utf-8") as f:
+            self.assertEqual(f.read().count("新的正文。"), 5)
+        self.assertFalse(os.path.exists(self.out + ".part"))
+
+    def test_failure_removes_partial_output(self):
+        def on_progress(done, total, failed):
+            if done == 2:
+                raise KeyboardInterrupt()
+        with self.assertRaises(KeyboardInterrupt):
+            batch_rewrite(self.book, self.out, "改写", lambda prompt: "新的正文。", on_progress=on_progress)
+        self.assertFalse(os.path.exists(self.out + ".part"))
+        self.assertFalse(os.path.exists(self.out))
+
+    def test_close_does_not_wait_for_pending_requests(self):
+        started = []
+
+        def complete(prompt):
+            started.append(prompt)
+            time.sleep(0.2)
+            return prompt
+        cancel_event = threading.Event()
+        results = BatchRewriter(complete, 1).run(((i, i) for i in range(20)), cancel_event)
+        self.assertEqual(next(results), (0, 0, None))
+        begun = time.monotonic()
+        results.close()  # 与 Ctrl+C 时关闭生成器相同
+        self.assertLess(time.monotonic() - begun, 0.1)
+        self.assertTrue(cancel_event.is_set())
+        time.sleep(0.3)
+        self.assertEqual(started, [0, 1])  # 排队中的请求已取消，不会再开始
+
+
+# --------------- 分段改写 ---------------
+class RewriteTextTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.jobs = JobStore(os.path.join(self.tmp.name, "jobs.db"))
+        self.engine = RewriteEngine({"m": {"max_output_tokens": 300}})
+        self.engine.complete = self.fake_complete
+        self.engine.complete_async = self.fake_complete_async
+        self.text = "\n".join(f"第{i}段" + "字" * 150 for i in range(4))
+        self.calls = []
+        self.fail_at = 3
+
+    def tearDown(self):
+        self.jobs.close()
+        self.tmp.cleanup()
+
+    def fake_complete(self, model_name, prompt, on_token=None, **kwargs):
+        self.calls.append(prompt)
+        if len(self.calls) == self.fail_at:
+            raise ApiError("失败")
+        if on_token is not None:
+            on_token("改")
+            on_token("写")
+        return "改写"
+
+    async def fake_complete_async(self, model_name, prompt, on_token=None, **kwargs):
+        return self.fake_complete(model_name, prompt, on_token, **kwargs)
+
+    def check_resume(self, rewrite):
+        job = self.jobs.open("text", None, "改写", "m", text=self.text)
+        with self.assertRaises(ApiError):
+            rewrite("m", "改写", self.text, job=job)
+        self.assertEqual(len(self.calls), 3)
+        # 以相同参数重新执行时，已完成的两段直接取用检查点
+        tokens = []
+        job = self.jobs.open("text", None, "改写", "m", text=self.text)
+        result = rewrite("m", "改写", self.text, on_token=tokens.append, job=job)
+        self.assertEqual(result, "\n".join(["改写"] * 4))
+        self.assertEqual("".join(tokens), result)
+        self.assertEqual(len(self.calls), 5)
+
+    def test_rewrite_text_resumes_from_job(self):
+        self.check_resume(self.engine.rewrite_text)
+
+    def test_rewrite_text_async_resumes_from_job(self):
+        self.check_resume(lambda *args, **kwargs: asyncio.run(self.engine.rewrite_text_async(*args, **kwargs)))
+
+
+# --------------- 取消请求 ---------------
+class _SlowHandler(http.server.BaseHTTPRequestHandler):
+    # 过一会儿才返回响应头，之后正常输出一段流式结果
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.server.header_delay)
+        body = b'data: {"choices": [{"delta": {"content": "ok"}}]}\n\ndata: [DONE]\n\n'
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CancelTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _SlowHandler)
+        self.server.header_delay = 0.5
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.config = {"api_key": "test", "model": "m", "stream": True, "async_http": False,
+                       "url": f"http://127.0.0.1:{self.server.server_address[1]}/v1/chat/completions"}
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_stream_completes(self):
+        self.assertEqual(request_completion(self.config, "hi"), "ok")
+
+    def test_cancel_while_waiting_for_headers(self):
+        cancel = CancelToken()
+        threading.Timer(0.1, cancel.cancel).start()
+        with self.assertRaises(RequestCancelled):
+            request_completion(self.config, "hi", cancel=cancel)
+
+
+# --------------- 限流 ---------------
+class RateLimiterTest(unittest.TestCase):
+    def acquire_in_thread(self, limiter, cancel=None):
+        result = {}
+
+        def task():
+            try:
+                limiter.acquire(cancel=cancel)
+                result["acquired_at"] = time.monotonic()
+            except RequestCancelled:
+                result["cancelled_at"] = time.monotonic()
+        thread = threading.Thread(target=task, daemon=True)
+        thread.start()
+        return thread, result
+
+    def test_release_wakes_waiter(self):
+        limiter = RateLimiter({"max_concurrency": 1})
+        limiter.acquire()
+        thread, result = self.acquire_in_thread(limiter)
+        time.sleep(0.2)
+        self.assertEqual(result, {})
+        released_at = time.monotonic()
+        limiter.release()
+        thread.join(1)
+        self.assertLess(result["acquired_at"] - released_at, 0.05)
+        self.assertEqual(limiter.in_flight, 1)
+
+    def test_cancel_wakes_waiter(self):
+        limiter = RateLimiter({"max_concurrency": 1})
+        limiter.acquire()
+        cancel = CancelToken()
+        thread, result = self.acquire_in_thread(limiter, cancel)
+        time.sleep(0.2)
+        cancelled_at = time.monotonic()
+        cancel.cancel()
+        thread.join(1)
+        self.assertLess(result["cancelled_at"] - cancelled_at, 0.05)
+        self.assertEqual(limiter.in_flight, 1)
+
+
+# --------------- 流式输出合并 ---------------
+class TokenCoalescerTest(unittest.TestCase):
+    def test_pending_text_is_flushed_after_interval(self):
+        batches = []
+        done = threading.Event()
+
+        def emit(text):
+            batches.append(text)
+            if len(batches) == 2:
+                done.set()
+        coalescer = TokenCoalescer(emit, interval=0.05)
+        for piece in ("甲", "乙", "丙"):
+            coalescer(piece)
+        # 首段立即交出，其余在窗口结束时由定时器补发，不必等下一个 token 或显式 flush
+        self.assertEqual(batches, ["甲"])
+        self.assertTrue(done.wait(1))
+        self.assertEqual(batches, ["甲", "乙丙"])
+        self.assertEqual(coalescer.tokens, 3)
+
+    def test_flush_cancels_trailing_timer(self):
+        batches = []
+        coalescer = TokenCoalescer(batches.append, interval=0.05)
+        coalescer("甲")
+        coalescer("乙")
+        coalescer.flush()
+        time.sleep(0.1)
+        self.assertEqual(batches, ["甲", "乙"])
+
+
+# --------------- 异步 HTTP 客户端 ---------------
+CHUNKED_BODY = b"5\r\nhello\r\n1\r\n \r\n5;ext=1\r\nworld\r\n0\r\n\r\n"
+
+
+class _RawHandler(http.server.BaseHTTPRequestHandler):
+    # 按路径返回不同形式的响应体；分块响应故意拆成几个字节一段、中间停顿，让客户端分多次读到
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self.server.requests.append((self.path, self.client_address))
+        if self.path == "/length":
+            self.send_body(200, b"hello world")
+        elif self.path == "/retry":
+            if len(self.server.requests) == 1:
+                self.send_body(429, b"too many", {"Retry-After": "0.5"})
+            else:
+                self.send_body(200, b"ok")
+        else:
+            self.send_response(200)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            try:
+                if self.path == "/slow":
+                    # 先发一块，过一会儿才发其余部分
+                    self.wfile.write(CHUNKED_BODY[:10])
+                    time.sleep(0.5)
+                    self.wfile.write(CHUNKED_BODY[10:])
+                else:
+                    for pos in range(0, len(CHUNKED_BODY), 3):
+                        self.wfile.write(CHUNKED_BODY[pos:pos + 3])
+                        time.sleep(0.01)
+            except OSError:
+                pass  # 客户端已放弃这个连接
+
+    def send_body(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class AsyncHttpTest(unittest.TestCase):
+    def setUp(self):
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _RawHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self.stats = ApiStats()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def run_with_pool(self, test):
+        async def main():
+            pool = AsyncConnectionPool(self.stats, 5, 5)
+            try:
+                return await test(pool)
+            finally:
+                pool.close()
+        return asyncio.run(main())
+
+    def test_chunked_body_split_across_reads(self):
+        async def test(pool):
+            response = await pool.request("POST", self.base + "/chunked", {})
+            chunks = [chunk async for chunk in response.iter_chunks()]
+            self.assertGreater(len(chunks), 1)
+            return b"".join(chunks)
+        self.assertEqual(self.run_with_pool(test), b"hello world")
+
+    def test_content_length_body(self):
+        async def test(pool):
+            response = await pool.request("POST", self.base + "/length", {})
+            return await response.read()
+        self.assertEqual(self.run_with_pool(test), b"hello world")
+
+    def test_connection_reused_after_full_read(self):
+        async def test(pool):
+            for path in ("/chunked", "/length", "/chunked"):
+                response = await pool.request("POST", self.base + path, {})
+                self.assertEqual(await response.read(), b"hello world")
+        self.run_with_pool(test)
+        self.assertEqual(self.stats.new_connections, 1)
+        self.assertEqual(len({address for _, address in self.server.requests}), 1)
+
+    def test_connection_discarded_after_partial_read(self):
+        async def test(pool):
+            response = await pool.request("POST", self.base + "/slow", {})
+            async for chunk in response.iter_chunks():
+                self.assertEqual(chunk, b"hello")
+                break
+            response.close()
+            response = await pool.request("POST", self.base + "/length", {})
+            return await response.read()
+        self.assertEqual(self.run_with_pool(test), b"hello world")
+        self.assertEqual(self.stats.new_connections, 2)
+
+    def test_connection_discarded_after_cancel(self):
+        async def test(pool):
+            response = await pool.request("POST", self.base + "/slow", {})
+            task = asyncio.ensure_future(response.read())
+            await asyncio.sleep(0.1)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            response = await pool.request("POST", self.base + "/length", {})
+            return await response.read()
+        self.assertEqual(self.run_with_pool(test), b"hello world")
+        self.assertEqual(self.stats.new_connections, 2)
+
+    def test_retry_after_on_429(self):
+        async def test():
+            client = AsyncApiClient({"max_retries": 2, "backoff_base": 0.01})
+            try:
+                started = time.monotonic()
+                response = await client.post(self.base + "/retry", {}, {})
+                elapsed = time.monotonic() - started
+                return await response.read(), elapsed, client.stats.retries
+            finally:
+                client.close()
+        body, elapsed, retries = asyncio.run(test())
+        self.assertEqual(body, b"ok")
+        self.assertGreaterEqual(elapsed, 0.5)
+        self.assertEqual(retries, 1)
+        self.assertEqual([path for path, _ in self.server.requests], ["/retry", "/retry"])
+
+
+# --------------- 遥测统计 ---------------
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        self.assertEqual(percentile(range(1, 11), 50), 5)
+        self.assertEqual(percentile(range(1, 21), 95), 19)
+        self.assertEqual(percentile(range(1, 101), 95), 95)
+        self.assertEqual(percentile(range(1, 101), 7), 7)
+        self.assertEqual(percentile(range(1, 11), 95), 10)
+        self.assertEqual(percentile([3.0], 50), 3.0)
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 0), 1)
+        self.assertEqual(percentile([5, 1, 4, 2, 3], 100), 5)
+        self.assertIsNone(percentile([], 50))
+
+
+if __name__ == "__main__":
+    unittest.main()